@@ -0,0 +1,141 @@
+"""
+Benchmark: PayFastOrder admin and reporting queries on a large generated table.
+
+Generates a SQLite database of PayFastOrder rows (2 million by default), and
+prints the query plan and timing of the queries the composite indexes serve.
+Pass ``--drop-indexes`` to compare against the table without them.
+
+Usage::
+
+    python benchmarks/bench_indexes.py [--rows N] [--db PATH] [--drop-indexes]
+
+The generated database is kept (and reused) at PATH.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import timedelta
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'payfast_tests')]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+
+def setup_django(db_path):
+    import django
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = db_path
+    django.setup()
+
+
+def generate(rows, batch_size=10000):
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+    from payfast.models import PayFastOrder, payment_status_code
+
+    users = [User.objects.create(username='user{}'.format(n)) for n in range(100)]
+    start = timezone.now() - timedelta(days=3 * 365)
+    statuses = ['COMPLETE'] * 6 + ['PENDING'] * 3 + ['FAILED', 'CANCELLED']
+    rng = random.Random(0)
+    for offset in range(0, rows, batch_size):
+        orders = []
+        for n in range(offset, min(offset + batch_size, rows)):
+            status = rng.choice(statuses)
+            # bulk_create() bypasses save(): set the derived fields explicitly.
+            orders.append(PayFastOrder(
+                m_payment_id=str(n),
+                pf_payment_id=str(n) if n % 3 else None,
+                item_name='Item {}'.format(n % 50),
+                amount_gross=rng.randint(100, 100000) / 100,
+                payment_status=status,
+                payment_status_code=payment_status_code(status),
+                trusted=rng.choice([True, True, True, False, None]),
+                user=rng.choice(users),
+            ))
+        PayFastOrder.objects.bulk_create(orders)
+        sys.stdout.write('\rGenerated {} rows'.format(min(offset + batch_size, rows)))
+        sys.stdout.flush()
+    print()
+
+    # auto_now_add ignores explicit values: spread created_at over three years.
+    from django.db import connection
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE payfast_payfastorder"
+            " SET created_at = datetime(%s, '+' || (id * %s) || ' seconds')",
+            [start.strftime('%Y-%m-%d %H:%M:%S'), (3 * 365 * 86400) // max(rows, 1)])
+        cursor.execute('ANALYZE')
+
+
+def queries():
+    from django.utils import timezone
+    from payfast.models import PayFastOrder, payment_status_q
+
+    recent = timezone.now() - timedelta(days=30)
+    orders = PayFastOrder.objects.all()
+    return [
+        ('pending orders by date',
+         orders.filter(payment_status_q('PENDING'), created_at__gte=recent).order_by('created_at')),
+        ('admin: trusted filter, newest first',
+         orders.filter(trusted=True).order_by('-created_at')[:100]),
+        ('admin: status filter + month drill-down',
+         orders.filter(payment_status_q('COMPLETE'),
+                       created_at__gte=recent - timedelta(days=30), created_at__lt=recent)
+         .order_by('-created_at')[:100]),
+        ("a user's orders, newest first",
+         orders.filter(user__username='user7').order_by('-created_at')[:100]),
+    ]
+
+
+def run(repeat):
+    from django.db import connection
+
+    for (name, queryset) in queries():
+        (sql, params) = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' / '.join(str(row[-1]) for row in cursor.fetchall())
+        timings = []
+        for _ in range(repeat):
+            started = default_timer()
+            list(queryset.values_list('pk'))
+            timings.append(default_timer() - started)
+        print('{:45} {:8.1f} ms  {}'.format(name, min(timings) * 1000, plan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(),
+                                                     'payfast_bench_indexes.sqlite'))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--drop-indexes', action='store_true')
+    args = parser.parse_args()
+
+    fresh = not os.path.exists(args.db)
+    setup_django(args.db)
+
+    from django.core.management import call_command
+    from django.db import connection, transaction
+    call_command('migrate', verbosity=0)
+    if fresh:
+        generate(args.rows)
+
+    # SQLite DDL is transactional: dropped indexes are restored on rollback.
+    with transaction.atomic():
+        if args.drop_indexes:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'"
+                               " AND tbl_name = 'payfast_payfastorder'"
+                               " AND name LIKE '%_created_at_%'")
+                for (name,) in cursor.fetchall():
+                    cursor.execute('DROP INDEX {}'.format(name))
+        run(args.repeat)
+        transaction.set_rollback(True)
+
+
+if __name__ == '__main__':
+    main()
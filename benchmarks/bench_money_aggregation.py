@@ -0,0 +1,123 @@
+"""
+Benchmark: summing PayFastOrder amounts as decimals versus integer cents.
+
+Generates a SQLite database of PayFastOrder rows (1 million by default), and
+times totals over the DecimalField amounts against the integer cents columns
+(`PayFastOrderQuerySet.amount_totals`), overall and per payment status.
+Also times the amount comparison of `NotifyForm.clean_amount_gross`.
+
+Usage::
+
+    python benchmarks/bench_money_aggregation.py [--rows N] [--db PATH] [--repeat N]
+
+The generated database is kept (and reused) at PATH.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from decimal import Decimal
+from timeit import default_timer, timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'payfast_tests')]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+
+def setup_django(db_path):
+    import django
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = db_path
+    django.setup()
+
+
+def generate(rows, batch_size=10000):
+    from payfast.models import PayFastOrder
+
+    statuses = ['COMPLETE'] * 6 + ['PENDING'] * 3 + ['FAILED', 'CANCELLED']
+    rng = random.Random(0)
+    for offset in range(0, rows, batch_size):
+        orders = []
+        for n in range(offset, min(offset + batch_size, rows)):
+            gross = rng.randint(100, 1000000)
+            fee = -(gross * 35 // 1000)
+            # bulk_create() bypasses save(): set the cents columns explicitly.
+            orders.append(PayFastOrder(
+                m_payment_id=str(n),
+                item_name='Item',
+                payment_status=rng.choice(statuses),
+                amount_gross=Decimal(gross).scaleb(-2),
+                amount_fee=Decimal(fee).scaleb(-2),
+                amount_net=Decimal(gross + fee).scaleb(-2),
+                amount_gross_cents=gross,
+                amount_fee_cents=fee,
+                amount_net_cents=gross + fee,
+            ))
+        PayFastOrder.objects.bulk_create(orders)
+        sys.stdout.write('\rGenerated {} rows'.format(min(offset + batch_size, rows)))
+        sys.stdout.flush()
+    print()
+
+
+def best(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = default_timer()
+        result = fn()
+        timings.append(default_timer() - started)
+    return (min(timings), result)
+
+
+def run(repeat):
+    from django.db.models import Sum
+    from payfast import money
+    from payfast.models import AMOUNT_FIELDS, PayFastOrder
+
+    orders = PayFastOrder.objects.all()
+    cases = [
+        ('totals, DecimalField', lambda: orders.aggregate(
+            **{name: Sum(name) for name in AMOUNT_FIELDS})),
+        ('totals, cents', lambda: orders.amount_totals()),
+        ('totals by status, DecimalField', lambda: list(
+            orders.order_by().values('payment_status').annotate(gross=Sum('amount_gross')))),
+        ('totals by status, cents', lambda: list(
+            orders.order_by().values('payment_status').annotate(gross=Sum('amount_gross_cents')))),
+    ]
+    for (name, fn) in cases:
+        (elapsed, result) = best(repeat, fn)
+        print('{:35} {:8.1f} ms'.format(name, elapsed * 1000))
+
+    (requested, received) = (Decimal('1234.50'), Decimal('1234.50'))
+    requested_cents = money.to_cents(requested)
+    number = 100000
+    for (name, stmt) in [
+            ('compare, Decimal', lambda: requested != received),
+            ('compare, stored cents', lambda: requested_cents != money.to_cents(received)),
+            ('parse ITN amount, Decimal', lambda: Decimal('1234.50')),
+            ('parse ITN amount, cents', lambda: money.to_cents('1234.50')),
+    ]:
+        elapsed = timeit(stmt, number=number)
+        print('{:35} {:8.3f} us'.format(name, elapsed / number * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(),
+                                                     'payfast_bench_money.sqlite'))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fresh = not os.path.exists(args.db)
+    setup_django(args.db)
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+    if fresh:
+        generate(args.rows)
+    run(args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""
+Load test: how many ITNs per second the notify view absorbs, fully offline.
+
+Starts a local stand-in for PayFast that serves the postback validation
+endpoint (``/eng/query/validate``) with injectable latency and error rates,
+then fires signed ITNs (see `payfast.api.itn_signature`) at the notify URL,
+at a fixed rate, and reports the throughput and p50/p95/p99 latencies.
+
+Usage::
+
+    python benchmarks/loadtest.py [--requests N] [--rate N] [--concurrency N]
+        [--postback-latency MS] [--postback-jitter MS]
+        [--postback-error-rate P] [--postback-invalid-rate P]
+
+By default, the notify view runs in-process, on a threaded WSGI server with the
+``payfast_tests`` settings and a fresh SQLite database (``--db``).
+
+To load a deployment instead, pass its notify URL with ``--url``, and the
+``m_payment_id`` values of existing, unpaid orders with ``--orders-file`` (one per line).
+Configure the deployment with ``PAYFAST_SERVER`` set to the stand-in's URL
+(fix its port with ``--fake-port``), and ``PAYFAST_IP_ADDRESSES`` including this host.
+
+``--rate 0`` fires as fast as ``--concurrency`` allows. Otherwise, latencies are
+measured from each ITN's scheduled send time, so they include any queueing
+once the target falls behind the rate.
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from timeit import default_timer
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'payfast_tests')]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+POSTBACK_PATH = '/eng/query/validate'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakePayFastHandler(BaseHTTPRequestHandler):
+    """
+    Answer postback validations like PayFast, after the server's configured delay.
+    """
+
+    def do_POST(self):
+        if self.path != POSTBACK_PATH:
+            self.send_error(404)
+            return
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        (delay, outcome) = server.next_response()
+        time.sleep(delay)
+        if outcome == 'error':
+            self.send_error(500)
+            return
+        body = outcome.encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakePayFast(ThreadingHTTPServer):
+    """
+    A local stand-in for the PayFast postback endpoint.
+
+    Each postback waits `latency` seconds (plus up to `jitter`), then fails with
+    a 500 response at `error_rate`, answers INVALID at `invalid_rate`, or VALID.
+    """
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, invalid_rate=0.0,
+                 seed=0):
+        super().__init__(('127.0.0.1', port), FakePayFastHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.invalid_rate = invalid_rate
+        self.outcomes = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def next_response(self):
+        with self._lock:
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            draw = self._rng.random()
+            if draw < self.error_rate:
+                outcome = 'error'
+            elif draw < self.error_rate + self.invalid_rate:
+                outcome = 'INVALID'
+            else:
+                outcome = 'VALID'
+            self.outcomes[outcome] += 1
+        return (delay, outcome)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def setup_django(db_path, fake_url):
+    import django
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = db_path
+    # Concurrent ITNs queue for SQLite's write lock.
+    settings.DATABASES['default']['OPTIONS'] = {'timeout': 30}
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ['*']
+    settings.PAYFAST_SERVER = fake_url
+    settings.PAYFAST_IP_ADDRESSES = ['127.0.0.1']
+    settings.PAYFAST_USE_POSTBACK = True
+    django.setup()
+    # Rejected ITNs and postback errors are counted, not logged.
+    logging.getLogger('django.request').disabled = True
+
+
+def create_orders(count, amount):
+    from payfast import money
+    from payfast.models import PayFastOrder
+
+    PayFastOrder.objects.bulk_create([
+        # bulk_create() bypasses save(): set the cents column explicitly.
+        PayFastOrder(m_payment_id='load-{}'.format(n), item_name='Load test',
+                     amount_gross=Decimal(amount), amount_gross_cents=money.to_cents(amount))
+        for n in range(count)
+    ], batch_size=1000)
+    return ['load-{}'.format(n) for n in range(count)]
+
+
+def start_notify_server():
+    from django.core.wsgi import get_wsgi_application
+    from payfast.forms import notify_url
+    from urllib.parse import urlsplit
+
+    server = ThreadingWSGIServer(('127.0.0.1', 0), QuietWSGIRequestHandler)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], urlsplit(notify_url()).path)
+
+
+def itn_body(n, m_payment_id, amount, merchant_id):
+    from payfast import api
+    from payfast import money
+
+    gross = money.to_cents(amount)
+    fee = -(gross * 35 // 1000)
+    data = OrderedDict([
+        ('m_payment_id', m_payment_id),
+        ('pf_payment_id', str(1000000 + n)),
+        ('payment_status', 'COMPLETE'),
+        ('item_name', 'Load test'),
+        ('amount_gross', money.format_cents(gross)),
+        ('amount_fee', money.format_cents(fee)),
+        ('amount_net', money.format_cents(gross + fee)),
+        ('merchant_id', merchant_id),
+    ])
+    data['signature'] = api.itn_signature(data)
+    return urlencode(data).encode('utf-8')
+
+
+def fire(url, body, scheduled, timeout):
+    started = default_timer() if scheduled is None else scheduled
+    try:
+        with urlopen(Request(url, data=body), timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    except (URLError, OSError) as e:
+        status = type(e).__name__
+    return (status, default_timer() - started)
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile.
+    """
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, int(round(p / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run(url, bodies, rate, concurrency, timeout):
+    futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        started = default_timer()
+        for (n, body) in enumerate(bodies):
+            if rate:
+                scheduled = started + n / rate
+                delay = scheduled - default_timer()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = None
+            futures.append(executor.submit(fire, url, body, scheduled, timeout))
+        results = [future.result() for future in futures]
+        elapsed = default_timer() - started
+    return (results, elapsed)
+
+
+def report(results, elapsed, fake):
+    statuses = Counter(status for (status, _) in results)
+    latencies = sorted(latency for (_, latency) in results)
+    ok = statuses.get(200, 0)
+    print('ITNs sent:      {}'.format(len(results)))
+    print('Elapsed:        {:.2f} s'.format(elapsed))
+    print('Throughput:     {:.1f} ITNs/s ({:.1f} accepted/s)'.format(
+        len(results) / elapsed, ok / elapsed))
+    print('Responses:      {}'.format(', '.join(
+        '{}: {}'.format(status, count) for (status, count) in sorted(
+            statuses.items(), key=lambda item: str(item[0])))))
+    for p in [50, 95, 99]:
+        print('Latency p{}:    {:8.1f} ms'.format(p, percentile(latencies, p) * 1000))
+    print('Latency max:    {:8.1f} ms'.format(latencies[-1] * 1000 if latencies else float('nan')))
+    print('Postbacks:      {}'.format(', '.join(
+        '{}: {}'.format(outcome, count) for (outcome, count) in sorted(fake.outcomes.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000, help='ITNs to send.')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='ITNs per second (0: as fast as possible).')
+    parser.add_argument('--concurrency', type=int, default=20, help='ITNs in flight at most.')
+    parser.add_argument('--timeout', type=float, default=30, help='Request timeout, in seconds.')
+    parser.add_argument('--amount', default='100.00', help='Order amount.')
+    parser.add_argument('--merchant-id', default='10000100')
+    parser.add_argument('--postback-latency', type=float, default=50, help='In milliseconds.')
+    parser.add_argument('--postback-jitter', type=float, default=0, help='In milliseconds.')
+    parser.add_argument('--postback-error-rate', type=float, default=0)
+    parser.add_argument('--postback-invalid-rate', type=float, default=0)
+    parser.add_argument('--fake-port', type=int, default=0)
+    parser.add_argument('--url', help='Notify URL of a deployment (default: in-process).')
+    parser.add_argument('--orders-file', help='With --url: m_payment_ids of existing orders.')
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(),
+                                                     'payfast_loadtest.sqlite'),
+                        help='In-process SQLite database (recreated).')
+    args = parser.parse_args()
+
+    fake = FakePayFast(port=args.fake_port,
+                       latency=args.postback_latency / 1000.0,
+                       jitter=args.postback_jitter / 1000.0,
+                       error_rate=args.postback_error_rate,
+                       invalid_rate=args.postback_invalid_rate)
+    fake.start()
+    print('PayFast stand-in: {}'.format(fake.url))
+
+    if args.url:
+        if not args.orders_file:
+            parser.error('--url requires --orders-file')
+        with open(args.orders_file) as f:
+            order_ids = [line.strip() for line in f if line.strip()]
+        url = args.url
+    else:
+        if os.path.exists(args.db):
+            os.remove(args.db)
+        setup_django(args.db, fake.url)
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+        order_ids = create_orders(args.requests, args.amount)
+        url = start_notify_server()
+    print('Notify URL:       {}'.format(url))
+
+    bodies = [itn_body(n, order_ids[n % len(order_ids)], args.amount, args.merchant_id)
+              for n in range(args.requests)]
+    (results, elapsed) = run(url, bodies, args.rate, args.concurrency, args.timeout)
+    report(results, elapsed, fake)
+    fake.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Microbenchmarks: signing, IP matching and form construction.
+
+Times the per-request work of checkout and ITN handling with realistic payloads,
+and measures the memory each operation allocates (with tracemalloc):
+
+* ``api.checkout_signature`` and ``api.itn_signature``
+* ``forms.is_payfast_ip_address``, for PayFast and other addresses
+* ``PayFastForm.__init__``, for an existing order (one query)
+* ``NotifyForm.is_valid()``, without the postback
+
+Usage::
+
+    python benchmarks/microbench.py [--baseline PATH] [--threshold FRACTION]
+        [--save-baseline] [--duration SECONDS] [--only NAME ...]
+
+With ``--baseline``, results are compared against the stored baseline: the run
+fails (exit status 1) if an operation is slower, or allocates more, than the
+baseline by more than the threshold (default 0.25). ``--save-baseline`` stores
+the results instead. Run it with ``tox -e bench``.
+
+Throughput depends on the machine: compare against a baseline recorded on the
+same machine (or CI runner type).
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from collections import OrderedDict
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'payfast_tests')]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+#: The address of a PayFast server, and an address that is not.
+PAYFAST_IP = '197.97.145.150'
+OTHER_IP = '203.0.113.7'
+
+
+def setup_django():
+    import django
+    from django.conf import settings
+    settings.DATABASES['default']['NAME'] = ':memory:'
+    settings.DEBUG = False  # Don't keep a log of the queries.
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def checkout_data():
+    return OrderedDict([
+        ('merchant_id', '10000100'),
+        ('merchant_key', '46f0cd694581a'),
+        ('return_url', 'https://shop.example.com/payfast/return/'),
+        ('cancel_url', 'https://shop.example.com/payfast/cancel/'),
+        ('notify_url', 'https://shop.example.com/payfast/notify/'),
+        ('name_first', 'Вася'),
+        ('name_last', 'Пупников'),
+        ('email_address', 'vasya@example.com'),
+        ('m_payment_id', '10472'),
+        ('amount', '1234.50'),
+        ('item_name', 'Payment (Планета суши). ID:272-15'),
+        ('item_description', 'Two sets, delivered'),
+        ('custom_int1', '42'),
+        ('custom_str1', 'campaign-2018'),
+    ])
+
+
+def itn_data():
+    from payfast import api
+
+    data = OrderedDict([
+        ('m_payment_id', 'bench'),
+        ('pf_payment_id', '613381'),
+        ('payment_status', 'COMPLETE'),
+        ('item_name', 'Payment (Планета суши). ID:272-15'),
+        ('item_description', 'Two sets, delivered'),
+        ('amount_gross', '1234.50'),
+        ('amount_fee', '-28.39'),
+        ('amount_net', '1206.11'),
+        ('custom_str1', 'campaign-2018'),
+        ('custom_str2', ''),
+        ('custom_str3', ''),
+        ('custom_str4', ''),
+        ('custom_str5', ''),
+        ('custom_int1', '42'),
+        ('custom_int2', ''),
+        ('custom_int3', ''),
+        ('custom_int4', ''),
+        ('custom_int5', ''),
+        ('name_first', 'Вася'),
+        ('name_last', 'Пупников'),
+        ('email_address', 'vasya@example.com'),
+        ('merchant_id', '10000100'),
+    ])
+    data['signature'] = api.itn_signature(data)
+    return data
+
+
+def cases():
+    """
+    Return the benchmarked operations, by name.
+    """
+    from django.test import RequestFactory
+    from payfast import api
+    from payfast import conf
+    from payfast.forms import NotifyForm, PayFastForm, is_payfast_ip_address, notify_url
+    from payfast.models import PayFastOrder
+
+    conf.USE_POSTBACK = False
+
+    checkout = checkout_data()
+    itn = itn_data()
+
+    PayFastForm(initial={'m_payment_id': 'checkout', 'amount': '1234.50',
+                         'item_name': checkout['item_name']})
+
+    def payfast_form():
+        PayFastForm(initial={'m_payment_id': 'checkout', 'amount': '1234.50',
+                             'item_name': checkout['item_name']})
+
+    order = PayFastOrder.objects.create(m_payment_id='bench', amount_gross='1234.50')
+    request = RequestFactory().post(notify_url(), itn, REMOTE_ADDR=PAYFAST_IP)
+
+    def notify_form():
+        form = NotifyForm(request, request.POST, instance=order)
+        assert form.is_valid(), form.errors
+
+    return OrderedDict([
+        ('checkout_signature', lambda: api.checkout_signature(checkout)),
+        ('itn_signature', lambda: api.itn_signature(itn)),
+        ('is_payfast_ip_address', lambda: is_payfast_ip_address(PAYFAST_IP)),
+        ('is_payfast_ip_address_miss', lambda: is_payfast_ip_address(OTHER_IP)),
+        ('PayFastForm', payfast_form),
+        ('NotifyForm.is_valid', notify_form),
+    ])
+
+
+def ops_per_sec(fn, duration, repeat=5):
+    """
+    Return the best throughput of `repeat` runs, taking about `duration` seconds in all.
+    """
+    # Calibrate the number of calls per run, for runs of duration / repeat seconds.
+    number = 1
+    while True:
+        started = default_timer()
+        for _ in range(number):
+            fn()
+        elapsed = default_timer() - started
+        if elapsed >= duration / 10:
+            break
+        number *= 2
+    number = max(1, int(number * duration / repeat / elapsed))
+
+    best = 0.0
+    for _ in range(repeat):
+        gc.collect()
+        started = default_timer()
+        for _ in range(number):
+            fn()
+        best = max(best, number / (default_timer() - started))
+    return best
+
+
+def allocations(fn, number=100):
+    """
+    Return the peak bytes allocated by one call of `fn`, and the bytes
+    still allocated per call after `number` calls.
+    """
+    fn()  # Warm up caches.
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        for _ in range(number):
+            fn()
+        gc.collect()
+        retained = max(0, tracemalloc.get_traced_memory()[0] - before) // (number + 1)
+    finally:
+        tracemalloc.stop()
+    return (peak, retained)
+
+
+def measure(fns, duration):
+    results = OrderedDict()
+    for (name, fn) in fns.items():
+        (peak, retained) = allocations(fn)
+        results[name] = OrderedDict([
+            ('ops_per_sec', round(ops_per_sec(fn, duration), 1)),
+            ('peak_bytes', peak),
+            ('retained_bytes', retained),
+        ])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the results against the baseline, and return the regressed operations.
+    """
+    regressions = []
+    print('{:28} {:>12} {:>9} {:>12} {:>9}'.format(
+        'operation', 'ops/sec', 'change', 'peak bytes', 'change'))
+    for (name, result) in results.items():
+        base = baseline.get(name)
+        if base is None:
+            (speed, memory) = ('', '')
+        else:
+            speed_change = result['ops_per_sec'] / base['ops_per_sec'] - 1
+            memory_change = (result['peak_bytes'] / base['peak_bytes'] - 1
+                             if base['peak_bytes'] else 0.0)
+            (speed, memory) = ('{:+.1%}'.format(speed_change), '{:+.1%}'.format(memory_change))
+            if speed_change < -threshold or memory_change > threshold:
+                regressions.append(name)
+        print('{:28} {:12.1f} {:>9} {:12d} {:>9}'.format(
+            name, result['ops_per_sec'], speed, result['peak_bytes'], memory))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown or allocation growth, as a fraction.')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='Approximate seconds to time each operation.')
+    parser.add_argument('--only', nargs='+', help='Operations to run.')
+    args = parser.parse_args()
+
+    setup_django()
+    fns = cases()
+    if args.only:
+        fns = OrderedDict((name, fns[name]) for name in args.only)
+    results = measure(fns, args.duration)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        compare(results, {}, args.threshold)
+        print('Saved baseline: {}'.format(args.baseline))
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print('Regressed beyond {:.0%}: {}'.format(args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
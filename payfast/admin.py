@@ -1,16 +1,215 @@
+from hashlib import md5
+
 from django.contrib import admin
-from payfast.models import PayFastOrder
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+from six.moves import reduce
+
+from payfast import conf
+from payfast import export
+from payfast.models import (
+    PayFastOrder, PayFastOrderArchive, PayFastITNLog, PayFastDailySummary,
+)
+
+
+def estimated_count(queryset):
+    """
+    Return the database's estimate of the number of rows in `queryset`,
+    or None if the backend can't estimate it cheaply.
+
+    PostgreSQL estimates from the query planner, so filters are accounted for.
+    MySQL only has a table-wide estimate, so it is only used for unfiltered querysets.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        (sql, params) = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            [[[plan]]] = cursor.fetchall()
+        return int(plan['Plan']['Plan Rows'])
+    elif connection.vendor == 'mysql' and not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT table_rows FROM information_schema.tables'
+                           ' WHERE table_schema = DATABASE() AND table_name = %s',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        return None if row is None else int(row[0])
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that avoids exact COUNT(*) queries on large tables.
+
+    If the database estimates at least `PAYFAST_ADMIN_COUNT_ESTIMATE_THRESHOLD`
+    rows, use the estimate: otherwise, count exactly.
+    """
+
+    @cached_property
+    def count(self):
+        estimate = estimated_count(self.object_list)
+        if estimate is not None and estimate >= conf.ADMIN_COUNT_ESTIMATE_THRESHOLD:
+            return estimate
+        return super(EstimatedCountPaginator, self).count
+
+
+class DateHierarchyCachingQuerySet(QuerySet):
+    """
+    QuerySet that caches the `dates()` and `aggregate()` results that the admin's
+    date hierarchy computes on every changelist load.
+
+    Results are cached for `PAYFAST_ADMIN_DATE_HIERARCHY_CACHE_TIMEOUT` seconds,
+    keyed by the query's SQL.
+    """
+
+    @classmethod
+    def wrap(cls, queryset):
+        return cls(model=queryset.model, query=queryset.query.clone(),
+                   using=queryset._db, hints=queryset._hints)
+
+    def _cached(self, kind, queryset, compute):
+        (sql, params) = queryset.query.sql_with_params()
+        key = 'payfast:admin:date_hierarchy:{}'.format(md5(
+            '{}|{}|{!r}|{}'.format(kind, sql, params, queryset.db).encode('utf-8')).hexdigest())
+        result = cache.get(key)
+        if result is None:
+            result = compute()
+            cache.set(key, result, conf.ADMIN_DATE_HIERARCHY_CACHE_TIMEOUT)
+        return result
+
+    def dates(self, *args, **kwargs):
+        queryset = super(DateHierarchyCachingQuerySet, self).dates(*args, **kwargs)
+        return self._cached('dates', queryset, lambda: list(queryset))
+
+    def aggregate(self, *args, **kwargs):
+        compute = super(DateHierarchyCachingQuerySet, self).aggregate
+        key_args = repr((args, sorted(kwargs.items())))
+        return self._cached('aggregate:' + key_args, self, lambda: compute(*args, **kwargs))
+
+
+class PayFastOrderChangeList(ChangeList):
+
+    def get_queryset(self, request):
+        queryset = super(PayFastOrderChangeList, self).get_queryset(request)
+        # Only load the displayed columns.
+        queryset = queryset.only(*self.model_admin.changelist_columns)
+        return DateHierarchyCachingQuerySet.wrap(queryset)
 
 
 class PayFastOrderAdmin(admin.ModelAdmin):
 
     list_display = ['m_payment_id', 'pf_payment_id', 'user', 'created_at', 'amount_gross',
                     'payment_status', 'item_name', 'trusted']
-    list_filter = ['trusted', 'payment_status']
+    list_select_related = ['user']
+    list_filter = ['trusted', 'payment_status_code']
     search_fields = ['m_payment_id', 'pf_payment_id', 'item_name',
                      'user__username', 'name_first', 'name_last', 'email_address']
     raw_id_fields = ['user']
     date_hierarchy = 'created_at'
+    # Newest first, along the (status / trusted / user, created_at) indexes.
+    ordering = ['-created_at']
+
+    paginator = EstimatedCountPaginator
+    # Skip the extra unfiltered COUNT(*).
+    show_full_result_count = False
+
+    #: Columns loaded for the changelist.
+    changelist_columns = list_display + ['user__username']
+
+    #: Search fields for the 'prefix' and 'exact' search modes.
+    id_search_fields = ['m_payment_id', 'pf_payment_id']
+    text_search_fields = ['item_name', 'user__username', 'name_first', 'name_last',
+                          'email_address']
+
+    actions = ['export_csv', 'export_jsonl']
+
+    def get_changelist(self, request, **kwargs):
+        return PayFastOrderChangeList
+
+    def export_csv(self, request, queryset):
+        return export.streaming_response(queryset, 'csv')
+    export_csv.short_description = 'Export selected orders as CSV'
+
+    def export_jsonl(self, request, queryset):
+        return export.streaming_response(queryset, 'jsonl')
+    export_jsonl.short_description = 'Export selected orders as JSON lines'
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Search according to `PAYFAST_ADMIN_SEARCH_MODE`:
+
+        * ``'contains'`` (default): Django's usual case-insensitive substring search.
+        * ``'prefix'``: Index-friendly prefix matches of the ID fields
+          (case-sensitive) and text fields (case-insensitive).
+        * ``'exact'``: Exact matches of the ID fields only.
+        """
+        mode = conf.ADMIN_SEARCH_MODE
+        if mode == 'contains' or not search_term:
+            return super(PayFastOrderAdmin, self).get_search_results(
+                request, queryset, search_term)
+
+        search_term = search_term.strip()
+        if mode == 'prefix':
+            lookups = (['{}__startswith'.format(name) for name in self.id_search_fields] +
+                       ['{}__istartswith'.format(name) for name in self.text_search_fields])
+        elif mode == 'exact':
+            lookups = ['{}__exact'.format(name) for name in self.id_search_fields]
+        else:
+            raise ValueError('Unknown PAYFAST_ADMIN_SEARCH_MODE: {!r}'.format(mode))
+
+        condition = reduce(lambda a, b: a | b, [Q(**{lookup: search_term}) for lookup in lookups])
+        # Matching orders have at most one user each: no duplicates are possible.
+        return (queryset.filter(condition), False)
+
+
+class PayFastOrderArchiveAdmin(admin.ModelAdmin):
+
+    list_display = ['m_payment_id', 'pf_payment_id', 'user', 'created_at', 'amount_gross',
+                    'payment_status', 'item_name', 'archived_at']
+    list_select_related = ['user']
+    list_filter = ['payment_status_code']
+    search_fields = ['=m_payment_id', '=pf_payment_id']
+    raw_id_fields = ['user']
+    date_hierarchy = 'created_at'
+    ordering = ['-created_at']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+
+class PayFastITNLogAdmin(admin.ModelAdmin):
+
+    list_display = ['m_payment_id', 'received_at', 'verdict', 'source_ip', 'errors']
+    list_filter = ['verdict']
+    search_fields = ['m_payment_id']
+    raw_id_fields = ['order']
+    date_hierarchy = 'received_at'
+    exclude = ['body']
+    readonly_fields = ['order', 'm_payment_id', 'received_at', 'source_ip', 'verdict',
+                       'errors', 'headers', 'timings', 'decoded_body']
+
+    def decoded_body(self, obj):
+        return obj.raw_body().decode('utf-8', 'replace')
+
+
+class PayFastDailySummaryAdmin(admin.ModelAdmin):
+
+    list_display = ['day', 'payment_status', 'merchant_id', 'count', 'amount_gross',
+                    'amount_fee', 'amount_net']
+    list_filter = ['payment_status', 'merchant_id']
+    date_hierarchy = 'day'
+    ordering = ['-day', 'payment_status']
+    # Maintained by payfast.summaries
+    readonly_fields = list_display
 
 
 admin.site.register(PayFastOrder, PayFastOrderAdmin)
+admin.site.register(PayFastOrderArchive, PayFastOrderArchiveAdmin)
+admin.site.register(PayFastITNLog, PayFastITNLogAdmin)
+admin.site.register(PayFastDailySummary, PayFastDailySummaryAdmin)
@@ -0,0 +1,185 @@
+"""
+In-process admission control for the notify view.
+
+When PayFast retries ITNs in bursts, each one costs a database lookup,
+a postback, and the signal receivers. Admission control sheds the excess
+early, with a quick retryable response (503 with ``Retry-After``), instead of
+letting requests queue up behind slow postbacks.
+
+Settings:
+
+* `PAYFAST_ADMISSION_RATE`: Sustained ITNs per second admitted by a token bucket
+  (default: None, unlimited).
+* `PAYFAST_ADMISSION_BURST`: Token bucket capacity (default: the rate, and at least 1).
+  A capacity below 1 would never admit a request, and is refused.
+* `PAYFAST_ADMISSION_MAX_CONCURRENCY`: ITNs handled at the same time, per process
+  (default: None, unlimited).
+* `PAYFAST_ADMISSION_RETRY_AFTER`: ``Retry-After`` value for shed requests, in seconds.
+
+The counts of admitted and shed requests are available from `get_controller().stats()`,
+and the shed requests are counted in `payfast.metrics`.
+"""
+from __future__ import unicode_literals
+
+import threading
+from functools import wraps
+from timeit import default_timer
+from typing import Callable, Dict, Optional  # noqa: F401
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+
+from payfast import conf
+from payfast import metrics
+
+
+#: Reasons for shedding a request.
+SHED_RATE = 'rate'
+SHED_CONCURRENCY = 'concurrency'
+
+
+class TokenBucket(object):
+    """
+    Admit on average `rate` acquisitions per second, with bursts of up to `burst`.
+    """
+
+    def __init__(self, rate, burst, clock=default_timer):  # type: (float, float, Callable) -> None
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):  # type: () -> bool
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class ConcurrencyLimiter(object):
+    """
+    Admit at most `limit` holders at the same time, without waiting.
+    """
+
+    def __init__(self, limit):  # type: (int) -> None
+        self.limit = limit
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):  # type: () -> int
+        return self._in_flight
+
+    def try_acquire(self):  # type: () -> bool
+        with self._lock:
+            if self._in_flight >= self.limit:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):  # type: () -> None
+        with self._lock:
+            self._in_flight -= 1
+
+
+class AdmissionController(object):
+    """
+    Combine an optional `TokenBucket` and `ConcurrencyLimiter`, and count the outcomes.
+    """
+
+    def __init__(
+            self,
+            bucket=None,  # type: Optional[TokenBucket]
+            limiter=None,  # type: Optional[ConcurrencyLimiter]
+    ):  # type: (...) -> None
+        self.bucket = bucket
+        self.limiter = limiter
+        self._stats_lock = threading.Lock()
+        self._stats = {'admitted': 0, 'shed_' + SHED_RATE: 0, 'shed_' + SHED_CONCURRENCY: 0}
+
+    def try_admit(self):  # type: () -> Optional[str]
+        """
+        Try to admit a request: return None if admitted, or the reason it was shed.
+
+        Admitted requests must be released with `release()`.
+        """
+        if self.limiter is not None and not self.limiter.try_acquire():
+            return self._count('shed_' + SHED_CONCURRENCY, SHED_CONCURRENCY)
+        if self.bucket is not None and not self.bucket.try_acquire():
+            if self.limiter is not None:
+                self.limiter.release()
+            return self._count('shed_' + SHED_RATE, SHED_RATE)
+        return self._count('admitted', None)
+
+    def release(self):  # type: () -> None
+        if self.limiter is not None:
+            self.limiter.release()
+
+    def stats(self):  # type: () -> Dict[str, int]
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['in_flight'] = 0 if self.limiter is None else self.limiter.in_flight
+        return stats
+
+    def _count(self, name, result):  # type: (str, Optional[str]) -> Optional[str]
+        with self._stats_lock:
+            self._stats[name] += 1
+        return result
+
+
+_controller = None  # type: Optional[AdmissionController]
+_controller_lock = threading.Lock()
+
+
+def get_controller():  # type: () -> AdmissionController
+    """
+    Return the process-wide admission controller, configured from settings.
+    """
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController(
+                    bucket=(None if conf.ADMISSION_RATE is None else
+                            TokenBucket(conf.ADMISSION_RATE, _burst())),
+                    limiter=(None if conf.ADMISSION_MAX_CONCURRENCY is None else
+                             ConcurrencyLimiter(conf.ADMISSION_MAX_CONCURRENCY)),
+                )
+    return _controller
+
+
+def _burst():  # type: () -> float
+    if conf.ADMISSION_BURST is None:
+        return max(1, conf.ADMISSION_RATE)
+    if conf.ADMISSION_BURST < 1:
+        raise ImproperlyConfigured(
+            'PAYFAST_ADMISSION_BURST must be at least 1, not {!r}'.format(conf.ADMISSION_BURST))
+    return conf.ADMISSION_BURST
+
+
+def admission_controlled(view):
+    """
+    Decorate a view to shed requests refused by the admission controller.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        controller = get_controller()
+        shed_reason = controller.try_admit()
+        if shed_reason is not None:
+            metrics.ITN_SHED.labels(reason=shed_reason).inc()
+            metrics.maybe_flush()
+            response = HttpResponse('Too busy ({}), please retry.'.format(shed_reason),
+                                    status=503, content_type='text/plain')
+            response['Retry-After'] = str(conf.ADMISSION_RETRY_AFTER)
+            return response
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            controller.release()
+    return wrapper
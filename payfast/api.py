@@ -3,15 +3,19 @@ This module can be used without django
 """
 from __future__ import unicode_literals
 
+import os
+import socket
 import sys
-from typing import Mapping, Tuple, Sequence  # noqa: F401
+import threading
+from typing import Dict, List, Mapping, Optional, Tuple, Sequence  # noqa: F401
 
 from hashlib import md5
 
 # Python 2 compatibility:
 from six import text_type as str
+from six.moves import http_client
 from six.moves.urllib.error import HTTPError
-from six.moves.urllib.parse import urlencode
+from six.moves.urllib.parse import urlencode, urlsplit
 from six.moves.urllib.request import urlopen
 
 from django.conf import settings
@@ -155,10 +159,17 @@ def _drop_non_signature_fields(
     }
 
 
-def _sign_fields(signable_fields):  # type: (SignableFields) -> str
+def _sign_fields(signable_fields, passphrase=None):
+    # type: (SignableFields, Optional[str]) -> str
     """
     Common signing code.
+
+    If a `passphrase` is given (as set on the PayFast account), it is signed last.
     """
+    if passphrase:
+        signable_fields = list(signable_fields) + [
+            ('passphrase', passphrase.strip(CHECKOUT_SIGNATURE_IGNORED_WHITESPACE))]
+
     for (k, v) in signable_fields:
         assert isinstance(k, str), repr(k)
         assert isinstance(v, str), repr(v)
@@ -192,7 +203,8 @@ CHECKOUT_SIGNATURE_IGNORED_WHITESPACE = ''.join([
 ])
 
 
-def checkout_signature(checkout_data):  # type: (Mapping[str, str]) -> str
+def checkout_signature(checkout_data, passphrase=None):
+    # type: (Mapping[str, str], Optional[str]) -> str
     """
     Calculate the signature of a checkout process submission.
     """
@@ -205,17 +217,17 @@ def checkout_signature(checkout_data):  # type: (Mapping[str, str]) -> str
     }
 
     signable_fields = _prepare_signable_fields(checkout_signature_field_order, stripped_fields)
-    return _sign_fields(signable_fields)
+    return _sign_fields(signable_fields, passphrase)
 
 
-def itn_signature(itn_data):  # type: (Mapping[str, str]) -> str
+def itn_signature(itn_data, passphrase=None):  # type: (Mapping[str, str], Optional[str]) -> str
     """
     Calculate the signature of an ITN submission.
     """
     # ITN signatures include fields with empty values.
     included_fields = _drop_non_signature_fields(itn_data, include_empty=True)
     signable_fields = _prepare_signable_fields(itn_signature_field_order, included_fields)
-    return _sign_fields(signable_fields)
+    return _sign_fields(signable_fields, passphrase)
 
 
 # TODO: Rework this and data_is_valid.
@@ -227,22 +239,177 @@ def _values_to_encode(data):
     ]
 
 
+class ConnectionPool(object):
+    """
+    Keep-alive connections to a postback server, reused across postbacks.
+
+    At most `size` idle connections are kept: busier moments open more,
+    and close them after use.
+
+    A process forked from the one that opened the connections (such as a
+    pre-fork server's worker) starts with an empty pool, instead of sharing
+    their sockets with its parent and siblings.
+    """
+
+    def __init__(self, server, size):  # type: (str, int) -> None
+        self.server = server
+        self.size = size
+        parts = urlsplit(server)
+        self._connection_class = (http_client.HTTPSConnection if parts.scheme == 'https' else
+                                  http_client.HTTPConnection)
+        self._host = parts.netloc
+        self._reset()
+
+    def _reset(self):  # type: () -> None
+        self._pid = os.getpid()
+        self._idle = []  # type: List[http_client.HTTPConnection]
+        self._in_use = 0
+        self._lock = threading.Lock()
+
+    def _check_fork(self):  # type: () -> None
+        # Forget (without closing) the connections and lock inherited from the parent.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _acquire(self):  # type: () -> Tuple[http_client.HTTPConnection, bool]
+        """
+        Return an idle connection (most recently used first), or a new one,
+        and whether it was idle.
+        """
+        self._check_fork()
+        with self._lock:
+            self._in_use += 1
+            if self._idle:
+                return (self._idle.pop(), True)
+        return (self._connection_class(self._host), False)
+
+    def _release(self, connection, keep):  # type: (http_client.HTTPConnection, bool) -> None
+        with self._lock:
+            self._in_use -= 1
+            if keep and len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def warm(self, count):  # type: (int) -> int
+        """
+        Open up to `count` idle connections ahead of use, and return how many were opened.
+        """
+        self._check_fork()
+        opened = 0
+        while opened < count:
+            with self._lock:
+                if len(self._idle) >= self.size:
+                    break
+            connection = self._connection_class(self._host)
+            connection.connect()
+            with self._lock:
+                self._idle.append(connection)
+            opened += 1
+        return opened
+
+    def stats(self):  # type: () -> Dict[str, int]
+        self._check_fork()
+        with self._lock:
+            return {'size': self.size, 'idle': len(self._idle), 'in_use': self._in_use}
+
+    def close(self):  # type: () -> None
+        with self._lock:
+            (idle, self._idle) = (self._idle, [])
+        for connection in idle:
+            connection.close()
+
+    def post(self, path, body):  # type: (str, bytes) -> str
+        """
+        POST a form-encoded `body` to `path`, and return the response body.
+        """
+        (connection, was_idle) = self._acquire()
+        try:
+            try:
+                response = self._request(connection, path, body)
+            except (http_client.HTTPException, socket.error):
+                if not was_idle:
+                    raise
+                # The server closed the idle connection: retry once, on a new one.
+                connection.close()
+                connection = self._connection_class(self._host)
+                response = self._request(connection, path, body)
+            result = response.read()
+        except Exception:
+            self._release(connection, keep=False)
+            raise
+        self._release(connection, keep=not response.will_close)
+        if response.status >= 400:
+            raise HTTPError(self.server + path, response.status, response.reason,
+                            response.msg, None)
+        return result.decode('utf-8')  # XXX: Assumed encoding
+
+    @staticmethod
+    def _request(connection, path, body):
+        # type: (http_client.HTTPConnection, str, bytes) -> http_client.HTTPResponse
+        connection.request('POST', path, body,
+                           {'Content-Type': 'application/x-www-form-urlencoded'})
+        return connection.getresponse()
+
+
+_pools = {}  # type: Dict[str, ConnectionPool]
+_pools_lock = threading.Lock()
+
+
+def get_pool(server, size):  # type: (str, int) -> ConnectionPool
+    """
+    Return the connection pool of postbacks to `server`, creating it with `size`
+    if necessary: once it exists, `data_is_valid` uses it.
+    """
+    key = server.rstrip('/')
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(key, size)
+    return pool
+
+
+def get_pools():  # type: () -> List[ConnectionPool]
+    return list(_pools.values())
+
+
+def reset_pools():  # type: () -> None
+    """
+    Close and forget the connection pools (mainly for tests).
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
 def data_is_valid(post_data, postback_server=POSTBACK_SERVER):
     """
     Validates data via the postback. Returns True if data is valid,
     False if data is invalid and None if the request failed.
+
+    The postback reuses a connection from the server's pool, if it has one
+    (see `get_pool`).
     """
     post_str = urlencode(_values_to_encode(post_data))  # type: str
-    # FIXME: No Content-Type header.
     post_bytes = post_str.encode(settings.DEFAULT_CHARSET)  # type: bytes
 
-    postback_url = postback_server.rstrip('/') + POSTBACK_URL
-    try:
-        response = urlopen(postback_url, data=post_bytes)
-        result = response.read().decode('utf-8')  # XXX: Assumed encoding
-    except HTTPError:
-        # XXX: Just re-raise for now.
-        raise
+    pool = _pools.get(postback_server.rstrip('/'))
+    if pool is not None:
+        # XXX: HTTPError is re-raised, as below.
+        result = pool.post(POSTBACK_URL, post_bytes)
+    else:
+        # FIXME: No Content-Type header.
+        postback_url = postback_server.rstrip('/') + POSTBACK_URL
+        try:
+            response = urlopen(postback_url, data=post_bytes)
+            result = response.read().decode('utf-8')  # XXX: Assumed encoding
+        except HTTPError:
+            # XXX: Just re-raise for now.
+            raise
 
     if result == 'VALID':
         return True
@@ -0,0 +1,19 @@
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+
+
+class PayFastConfig(AppConfig):
+    name = 'payfast'
+
+    def ready(self):
+        # payfast.warmup imports the models: only import it once they are ready.
+        from django.core.signals import request_started
+
+        from payfast import conf
+        from payfast import warmup
+
+        # Warm up lazily, on each process's first request (see payfast.warmup).
+        if conf.WARMUP:
+            request_started.connect(warmup.start_on_request,
+                                    dispatch_uid='payfast.warmup.start_on_request')
@@ -0,0 +1,184 @@
+"""
+Hot/cold archival of orders into `PayFastOrderArchive`.
+
+The notify view, admin and checkout form only use the live `PayFastOrder` table.
+`archive_orders` keeps it small by moving settled orders into the archive table,
+in batches: each batch is copied and deleted in one transaction.
+`history` looks orders up in both tables, for reporting and reconciliation.
+
+An ITN for an archived order is not found (404), so only archive orders that
+PayFast won't notify again.
+
+The archive keeps ``m_payment_id`` and ``pf_payment_id`` unique, like the live
+table. A live order that reuses an archived order's id (or primary key) is left
+in the live table, and logged as a conflict.
+"""
+from __future__ import unicode_literals
+
+import logging
+from datetime import datetime, timedelta  # noqa: F401
+from itertools import chain
+from typing import Callable, Dict, Iterable, Iterator, Optional, Set, Union  # noqa: F401
+
+from django.db import transaction
+from django.db.models import QuerySet  # noqa: F401
+from django.utils import timezone
+
+from payfast.batches import BatchProgress, DEFAULT_SLEEP, run_batches  # noqa: F401
+from payfast.models import (  # noqa: F401
+    AbstractPayFastOrder,
+    DEFAULT_BATCH_SIZE,
+    PAYMENT_STATUS_CANCELLED,
+    PAYMENT_STATUS_COMPLETE,
+    PAYMENT_STATUS_FAILED,
+    PayFastOrder,
+    PayFastOrderArchive,
+    payment_status_code,
+)
+
+
+DEFAULT_OLDER_THAN = timedelta(days=90)
+
+#: Payment statuses after which PayFast sends no further ITNs.
+SETTLED_STATUSES = [PAYMENT_STATUS_COMPLETE, PAYMENT_STATUS_FAILED, PAYMENT_STATUS_CANCELLED]
+
+_COPIED_FIELDS = [field.attname for field in PayFastOrder._meta.concrete_fields]
+
+#: The fields that are unique in both tables.
+_UNIQUE_FIELDS = ['id', 'm_payment_id', 'pf_payment_id']
+
+logger = logging.getLogger(__name__)
+
+
+def settled_orders(older_than=DEFAULT_OLDER_THAN):
+    # type: (Union[timedelta, datetime]) -> QuerySet
+    """
+    Return the trusted, settled orders last updated before `older_than`
+    (a datetime, or a timedelta before now).
+    """
+    if isinstance(older_than, timedelta):
+        older_than = timezone.now() - older_than
+    return PayFastOrder.objects.trusted().filter(
+        payment_status_code__in=[payment_status_code(status) for status in SETTLED_STATUSES],
+        updated_at__lt=older_than)
+
+
+def move(queryset):  # type: (QuerySet) -> int
+    """
+    Copy the orders in `queryset` into the archive and delete them, in one
+    transaction, and return the number of orders moved.
+
+    Archived orders keep their primary key and timestamps. ITN log entries
+    of the moved orders keep their ``m_payment_id``, but lose their order link.
+    Orders that conflict with archived orders (see `conflicts`) are skipped.
+    """
+    # A locking queryset is for writing: its db is the primary, not a read
+    # replica (see payfast.routers), unless `queryset` names a database.
+    queryset = queryset.select_for_update()
+    db = queryset.db
+    with transaction.atomic(using=db):
+        rows = list(queryset.values(*_COPIED_FIELDS))
+        conflicting = conflicts(rows, using=db)
+        if conflicting:
+            logger.warning('Not archiving PayFast orders %s: their ids are already archived',
+                           ', '.join(str(pk) for pk in sorted(conflicting)))
+            rows = [row for row in rows if row['id'] not in conflicting]
+        if not rows:
+            return 0
+        PayFastOrderArchive.objects.using(db).bulk_create(
+            [PayFastOrderArchive(**row) for row in rows])
+        PayFastOrder.objects.using(db).filter(pk__in=[row['id'] for row in rows]).delete()
+    return len(rows)
+
+
+def conflicts(rows, using=None):  # type: (Iterable[Dict[str, object]], Optional[str]) -> Set[int]
+    """
+    Return the primary keys of the order `rows` whose primary key,
+    ``m_payment_id`` or ``pf_payment_id`` is already in the archive.
+    """
+    rows = list(rows)
+    conflicting = set()  # type: Set[int]
+    for field in _UNIQUE_FIELDS:
+        values = {row[field] for row in rows if row[field] is not None}
+        if not values:
+            continue
+        archived = set(PayFastOrderArchive.objects.using(using)
+                       .filter(**{field + '__in': values}).values_list(field, flat=True))
+        conflicting.update(row['id'] for row in rows if row[field] in archived)
+    return conflicting
+
+
+def archive_orders(
+        older_than=DEFAULT_OLDER_THAN,  # type: Union[timedelta, datetime]
+        batch_size=DEFAULT_BATCH_SIZE,  # type: int
+        sleep=DEFAULT_SLEEP,  # type: float
+        dry_run=False,  # type: bool
+        progress=None,  # type: Optional[Callable[[BatchProgress], None]]
+):  # type: (...) -> BatchProgress
+    """
+    Move settled orders (see `settled_orders`) into the archive, in batches.
+
+    See `payfast.batches.run_batches` for the other arguments.
+    """
+    return run_batches(settled_orders(older_than), move, batch_size=batch_size, sleep=sleep,
+                       dry_run=dry_run, progress=progress)
+
+
+class OrderHistory(object):
+    """
+    Read-only lookups of orders across the live and archive tables.
+
+    Results are `PayFastOrder` or `PayFastOrderArchive` instances: both have
+    the fields of `AbstractPayFastOrder`.
+    """
+
+    models = [PayFastOrder, PayFastOrderArchive]
+
+    def get(self, **lookup):  # type: (...) -> AbstractPayFastOrder
+        """
+        Return the order matching `lookup`, preferring the live table.
+
+        :raise PayFastOrder.DoesNotExist: If neither table has a match.
+        """
+        for model in self.models:
+            try:
+                return model.objects.get(**lookup)
+            except model.DoesNotExist:
+                pass
+        raise PayFastOrder.DoesNotExist('No live or archived PayFastOrder matches {!r}'.format(
+            lookup))
+
+    def filter(self, *args, **kwargs):  # type: (...) -> Iterator[AbstractPayFastOrder]
+        """
+        Iterate over the live, then the archived orders matching the given filters.
+        """
+        return chain.from_iterable(model.objects.filter(*args, **kwargs).iterator()
+                                   for model in self.models)
+
+    def count(self, *args, **kwargs):  # type: (...) -> int
+        return sum(model.objects.filter(*args, **kwargs).count() for model in self.models)
+
+    def in_bulk(self, values, field_name, only=None):
+        # type: (Iterable[str], str, Optional[Iterable[str]]) -> Dict[str, AbstractPayFastOrder]
+        """
+        Map each of `values` to the order whose `field_name` it is, like `QuerySet.in_bulk`.
+        If given, only load the `only` fields.
+
+        The archive is only queried for values missing from the live table.
+        """
+        missing = set(values)
+        found = {}  # type: Dict[str, AbstractPayFastOrder]
+        for model in self.models:
+            if not missing:
+                break
+            orders = model.objects.filter(**{field_name + '__in': missing})
+            if only is not None:
+                orders = orders.only(*only)
+            for order in orders:
+                found[getattr(order, field_name)] = order
+            missing.difference_update(found)
+        return found
+
+
+#: Lookups across the live and archive tables: see `OrderHistory`.
+history = OrderHistory()
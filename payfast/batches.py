@@ -0,0 +1,52 @@
+"""
+Batched maintenance of large order tables.
+
+`run_batches` applies an action to a queryset's rows a batch of consecutive
+primary keys at a time, pausing between batches so that each statement is short
+and replicas can keep up. It backs `payfast.sweep` and `payfast.archive`.
+"""
+from __future__ import unicode_literals
+
+import time
+from collections import namedtuple
+from typing import Callable, Optional  # noqa: F401
+
+from django.db.models import QuerySet  # noqa: F401
+
+from payfast.models import DEFAULT_BATCH_SIZE
+
+
+DEFAULT_SLEEP = 0.5  # seconds
+
+#: Progress of a batched run: the number of batches and rows processed so far,
+#: and the primary key range of the latest batch.
+BatchProgress = namedtuple('BatchProgress', ['batches', 'rows', 'first_pk', 'last_pk'])
+
+
+def run_batches(
+        queryset,  # type: QuerySet
+        action,  # type: Callable[[QuerySet], int]
+        batch_size=DEFAULT_BATCH_SIZE,  # type: int
+        sleep=DEFAULT_SLEEP,  # type: float
+        dry_run=False,  # type: bool
+        progress=None,  # type: Optional[Callable[[BatchProgress], None]]
+):  # type: (...) -> BatchProgress
+    """
+    Call `action` for each batch of `queryset`, and return the totals.
+
+    `action` receives `queryset` bounded by the batch's primary key range
+    (so rows that stopped matching since the batch was selected are left alone),
+    and returns the number of rows it processed. If `dry_run` is true, batches
+    are only counted. `progress` is called after each batch.
+    """
+    report = BatchProgress(0, 0, None, None)
+    for batch in queryset.pk_batches(batch_size):
+        if report.batches and sleep and not dry_run:
+            time.sleep(sleep)
+        (first_pk, last_pk) = (batch[0], batch[-1])
+        done = (len(batch) if dry_run else
+                action(queryset.filter(pk__gte=first_pk, pk__lte=last_pk)))
+        report = BatchProgress(report.batches + 1, report.rows + done, first_pk, last_pk)
+        if progress is not None:
+            progress(report)
+    return report
@@ -0,0 +1,17 @@
+"""
+Resource budgets of the payfast entry points.
+
+Each entry point declares its budgets next to its code (`payfast.views.ITN_BUDGETS`,
+`payfast.forms.CHECKOUT_BUDGETS`), and the tests hold it to them with
+`payfast.testing.assert_budget`, so that extra queries or postbacks don't creep in.
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+
+#: The most database queries, outbound HTTP calls (postbacks) and wall time in
+#: seconds that one call of an entry point may take. None leaves a resource unchecked.
+#:
+#: Queries don't include savepoints, so that budgets hold inside test transactions.
+Budget = namedtuple('Budget', ['queries', 'http_calls', 'seconds'])
@@ -23,15 +23,31 @@ else:
     MERCHANT_ID = getattr(settings, 'PAYFAST_MERCHANT_ID')
     MERCHANT_KEY = getattr(settings, 'PAYFAST_MERCHANT_KEY')
 
+# Further merchant accounts, by merchant id (see payfast.merchants)
+MERCHANTS = getattr(settings, 'PAYFAST_MERCHANTS', {})
+
 LIVE_SERVER = 'https://www.payfast.co.za'
 SANDBOX_SERVER = 'https://sandbox.payfast.co.za'
-SERVER = SANDBOX_SERVER if TEST_MODE else LIVE_SERVER
+# Override to use a stand-in server (such as the one in benchmarks/loadtest.py).
+SERVER = getattr(settings, 'PAYFAST_SERVER', SANDBOX_SERVER if TEST_MODE else LIVE_SERVER)
 
 PROCESS_URL = SERVER + '/eng/process'
 
 REQUIRE_AMOUNT_MATCH = getattr(settings, 'PAYFAST_REQUIRE_AMOUNT_MATCH', True)
 USE_POSTBACK = getattr(settings, 'PAYFAST_USE_POSTBACK', True)
 
+# 'serial' validates the postback after looking up the order;
+# 'concurrent' overlaps them (see payfast.forms.start_postback).
+POSTBACK_MODE = getattr(settings, 'PAYFAST_POSTBACK_MODE', 'serial')
+POSTBACK_WORKERS = getattr(settings, 'PAYFAST_POSTBACK_WORKERS', 10)
+# Keep-alive connections kept per postback server (see payfast.api.ConnectionPool);
+# 0 opens a new connection for each postback.
+POSTBACK_POOL_SIZE = getattr(settings, 'PAYFAST_POSTBACK_POOL_SIZE', 0)
+# Consecutive postback errors that open the circuit breaker (0: no breaker),
+# and the seconds before retrying (see payfast.merchants.CircuitBreaker).
+POSTBACK_BREAKER_THRESHOLD = getattr(settings, 'PAYFAST_POSTBACK_BREAKER_THRESHOLD', 0)
+POSTBACK_BREAKER_RESET = getattr(settings, 'PAYFAST_POSTBACK_BREAKER_RESET', 30)
+
 # request.META key with client ip address
 IP_HEADER = getattr(settings, 'PAYFAST_IP_HEADER', 'REMOTE_ADDR')
 
@@ -41,3 +57,77 @@ DEFAULT_PAYFAST_IP_ADDRESSES = [
     '197.97.145.144/28',
     '41.74.179.192/27',
 ]
+
+# ITN log (see payfast.itn_log):
+#
+# 'sync' writes each entry as the ITN is handled,
+# 'buffered' collects entries in-process and writes them in batches,
+# 'off' disables the log.
+ITN_LOG_MODE = getattr(settings, 'PAYFAST_ITN_LOG_MODE', 'sync')
+ITN_LOG_BATCH_SIZE = getattr(settings, 'PAYFAST_ITN_LOG_BATCH_SIZE', 100)
+ITN_LOG_FLUSH_INTERVAL = getattr(settings, 'PAYFAST_ITN_LOG_FLUSH_INTERVAL', 5.0)  # seconds
+
+# request.META keys to keep in the ITN log
+ITN_LOG_HEADERS = getattr(settings, 'PAYFAST_ITN_LOG_HEADERS', [
+    'CONTENT_TYPE',
+    'CONTENT_LENGTH',
+    'HTTP_HOST',
+    'HTTP_USER_AGENT',
+    'HTTP_REFERER',
+    'HTTP_X_FORWARDED_FOR',
+    'HTTP_X_PAYFAST_REPLAY',  # Set by the payfast_replay_itn command
+])
+
+# notify signal dispatch (see payfast.dispatch): 'sync', 'on_commit' or 'executor'
+NOTIFY_DISPATCH = getattr(settings, 'PAYFAST_NOTIFY_DISPATCH', 'sync')
+NOTIFY_WORKERS = getattr(settings, 'PAYFAST_NOTIFY_WORKERS', 4)
+NOTIFY_QUEUE_SIZE = getattr(settings, 'PAYFAST_NOTIFY_QUEUE_SIZE', 100)
+NOTIFY_QUEUE_TIMEOUT = getattr(settings, 'PAYFAST_NOTIFY_QUEUE_TIMEOUT', 1.0)  # seconds
+
+# Admission control for the notify view (see payfast.admission)
+ADMISSION_RATE = getattr(settings, 'PAYFAST_ADMISSION_RATE', None)  # ITNs per second
+ADMISSION_BURST = getattr(settings, 'PAYFAST_ADMISSION_BURST', None)
+ADMISSION_MAX_CONCURRENCY = getattr(settings, 'PAYFAST_ADMISSION_MAX_CONCURRENCY', None)
+ADMISSION_RETRY_AFTER = getattr(settings, 'PAYFAST_ADMISSION_RETRY_AFTER', 1)  # seconds
+
+# Maintain PayFastDailySummary as ITNs are processed (see payfast.summaries)
+DAILY_SUMMARIES = getattr(settings, 'PAYFAST_DAILY_SUMMARIES', True)
+
+# Read replicas (see payfast.routers)
+DATABASE_PRIMARY = getattr(settings, 'PAYFAST_DATABASE_PRIMARY', 'default')
+DATABASE_REPLICAS = getattr(settings, 'PAYFAST_DATABASE_REPLICAS', [])
+DATABASE_STICKY_SECONDS = getattr(settings, 'PAYFAST_DATABASE_STICKY_SECONDS', 1.0)
+
+# Sampling profiler (see payfast.profiling)
+PROFILE_RATE = getattr(settings, 'PAYFAST_PROFILE_RATE', 0.0)  # fraction of requests
+PROFILE_MODE = getattr(settings, 'PAYFAST_PROFILE_MODE', 'cprofile')  # or 'stack'
+PROFILE_URL_NAMES = getattr(settings, 'PAYFAST_PROFILE_URL_NAMES', ['payfast_notify'])
+PROFILE_DIR = getattr(settings, 'PAYFAST_PROFILE_DIR', None)
+PROFILE_DUMP_INTERVAL = getattr(settings, 'PAYFAST_PROFILE_DUMP_INTERVAL', 60)  # seconds
+PROFILE_STACK_INTERVAL = getattr(settings, 'PAYFAST_PROFILE_STACK_INTERVAL', 0.005)  # seconds
+
+# PayFastOrderAdmin (see payfast.admin)
+ADMIN_SEARCH_MODE = getattr(settings, 'PAYFAST_ADMIN_SEARCH_MODE', 'contains')
+ADMIN_COUNT_ESTIMATE_THRESHOLD = getattr(settings, 'PAYFAST_ADMIN_COUNT_ESTIMATE_THRESHOLD', 100000)
+ADMIN_DATE_HIERARCHY_CACHE_TIMEOUT = getattr(settings, 'PAYFAST_ADMIN_DATE_HIERARCHY_CACHE_TIMEOUT',
+                                             300)  # seconds
+
+# ITN metrics (see payfast.metrics)
+METRICS_VIEW = getattr(settings, 'PAYFAST_METRICS_VIEW', False)
+METRICS_DIR = getattr(settings, 'PAYFAST_METRICS_DIR', None)  # shared by worker processes
+METRICS_FLUSH_INTERVAL = getattr(settings, 'PAYFAST_METRICS_FLUSH_INTERVAL', 5)  # seconds
+
+# Tracing of the checkout and ITN flows (see payfast.tracing)
+TRACE_RATE = getattr(settings, 'PAYFAST_TRACE_RATE', 0.0)  # fraction of orders
+TRACE_EXPORTERS = getattr(settings, 'PAYFAST_TRACE_EXPORTERS',
+                          ['payfast.tracing.LoggingExporter'])
+
+# Warm-up on the first request of each process (see payfast.warmup)
+WARMUP = getattr(settings, 'PAYFAST_WARMUP', False)
+WARMUP_CONNECTIONS = getattr(settings, 'PAYFAST_WARMUP_CONNECTIONS', 2)  # per postback server
+
+# Health and readiness views (see payfast.health and payfast.warmup)
+HEALTH_VIEW = getattr(settings, 'PAYFAST_HEALTH_VIEW', False)
+HEALTH_DB_INTERVAL = getattr(settings, 'PAYFAST_HEALTH_DB_INTERVAL', 10)  # seconds; 0: no probe
+HEALTH_WINDOW = getattr(settings, 'PAYFAST_HEALTH_WINDOW', 60)  # seconds
+HEALTH_MAX_ERROR_RATE = getattr(settings, 'PAYFAST_HEALTH_MAX_ERROR_RATE', 0.5)
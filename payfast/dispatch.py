@@ -0,0 +1,215 @@
+"""
+Dispatch of the `payfast.signals.notify` signal.
+
+Setting: `PAYFAST_NOTIFY_DISPATCH`
+
+* ``'sync'`` (default): Receivers run in the notify request, before PayFast
+  gets its response, and an exception fails the request (the historical behaviour).
+* ``'on_commit'``: Receivers run in the notify request, but only once the
+  current transaction commits (see `transaction.on_commit`).
+* ``'executor'``: Once the current transaction commits, receivers are handed
+  off to a bounded pool of `PAYFAST_NOTIFY_WORKERS` threads, so that the ITN
+  response time does not depend on them.
+
+In the deferred modes, each receiver runs in isolation (like `Signal.send_robust`):
+an exception is logged and reported, but does not stop the other receivers.
+
+The executor's queue holds at most `PAYFAST_NOTIFY_QUEUE_SIZE` pending
+dispatches. When it is full, submitting waits up to
+`PAYFAST_NOTIFY_QUEUE_TIMEOUT` seconds for room, and then runs the
+receivers in the calling thread instead (back-pressure on the caller,
+rather than unbounded growth or dropped notifications).
+"""
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import namedtuple
+from timeit import default_timer
+from typing import Any, Callable, Dict, List, Optional  # noqa: F401
+
+import django
+from django.db import close_old_connections, transaction
+from six.moves import queue
+
+from payfast import conf
+from payfast import signals
+from payfast.models import PayFastOrder  # noqa: F401
+
+
+logger = logging.getLogger(__name__)
+
+
+#: The outcome of one receiver: its return value or raised exception,
+#: and how long it took, in seconds.
+ReceiverResult = namedtuple('ReceiverResult', ['receiver', 'response', 'error', 'elapsed'])
+
+
+class DispatchReport(namedtuple('DispatchReport', ['order', 'results'])):
+    """
+    The `ReceiverResult` of each receiver that ran for `order`.
+    """
+
+    @property
+    def failed(self):  # type: () -> List[ReceiverResult]
+        return [result for result in self.results if result.error is not None]
+
+
+class DispatchFuture(object):
+    """
+    Handle for a dispatch that may not have run yet.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._report = None  # type: Optional[DispatchReport]
+
+    def done(self):  # type: () -> bool
+        return self._done.is_set()
+
+    def result(self, timeout=None):  # type: (Optional[float]) -> Optional[DispatchReport]
+        """
+        Wait for the dispatch to run, and return its report (or None, on timeout).
+        """
+        self._done.wait(timeout)
+        return self._report
+
+    def _run(self, sender, order, robust=True):  # type: (Any, PayFastOrder, bool) -> None
+        try:
+            self._report = run_receivers(sender, order, robust=robust)
+        finally:
+            self._done.set()
+
+
+def run_receivers(
+        sender,  # type: Any
+        order,  # type: PayFastOrder
+        robust=True,  # type: bool
+):  # type: (...) -> DispatchReport
+    """
+    Run and time each `notify` receiver for `order`.
+
+    If `robust` is false, exceptions propagate (like `Signal.send`).
+    """
+    results = []
+    # Like Signal.send_robust(), but timing each receiver.
+    # (_live_receivers() is private, but stable across the supported Django versions.)
+    for receiver in signals.notify._live_receivers(sender):
+        started = default_timer()
+        try:
+            response = receiver(signal=signals.notify, sender=sender, order=order)
+        except Exception as e:
+            if not robust:
+                raise
+            logger.exception('PayFast notify receiver %r failed for %s', receiver, order)
+            results.append(ReceiverResult(receiver, None, e, default_timer() - started))
+        else:
+            results.append(ReceiverResult(receiver, response, None, default_timer() - started))
+    return DispatchReport(order, results)
+
+
+class BoundedExecutor(object):
+    """
+    A fixed pool of daemon worker threads, consuming a bounded queue.
+    """
+
+    def __init__(self, workers, queue_size, queue_timeout):  # type: (int, int, float) -> None
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self._queue = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+        self._threads = []  # type: List[threading.Thread]
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'submitted': 0, 'completed': 0, 'ran_inline': 0}
+
+    def submit(self, fn):  # type: (Callable[[], None]) -> None
+        """
+        Queue `fn` to run on a worker thread, or run it inline if the queue stays full.
+        """
+        self._start()
+        try:
+            self._queue.put(fn, timeout=self.queue_timeout)
+        except queue.Full:
+            self._count('ran_inline')
+            fn()
+        else:
+            self._count('submitted')
+
+    def stats(self):  # type: () -> Dict[str, int]
+        """
+        Return counters, and the current queue depth.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['queue_size'] = self._queue.maxsize
+        return stats
+
+    def _count(self, name):  # type: (str) -> None
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def _start(self):  # type: () -> None
+        if len(self._threads) < self.workers:
+            with self._lock:
+                while len(self._threads) < self.workers:
+                    thread = threading.Thread(
+                        target=self._work, name='payfast-notify-{}'.format(len(self._threads)))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _work(self):  # type: () -> None
+        while True:
+            fn = self._queue.get()
+            try:
+                fn()
+            except Exception:
+                logger.exception('PayFast notify dispatch failed')
+            finally:
+                self._count('completed')
+                # Honour CONN_MAX_AGE for this thread's connection.
+                close_old_connections()
+
+
+_executor = None  # type: Optional[BoundedExecutor]
+_executor_lock = threading.Lock()
+
+
+def get_executor():  # type: () -> BoundedExecutor
+    """
+    Return the process-wide notify executor, creating it if necessary.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = BoundedExecutor(conf.NOTIFY_WORKERS,
+                                            conf.NOTIFY_QUEUE_SIZE,
+                                            conf.NOTIFY_QUEUE_TIMEOUT)
+    return _executor
+
+
+def _on_commit(fn):  # type: (Callable[[], None]) -> None
+    # Django 1.9 adds transaction.on_commit()
+    if django.VERSION < (1, 9):
+        fn()
+    else:
+        transaction.on_commit(fn)
+
+
+def send_notify(sender, order):  # type: (Any, PayFastOrder) -> DispatchFuture
+    """
+    Send the `notify` signal for `order`, according to `PAYFAST_NOTIFY_DISPATCH`.
+    """
+    mode = conf.NOTIFY_DISPATCH
+    future = DispatchFuture()
+    if mode == 'sync':
+        future._run(sender, order, robust=False)
+    elif mode == 'on_commit':
+        _on_commit(lambda: future._run(sender, order))
+    elif mode == 'executor':
+        _on_commit(lambda: get_executor().submit(lambda: future._run(sender, order)))
+    else:
+        raise ValueError('Unknown PAYFAST_NOTIFY_DISPATCH: {!r}'.format(mode))
+    return future
@@ -0,0 +1,173 @@
+"""
+Streaming export of `PayFastOrder` rows as CSV or JSON lines.
+
+Rows are read with `values_list(...).iterator()`, and written out one at a time,
+so memory use stays constant regardless of the number of orders.
+This backs the `PayFastOrderAdmin` export actions and the
+`payfast_export_orders` management command.
+"""
+from __future__ import unicode_literals
+
+import csv
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Iterable, Iterator, Optional, Sequence, Tuple  # noqa: F401
+
+import django
+import six
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import QuerySet  # noqa: F401
+from django.http import StreamingHttpResponse
+
+from payfast.models import PayFastOrder
+
+
+#: Columns exported by default.
+DEFAULT_COLUMNS = [
+    'm_payment_id',
+    'pf_payment_id',
+    'created_at',
+    'payment_status',
+    'amount_gross',
+    'amount_fee',
+    'amount_net',
+    'item_name',
+    'merchant_id',
+    'trusted',
+]
+
+#: Rows fetched from the database at a time.
+DEFAULT_CHUNK_SIZE = 2000
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def check_columns(columns):  # type: (Sequence[str]) -> None
+    """
+    :raise ValueError: If any of `columns` is not a `PayFastOrder` field.
+    """
+    for name in columns:
+        try:
+            PayFastOrder._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise ValueError('Unknown PayFastOrder column: {!r}'.format(name))
+
+
+def filter_orders(
+        queryset,  # type: QuerySet
+        since=None,  # type: Optional[datetime]
+        until=None,  # type: Optional[datetime]
+):  # type: (...) -> QuerySet
+    """
+    Limit `queryset` to orders created in the given date range (`until` is exclusive).
+    """
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    return queryset
+
+
+def export_rows(
+        queryset,  # type: QuerySet
+        columns,  # type: Sequence[str]
+        chunk_size=DEFAULT_CHUNK_SIZE,  # type: int
+):  # type: (...) -> Iterator[Tuple]
+    """
+    Yield a tuple of `columns` values for each order in `queryset`.
+    """
+    check_columns(columns)
+    rows = queryset.values_list(*columns)
+    # Django 2.0 adds QuerySet.iterator(chunk_size)
+    if django.VERSION < (2, 0):
+        return rows.iterator()
+    else:
+        return rows.iterator(chunk_size=chunk_size)
+
+
+def _text(value):  # type: (Any) -> str
+    if value is None:
+        return ''
+    elif isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return six.text_type(value)
+
+
+def _json_value(value):  # type: (Any) -> Any
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return six.text_type(value)
+    return value
+
+
+class _Echo(object):
+    """
+    File-like object that returns what is written, for streaming with `csv.writer`.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, columns):  # type: (Iterable[Tuple], Sequence[str]) -> Iterator[str]
+    """
+    Yield the CSV header and rows, one line at a time.
+    """
+    writer = csv.writer(_Echo())
+    for row in _with_header(rows, columns):
+        values = [_text(value) for value in row]
+        if six.PY2:
+            values = [value.encode('utf-8') for value in values]
+        yield writer.writerow(values)
+
+
+def _with_header(rows, columns):
+    yield columns
+    for row in rows:
+        yield row
+
+
+def jsonl_lines(rows, columns):  # type: (Iterable[Tuple], Sequence[str]) -> Iterator[str]
+    """
+    Yield one JSON object per row, one line at a time.
+    """
+    for row in rows:
+        yield json.dumps(
+            {name: _json_value(value) for (name, value) in zip(columns, row)},
+            sort_keys=True,
+        ) + '\n'
+
+
+def export_lines(
+        queryset,  # type: QuerySet
+        format='csv',  # type: str
+        columns=DEFAULT_COLUMNS,  # type: Sequence[str]
+        chunk_size=DEFAULT_CHUNK_SIZE,  # type: int
+):  # type: (...) -> Iterator[str]
+    """
+    Yield the lines of an export of `queryset`, in the given format.
+    """
+    if format not in FORMATS:
+        raise ValueError('Unknown export format: {!r}'.format(format))
+    rows = export_rows(queryset, columns, chunk_size=chunk_size)
+    return (csv_lines if format == 'csv' else jsonl_lines)(rows, columns)
+
+
+def streaming_response(
+        queryset,  # type: QuerySet
+        format='csv',  # type: str
+        columns=DEFAULT_COLUMNS,  # type: Sequence[str]
+        filename='payfast_orders',  # type: str
+):  # type: (...) -> StreamingHttpResponse
+    """
+    Return a `StreamingHttpResponse` downloading an export of `queryset`.
+    """
+    response = StreamingHttpResponse(export_lines(queryset, format, columns),
+                                     content_type=FORMATS[format])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(filename, format)
+    return response
@@ -1,8 +1,11 @@
 from __future__ import unicode_literals
 
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor  # noqa: F401
 from ipaddress import ip_address, ip_network
 from operator import attrgetter
+from typing import Any, Dict, List, Optional, Tuple  # noqa: F401
 
 from django.contrib.auth import get_user_model
 from six import text_type as str
@@ -11,9 +14,16 @@ from six.moves.urllib_parse import urljoin
 import django
 from django import forms
 from django.conf import settings
+from django.core.exceptions import NON_FIELD_ERRORS
+from django.http import HttpRequest  # noqa: F401
 
 from payfast import api
+from payfast.budgets import Budget
 from payfast import conf
+from payfast import merchants
+from payfast import money
+from payfast import routers
+from payfast import tracing
 from payfast.models import PayFastOrder
 
 # Django 1.10 introduces django.urls
@@ -46,6 +56,16 @@ class HiddenForm(forms.Form):
             self.fields[field].widget = forms.HiddenInput()
 
 
+#: Resource budgets of `PayFastForm`, by path: a new order (with or without
+#: `m_payment_id`), an unchanged existing order, and an existing order updated
+#: with a new user or amount. See `payfast.budgets`.
+CHECKOUT_BUDGETS = {
+    'created': Budget(queries=2, http_calls=0, seconds=0.5),
+    'existing': Budget(queries=1, http_calls=0, seconds=0.5),
+    'updated': Budget(queries=2, http_calls=0, seconds=0.5),
+}
+
+
 class PayFastForm(HiddenForm):
     """ PayFast helper form.
     It is not for validating data.
@@ -119,47 +139,89 @@ class PayFastForm(HiddenForm):
             kwargs['initial'].setdefault('email_address', email_address)
 
         kwargs['initial'].setdefault('notify_url', notify_url())
-        kwargs['initial'].setdefault('merchant_id', conf.MERCHANT_ID)
-        kwargs['initial'].setdefault('merchant_key', conf.MERCHANT_KEY)
+        registry = merchants.get_registry()
+        merchant_id = kwargs['initial'].setdefault('merchant_id', registry.default.merchant_id)
+        # Unregistered merchants are signed without a passphrase.
+        self.merchant = registry.get(merchant_id)  # type: Optional[merchants.Merchant]
+        if self.merchant is not None:
+            kwargs['initial'].setdefault('merchant_key', self.merchant.merchant_key)
+            self.target = self.merchant.process_url
+        else:
+            kwargs['initial'].setdefault('merchant_key', conf.MERCHANT_KEY)
 
         super(PayFastForm, self).__init__(*args, **kwargs)
 
-        if 'm_payment_id' in self.initial:
-            # If the caller supplies m_payment_id, find the existing order, or create it.
-            (self.order, created) = PayFastOrder.objects.get_or_create(
-                m_payment_id=self.initial['m_payment_id'],
-                defaults=dict(
-                    user=user,
-                    amount_gross=self.initial['amount'],
-                ),
-            )
-            if not created:
-                # If the order is existing, check the user and amount fields,
-                # and update if necessary.
-                #
-                # XXX: Also consistency-check that the order is not paid yet?
-                #
-                if not (self.order.user == user and
-                        self.order.amount_gross == self.initial['amount']):
-                    self.order.user = user
-                    self.order.amount_gross = self.initial['amount']
+        with tracing.trace('payfast.checkout', self.initial.get('m_payment_id')) as checkout:
+            # Read the order back from the primary, not a replica (see payfast.routers).
+            with tracing.span('payfast.checkout.order'), routers.use_primary():
+                if 'm_payment_id' in self.initial:
+                    # If the caller supplies m_payment_id, find the existing order, or create it.
+                    (self.order, created) = PayFastOrder.objects.get_or_create(
+                        m_payment_id=self.initial['m_payment_id'],
+                        defaults=dict(
+                            user=user,
+                            amount_gross=self.initial['amount'],
+                        ),
+                    )
+                    if not created:
+                        # If the order is existing, check the user and amount fields,
+                        # and update if necessary.
+                        #
+                        # XXX: Also consistency-check that the order is not paid yet?
+                        #
+                        # (Compare the user's key and the amounts' cents, to avoid
+                        # fetching the user, and re-saving amounts passed as strings.
+                        # The stored amount_gross_cents can be stale after a queryset update().)
+                        if not (self.order.user_id == (user.pk if user else None) and
+                                money.to_cents(self.order.amount_gross) ==
+                                money.to_cents(self.initial['amount'])):
+                            self.order.user = user
+                            self.order.amount_gross = self.initial['amount']
+                            self.order.save()
+                else:
+                    # Old path: Create a new PayFastOrder each time form is instantiated.
+                    self.order = PayFastOrder.objects.create(
+                        user=user,
+                        amount_gross=self.initial['amount'],
+                    )
+
+                    # Initialise m_payment_id from the pk.
+                    self.order.m_payment_id = str(self.order.pk)
                     self.order.save()
-        else:
-            # Old path: Create a new PayFastOrder each time form is instantiated.
-            self.order = PayFastOrder.objects.create(
-                user=user,
-                amount_gross=self.initial['amount'],
-            )
 
-            # Initialise m_payment_id from the pk.
-            self.order.m_payment_id = str(self.order.pk)
-            self.order.save()
+                    self.initial['m_payment_id'] = self.order.m_payment_id
+            checkout.set_attribute('m_payment_id', self.initial['m_payment_id'])
 
-            self.initial['m_payment_id'] = self.order.m_payment_id
+            # Coerce values to strings, for signing.
+            with tracing.span('payfast.checkout.sign'):
+                data = {k: str(v) for (k, v) in self.initial.items()}
+                self._signature = self.fields['signature'].initial = (
+                    api.checkout_signature(data) if self.merchant is None else
+                    self.merchant.signer.checkout_signature(data))
 
-        # Coerce values to strings, for signing.
-        data = {k: str(v) for (k, v) in self.initial.items()}
-        self._signature = self.fields['signature'].initial = api.checkout_signature(data)
+
+_ip_networks = {}  # type: Dict[Tuple[str, ...], List[Any]]
+
+
+def payfast_ip_networks():  # type: () -> List[Any]
+    """
+    Return the parsed networks of `PAYFAST_IP_ADDRESSES`.
+
+    They are parsed once per value of the setting.
+    """
+    # TODO: Django system check for validity?
+    payfast_ip_addresses = tuple(getattr(settings, 'PAYFAST_IP_ADDRESSES',
+                                         conf.DEFAULT_PAYFAST_IP_ADDRESSES))
+    networks = _ip_networks.get(payfast_ip_addresses)
+    if networks is None:
+        if sys.version_info < (3,):
+            # Python 2: ip_network() requires unicode.
+            networks = [ip_network(unicode(address))  # noqa: F821
+                        for address in payfast_ip_addresses]
+        else:
+            networks = [ip_network(address) for address in payfast_ip_addresses]
+        _ip_networks[payfast_ip_addresses] = networks
+    return networks
 
 
 def is_payfast_ip_address(ip_address_str):
@@ -171,25 +233,81 @@ def is_payfast_ip_address(ip_address_str):
     :type ip_address_str: str
     :rtype: bool
     """
-    # TODO: Django system check for validity?
-    payfast_ip_addresses = getattr(settings, 'PAYFAST_IP_ADDRESSES',
-                                   conf.DEFAULT_PAYFAST_IP_ADDRESSES)
-
     if sys.version_info < (3,):
         # Python 2 usability: Coerce str to unicode, to avoid very common TypeErrors.
         # (On Python 3, this should generally not happen:
         #  let unexpected bytes values fail as expected.)
         ip_address_str = unicode(ip_address_str)  # noqa: F821
-        payfast_ip_addresses = [unicode(address) for address in payfast_ip_addresses]  # noqa: F821
 
-    return any(ip_address(ip_address_str) in ip_network(payfast_address)
-               for payfast_address in payfast_ip_addresses)
+    address = ip_address(ip_address_str)
+    return any(address in network for network in payfast_ip_networks())
+
+
+_postback_executor_instance = None  # type: Optional[ThreadPoolExecutor]
+_postback_executor_lock = threading.Lock()
+
+
+def _postback_executor():  # type: () -> ThreadPoolExecutor
+    global _postback_executor_instance
+    if _postback_executor_instance is None:
+        with _postback_executor_lock:
+            if _postback_executor_instance is None:
+                _postback_executor_instance = ThreadPoolExecutor(
+                    max_workers=conf.POSTBACK_WORKERS)
+    return _postback_executor_instance
+
+
+def start_postback(request):  # type: (HttpRequest) -> Optional[Future]
+    """
+    Start the postback validation of an ITN request on a worker thread.
+
+    This lets the caller overlap the postback's network round trip with its
+    own database work, by passing the returned future to `NotifyForm`.
+
+    The postback is only started if the request is for a registered merchant
+    (see `payfast.merchants`), and passes the cheap IP address and signature checks:
+    otherwise, return None, and leave it to `NotifyForm` to reject the request.
+    """
+    merchant = merchants.get_merchant(request.POST.get('merchant_id'))
+    if merchant is None or not merchant.use_postback:
+        return None
+    try:
+        trusted = (is_payfast_ip_address(request.META.get(conf.IP_HEADER, None)) and
+                   merchant.signer.itn_signature(request.POST) == request.POST.get('signature'))
+    except ValueError:
+        trusted = False
+    if not trusted:
+        return None
+    return _postback_executor().submit(merchant.postback.validate, request.POST)
+
+
+#: The reasons `NotifyForm.rejection_reason` reports, by precedence:
+#: (reason, field, error message prefix).
+REJECTION_REASONS = [
+    ('untrusted_ip', NON_FIELD_ERRORS, 'untrusted ip'),
+    ('bad_signature', NON_FIELD_ERRORS, 'Signature is invalid'),
+    ('merchant_mismatch', 'merchant_id', 'Invalid merchant id'),
+    ('amount_mismatch', 'amount_gross', 'Amount is not the same'),
+    ('postback_invalid', NON_FIELD_ERRORS, 'Postback validation fails'),
+    ('postback_failed', NON_FIELD_ERRORS, 'Postback fails'),
+]
 
 
 class NotifyForm(forms.ModelForm):
+    """
+    Validate an ITN request against its order.
+
+    Pass `postback` (from `start_postback`) to use an already-started postback
+    validation, instead of performing it during `clean()`. Pass `use_postback`
+    to override the merchant's `use_postback`.
+    """
 
     def __init__(self, request, *args, **kwargs):
         self.request = request
+        self.postback = kwargs.pop('postback', None)  # type: Optional[Future]
+        self.use_postback = kwargs.pop('use_postback', None)  # type: Optional[bool]
+        # Set by clean_merchant_id()
+        self.merchant = None  # type: Optional[merchants.Merchant]
         super(NotifyForm, self).__init__(*args, **kwargs)
         # the form must be used with order instance provided
         assert self.instance.pk
@@ -199,14 +317,21 @@ class NotifyForm(forms.ModelForm):
         if not is_payfast_ip_address(self.ip):
             raise forms.ValidationError('untrusted ip: %s' % self.ip)
 
+        # An unknown merchant id is already an error: check the rest as for the default merchant.
+        merchant = self.merchant or merchants.get_registry().default
+
         # Verify signature
-        sig = api.itn_signature(self.data)
+        sig = merchant.signer.itn_signature(self.data)
         if sig != self.cleaned_data['signature']:
             raise forms.ValidationError('Signature is invalid: %s != %s' % (
                 sig, self.cleaned_data['signature'],))
 
-        if conf.USE_POSTBACK:
-            is_valid = api.data_is_valid(self.request.POST, conf.SERVER)
+        if merchant.use_postback if self.use_postback is None else self.use_postback:
+            with tracing.span('payfast.notify.postback', concurrent=self.postback is not None):
+                if self.postback is None:
+                    is_valid = merchant.postback.validate(self.request.POST)
+                else:
+                    is_valid = self.postback.result()
             if is_valid is None:
                 raise forms.ValidationError('Postback fails')
             if not is_valid:
@@ -216,7 +341,8 @@ class NotifyForm(forms.ModelForm):
 
     def clean_merchant_id(self):
         merchant_id = self.cleaned_data['merchant_id']
-        if merchant_id != conf.MERCHANT_ID:
+        self.merchant = merchants.get_merchant(merchant_id)
+        if self.merchant is None:
             raise forms.ValidationError('Invalid merchant id (%s).' % merchant_id)
         return merchant_id
 
@@ -224,7 +350,9 @@ class NotifyForm(forms.ModelForm):
         received = self.cleaned_data['amount_gross']
         if conf.REQUIRE_AMOUNT_MATCH:
             requested = self.instance.amount_gross
-            if requested != received:
+            # Compare integer cents: see payfast.money. The stored amount_gross_cents
+            # is not used: it is stale if amount_gross was updated without save().
+            if money.to_cents(requested) != money.to_cents(received):
                 raise forms.ValidationError('Amount is not the same: %s != %s' % (
                                             requested, received,))
         return received
@@ -238,11 +366,24 @@ class NotifyForm(forms.ModelForm):
                          self.request.encoding)
         body_str = body_bytes.decode(body_encoding)  # type: str
 
+        # The full body is kept in the ITN log: see payfast.itn_log
         self.instance.debug_info = body_str[:255]
 
         self.instance.trusted = True
         return super(NotifyForm, self).save(*args, **kwargs)
 
+    def rejection_reason(self):  # type: () -> Optional[str]
+        '''
+        The main reason the ITN is rejected, from `REJECTION_REASONS`,
+        or ``'invalid_data'`` for other errors, or None if it is valid.
+        '''
+        if not self.errors:
+            return None
+        for (reason, field, prefix) in REJECTION_REASONS:
+            if any(message.startswith(prefix) for message in self.errors.get(field, [])):
+                return reason
+        return 'invalid_data'
+
     def plain_errors(self):
         ''' plain error list (without the html) '''
         return '|'.join(["%s: %s" % (k, (v[0])) for k, v in self.errors.items()])
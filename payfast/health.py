@@ -0,0 +1,276 @@
+"""
+Health of the ITN path, for orchestrators and load balancers.
+
+The health view, mounted with ``payfast.urls`` at ``health/`` and enabled with
+`PAYFAST_HEALTH_VIEW`, reports:
+
+* the reachability of the `PayFastOrder` database, as last seen by the notify
+  view, or by a background probe every `PAYFAST_HEALTH_DB_INTERVAL` seconds
+  (default 10; 0 for no probe) when there are no ITNs;
+* the postback circuit breakers and connection pools
+  (see `payfast.merchants.PostbackClient`), without the merchant ids;
+* the backlog of deferred processing: the `notify` dispatch queue
+  (see `payfast.dispatch`) and the buffered ITN log (see `payfast.itn_log`);
+* the ITNs received over the last `PAYFAST_HEALTH_WINDOW` seconds (default 60),
+  by outcome, and the rate of errors (exceptions) among them.
+
+It answers from in-memory state, without I/O, so it can be probed often.
+Errors are reported by exception type only: their messages are logged.
+
+The status is ``'starting'`` until the warm-up is done (see `payfast.warmup`),
+``'unavailable'`` if the database is unreachable (both answered with 503),
+``'degraded'`` if a circuit breaker is open, the dispatch queue is full, or the
+error rate exceeds `PAYFAST_HEALTH_MAX_ERROR_RATE` (default 0.5), and ``'ok'``
+otherwise (both answered with 200).
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import threading
+from collections import Counter, deque
+from timeit import default_timer
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple  # noqa: F401
+
+from django.db import DatabaseError, connections, router
+from django.http import Http404, HttpResponse
+
+from payfast import conf
+from payfast import dispatch
+from payfast import itn_log
+from payfast import merchants
+from payfast import warmup
+from payfast.models import PayFastOrder
+
+
+logger = logging.getLogger(__name__)
+
+#: The outcome of an ITN that raised an exception (see `record_itn_error`).
+ERROR = 'error'
+
+
+class DatabaseState(object):
+    """
+    The last known reachability of the `PayFastOrder` database.
+    """
+
+    def __init__(self, clock=default_timer):  # type: (Callable[[], float]) -> None
+        self._clock = clock
+        # (reachable, error, when): replaced as a whole, so readers need no lock.
+        self._state = (None, None, None)
+        # type: Tuple[Optional[bool], Optional[str], Optional[float]]
+        self._probe = None  # type: Optional[threading.Thread]
+        self._lock = threading.Lock()
+
+    def record(self, reachable, error=None):  # type: (bool, Optional[str]) -> None
+        self._state = (reachable, error, self._clock())
+
+    def check(self):  # type: () -> bool
+        """
+        Query the database now, and record whether it answered.
+        """
+        try:
+            PayFastOrder.objects.using(router.db_for_write(PayFastOrder)).exists()
+        except DatabaseError as e:
+            logger.warning('PayFast database health check failed: %s', e)
+            self.record(False, type(e).__name__)
+            return False
+        self.record(True)
+        return True
+
+    def report(self):  # type: () -> Dict[str, object]
+        (reachable, error, when) = self._state
+        return {
+            'reachable': reachable,
+            'error': error,
+            'seconds_ago': None if when is None else round(self._clock() - when, 3),
+        }
+
+    def start_probe(self, interval):  # type: (float) -> None
+        """
+        Start checking the database every `interval` seconds without other news of it.
+        """
+        if self._probe is not None:
+            return
+        with self._lock:
+            if self._probe is None:
+                self._probe = threading.Thread(target=self._run_probe, args=(interval,),
+                                               name='payfast-health-probe')
+                self._probe.daemon = True
+                self._probe.start()
+
+    def _run_probe(self, interval):  # type: (float) -> None
+        stopped = threading.Event()
+        while True:
+            when = self._state[2]
+            if when is None or self._clock() - when >= interval:
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception('PayFast database health probe failed')
+                finally:
+                    # Don't hold on to a connection between probes.
+                    connections.close_all()
+            stopped.wait(interval)
+
+
+class RecentCounts(object):
+    """
+    Counts of events by kind over the last `window` seconds, in one-second buckets.
+    """
+
+    def __init__(self, window, clock=default_timer):  # type: (float, Callable[[], float]) -> None
+        self.window = window
+        self._clock = clock
+        self._buckets = deque()  # type: Deque[Tuple[int, Counter]]
+        self._lock = threading.Lock()
+
+    def add(self, kind):  # type: (str) -> None
+        second = int(self._clock())
+        with self._lock:
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append((second, Counter()))
+                self._trim(second)
+            self._buckets[-1][1][kind] += 1
+
+    def totals(self):  # type: () -> Counter
+        totals = Counter()  # type: Counter
+        with self._lock:
+            self._trim(int(self._clock()))
+            for (_, counts) in self._buckets:
+                totals.update(counts)
+        return totals
+
+    def _trim(self, second):  # type: (int) -> None
+        while self._buckets and self._buckets[0][0] <= second - self.window:
+            self._buckets.popleft()
+
+
+_database = None  # type: Optional[DatabaseState]
+_notify = None  # type: Optional[RecentCounts]
+_lock = threading.Lock()
+
+
+def _get_state():  # type: () -> Tuple[DatabaseState, RecentCounts]
+    global _database, _notify
+    if _database is None or _notify is None:
+        with _lock:
+            if _database is None or _notify is None:
+                (_database, _notify) = (DatabaseState(), RecentCounts(conf.HEALTH_WINDOW))
+    return (_database, _notify)
+
+
+def reset():  # type: () -> None
+    """
+    Forget the recorded state, and the settings read from it (mainly for tests).
+    """
+    global _database, _notify
+    with _lock:
+        (_database, _notify) = (None, None)
+
+
+def record_itn(verdict):  # type: (str) -> None
+    """
+    Record a processed ITN, with its `PayFastITNLog` verdict.
+
+    Processing it reached the database.
+    """
+    (database, notify) = _get_state()
+    notify.add(verdict)
+    database.record(True)
+
+
+def record_itn_error(error):  # type: (Exception) -> None
+    """
+    Record an ITN that failed with `error`.
+    """
+    (database, notify) = _get_state()
+    notify.add(ERROR)
+    if isinstance(error, DatabaseError):
+        database.record(False, type(error).__name__)
+
+
+def check_database():  # type: () -> bool
+    """
+    Check the database now (see `DatabaseState.check`).
+    """
+    return _get_state()[0].check()
+
+
+def _postback_report():  # type: () -> List[Dict[str, object]]
+    report = []
+    for merchant in merchants.get_registry():
+        client = merchant.postback
+        report.append({
+            'server': client.server,
+            'use_postback': merchant.use_postback,
+            'breaker': None if client.breaker is None else client.breaker.stats(),
+            'pool': None if client.pool is None else client.pool.stats(),
+        })
+    return report
+
+
+def _backlog_report():  # type: () -> Dict[str, object]
+    # Report the executor and buffer only if they exist: don't create them.
+    executor = dispatch._executor
+    buffer = itn_log._buffer
+    return {
+        'notify_dispatch': None if executor is None else executor.stats(),
+        'itn_log_buffer': None if buffer is None else len(buffer),
+    }
+
+
+def _notify_report(notify):  # type: (RecentCounts) -> Dict[str, object]
+    totals = notify.totals()
+    received = sum(totals.values())
+    report = {'window_seconds': notify.window, 'received': received}  # type: Dict[str, Any]
+    report.update(totals)
+    report['error_rate'] = round(float(totals[ERROR]) / received, 4) if received else 0.0
+    return report
+
+
+def report():  # type: () -> Dict[str, Any]
+    """
+    Return the health report, and its ``'status'``.
+    """
+    (database, notify) = _get_state()
+    if conf.HEALTH_DB_INTERVAL:
+        database.start_probe(conf.HEALTH_DB_INTERVAL)
+
+    result = {
+        'database': database.report(),
+        'postback': _postback_report(),
+        'backlog': _backlog_report(),
+        'notify': _notify_report(notify),
+    }  # type: Dict[str, Any]
+
+    dispatch_stats = result['backlog']['notify_dispatch']
+    if not warmup.is_ready():
+        status = 'starting'
+    elif result['database']['reachable'] is False:
+        status = 'unavailable'
+    elif (any(postback['breaker'] is not None and
+              postback['breaker']['state'] == merchants.CircuitBreaker.OPEN
+              for postback in result['postback']) or
+          (dispatch_stats is not None and
+           dispatch_stats['queue_depth'] >= dispatch_stats['queue_size'] > 0) or
+          result['notify']['error_rate'] > conf.HEALTH_MAX_ERROR_RATE):
+        status = 'degraded'
+    else:
+        status = 'ok'
+    result['status'] = status
+    return result
+
+
+def health_view(request):
+    """
+    Report the health of the ITN path: 200 if it can take ITNs, 503 if not.
+    """
+    if not conf.HEALTH_VIEW:
+        raise Http404('Health checks are disabled.')
+    result = report()
+    return HttpResponse(
+        json.dumps(result, sort_keys=True),
+        status=503 if result['status'] in ('starting', 'unavailable') else 200,
+        content_type='application/json',
+    )
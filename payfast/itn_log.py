@@ -0,0 +1,193 @@
+"""
+Recording of received ITN submissions in the append-only `PayFastITNLog`.
+
+Setting: `PAYFAST_ITN_LOG_MODE`
+
+* ``'sync'`` (default): Each entry is written as the ITN is handled.
+* ``'buffered'``: Entries are collected in an in-process buffer, and written
+  with `bulk_create` once `PAYFAST_ITN_LOG_BATCH_SIZE` entries are pending,
+  or `PAYFAST_ITN_LOG_FLUSH_INTERVAL` seconds have passed.
+  Pending entries are lost if the process dies before they are flushed.
+* ``'off'``: Nothing is recorded.
+"""
+from __future__ import unicode_literals
+
+import atexit
+import json
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+from typing import Dict, List, Optional  # noqa: F401
+
+from django.db import connection
+from django.http import HttpRequest  # noqa: F401
+from django.http.request import RawPostDataException
+from six.moves.urllib.parse import urlencode
+
+from payfast import conf
+from payfast.models import PayFastITNLog, PayFastOrder  # noqa: F401
+
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer(object):
+    """
+    Collect the elapsed time of named processing stages, in milliseconds.
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict()  # type: Dict[str, float]
+
+    @contextmanager
+    def stage(self, name):
+        started = default_timer()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((default_timer() - started) * 1000, 3)
+
+
+def raw_body(request):  # type: (HttpRequest) -> bytes
+    """
+    Return the raw body of an ITN request.
+
+    PayFast posts ITNs as ``application/x-www-form-urlencoded``, for which
+    Django keeps the raw body around. For other (multipart) submissions,
+    the body is no longer available once parsed: fall back to re-encoding
+    the parsed POST data.
+    """
+    try:
+        return request.body
+    except RawPostDataException:
+        return urlencode(list(request.POST.lists()), doseq=True).encode('ascii')
+
+
+def build_entry(
+        request,  # type: HttpRequest
+        verdict,  # type: str
+        order=None,  # type: Optional[PayFastOrder]
+        errors='',  # type: str
+        timings=None,  # type: Optional[Dict[str, float]]
+):  # type: (...) -> PayFastITNLog
+    """
+    Build an unsaved `PayFastITNLog` entry for the given ITN request.
+    """
+    headers = OrderedDict(
+        (key, request.META[key]) for key in conf.ITN_LOG_HEADERS
+        if key in request.META
+    )
+    return PayFastITNLog(
+        order=order,
+        m_payment_id=request.POST.get('m_payment_id', None),
+        source_ip=request.META.get(conf.IP_HEADER, None),
+        verdict=verdict,
+        errors=errors,
+        headers=json.dumps(headers),
+        body=zlib.compress(raw_body(request)),
+        timings=json.dumps(timings or {}),
+    )
+
+
+class ITNLogBuffer(object):
+    """
+    Thread-safe in-process buffer of unsaved `PayFastITNLog` entries.
+
+    Entries are flushed with a single `bulk_create` when `batch_size` entries
+    are pending, or by a background thread every `flush_interval` seconds,
+    until `stop` is called. Once stopped, each entry is written as it is appended.
+    """
+
+    def __init__(self, batch_size, flush_interval):  # type: (int, float) -> None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = []  # type: List[PayFastITNLog]
+        self._flusher = None  # type: Optional[threading.Thread]
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def append(self, entry):  # type: (PayFastITNLog) -> None
+        stopped = self._stopped.is_set()
+        with self._lock:
+            self._pending.append(entry)
+            full = stopped or len(self._pending) >= self.batch_size
+            if self._flusher is None and not stopped:
+                self._flusher = threading.Thread(target=self._flush_periodically,
+                                                 name='payfast-itn-log-flusher')
+                self._flusher.daemon = True
+                self._flusher.start()
+        if full:
+            self.flush()
+
+    def flush(self):  # type: () -> int
+        """
+        Write all pending entries, and return how many were written.
+        """
+        with self._lock:
+            (entries, self._pending) = (self._pending, [])
+        if entries:
+            try:
+                PayFastITNLog.objects.bulk_create(entries)
+            except Exception:
+                logger.exception('Failed to write %d PayFast ITN log entries', len(entries))
+                return 0
+        return len(entries)
+
+    def stop(self):  # type: () -> int
+        """
+        Stop the background thread, and write the pending entries.
+        """
+        self._stopped.set()
+        return self.flush()
+
+    def _flush_periodically(self):  # type: () -> None
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+            # Don't hold on to a connection between flushes.
+            connection.close()
+
+
+_buffer = None  # type: Optional[ITNLogBuffer]
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():  # type: () -> ITNLogBuffer
+    """
+    Return the process-wide ITN log buffer, creating it if necessary.
+    """
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = ITNLogBuffer(conf.ITN_LOG_BATCH_SIZE, conf.ITN_LOG_FLUSH_INTERVAL)
+                atexit.register(_buffer.stop)
+    return _buffer
+
+
+def record(
+        request,  # type: HttpRequest
+        verdict,  # type: str
+        order=None,  # type: Optional[PayFastOrder]
+        errors='',  # type: str
+        timings=None,  # type: Optional[Dict[str, float]]
+):  # type: (...) -> None
+    """
+    Record an ITN request in the log, according to `PAYFAST_ITN_LOG_MODE`.
+    """
+    mode = conf.ITN_LOG_MODE
+    if mode == 'off':
+        return
+
+    entry = build_entry(request, verdict, order=order, errors=errors, timings=timings)
+    if mode == 'sync':
+        entry.save()
+    elif mode == 'buffered':
+        get_buffer().append(entry)
+    else:
+        raise ValueError('Unknown PAYFAST_ITN_LOG_MODE: {!r}'.format(mode))
@@ -0,0 +1,25 @@
+"""
+Argument types shared by the payfast management commands.
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime  # noqa: F401
+
+from django.core.management.base import CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+
+def datetime_argument(value):  # type: (str) -> datetime
+    """
+    Parse an ISO 8601 date or date/time, in the current time zone if not given.
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError('Invalid date/time: {!r}'.format(value))
+        parsed = datetime(day.year, day.month, day.day)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
@@ -0,0 +1,51 @@
+"""
+Move settled PayFast orders into the archive table, in batches.
+
+Example::
+
+    manage.py payfast_archive_orders --older-than-days 180 --batch-size 500 --sleep 1
+"""
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from payfast import archive
+from payfast import batches
+
+
+class Command(BaseCommand):
+    help = 'Move settled PayFast orders into the archive table, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=float, default=archive.DEFAULT_OLDER_THAN.days,
+            help='Only archive orders last updated more than this many days ago.')
+        parser.add_argument(
+            '--batch-size', type=int, default=archive.DEFAULT_BATCH_SIZE,
+            help='Orders moved per batch (and transaction).')
+        parser.add_argument(
+            '--sleep', type=float, default=batches.DEFAULT_SLEEP,
+            help='Seconds to pause between batches.')
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Only count the orders that would be archived.')
+
+    def handle(self, *args, **options):
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+
+        def progress(report):
+            if options['verbosity'] >= 2:
+                self.stderr.write('  ...{} orders (pk {}-{})'.format(
+                    report.rows, report.first_pk, report.last_pk))
+
+        report = archive.archive_orders(
+            older_than=timedelta(days=options['older_than_days']),
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            dry_run=options['dry_run'],
+            progress=progress,
+        )
+        if options['verbosity'] >= 1:
+            self.stdout.write('{} {} orders in {} batches'.format(
+                verb, report.rows, report.batches))
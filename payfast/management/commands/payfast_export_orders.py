@@ -0,0 +1,58 @@
+"""
+Export PayFast orders as CSV or JSON lines, in constant memory.
+
+Example::
+
+    manage.py payfast_export_orders --since 2018-01-01 --until 2018-02-01 \\
+        --columns m_payment_id,pf_payment_id,amount_gross,payment_status --output jan.csv
+"""
+from __future__ import unicode_literals
+
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payfast import export
+from payfast.management.arguments import datetime_argument
+from payfast.models import PayFastOrder
+
+
+class Command(BaseCommand):
+    help = 'Export PayFast orders as CSV or JSON lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=sorted(export.FORMATS), default='csv')
+        parser.add_argument(
+            '--columns', default=','.join(export.DEFAULT_COLUMNS),
+            help='Comma-separated PayFastOrder fields to export.')
+        parser.add_argument(
+            '--since', type=datetime_argument, help='Only export orders created at or after this.')
+        parser.add_argument(
+            '--until', type=datetime_argument, help='Only export orders created before this.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=export.DEFAULT_CHUNK_SIZE,
+            help='Rows fetched from the database at a time.')
+        parser.add_argument(
+            '--output', metavar='PATH', help='Write to this file, instead of stdout.')
+
+    def handle(self, *args, **options):
+        columns = [name.strip() for name in options['columns'].split(',') if name.strip()]
+        orders = export.filter_orders(PayFastOrder.objects.order_by('pk'),
+                                      since=options['since'], until=options['until'])
+        try:
+            lines = export.export_lines(orders, options['format'], columns,
+                                        chunk_size=options['chunk_size'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        if options['output']:
+            # On Python 2, csv_lines() yields UTF-8 encoded bytes.
+            with io.open(options['output'], 'wb') as f:
+                for line in lines:
+                    f.write(line if isinstance(line, bytes) else line.encode('utf-8'))
+        else:
+            for line in lines:
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8')
+                self.stdout.write(line, ending='')
@@ -0,0 +1,30 @@
+"""
+Rebuild the PayFast daily summary table from PayFastOrder.
+
+Example::
+
+    manage.py payfast_rebuild_summaries --chunk-size 5000
+"""
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from payfast import summaries
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the PayFast daily summary table from PayFast orders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=summaries.DEFAULT_CHUNK_SIZE,
+            help='Orders read from the database at a time.')
+
+    def handle(self, *args, **options):
+        def progress(done):
+            if options['verbosity'] >= 2:
+                self.stderr.write('  ...{} orders'.format(done))
+
+        rows = summaries.rebuild(chunk_size=options['chunk_size'], progress=progress)
+        if options['verbosity'] >= 1:
+            self.stdout.write('Rebuilt {} summary rows'.format(rows))
@@ -0,0 +1,138 @@
+"""
+Reconcile a PayFast transaction history CSV export against PayFastOrder.
+
+Example::
+
+    manage.py payfast_reconcile history.csv --checkpoint history.checkpoint \\
+        --report discrepancies.csv
+
+If interrupted, run the same command again to resume from the checkpoint.
+"""
+from __future__ import unicode_literals
+
+import csv
+import io
+import os
+
+import six
+from django.core.management.base import BaseCommand, CommandError
+
+from payfast import reconcile
+
+
+def _read_rows(path, encoding):
+    if six.PY2:
+        with open(path, 'rb') as f:
+            for row in csv.DictReader(f):
+                yield {k.decode(encoding): (v or b'').decode(encoding) for (k, v) in row.items()}
+    else:
+        with io.open(path, encoding=encoding, newline='') as f:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def _csv_row(values):
+    # Python 2's csv module writes bytes, so encode the values first.
+    values = [six.text_type(value) for value in values]
+    if six.PY2:
+        values = [value.encode('utf-8') for value in values]
+    return values
+
+
+def _column_argument(value):
+    (field_name, sep, column) = value.partition('=')
+    if not sep or field_name not in reconcile.DEFAULT_COLUMNS:
+        raise CommandError('Expected FIELD=COLUMN, with FIELD one of: {}'.format(
+            ', '.join(reconcile.DEFAULT_COLUMNS)))
+    return (field_name, column)
+
+
+class Command(BaseCommand):
+    help = 'Reconcile a PayFast transaction history CSV export against PayFast orders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The transaction history CSV file.')
+        parser.add_argument(
+            '--encoding', default='utf-8-sig', help='The CSV file encoding (default: utf-8-sig)')
+        parser.add_argument(
+            '--column', type=_column_argument, action='append', default=[],
+            metavar='FIELD=COLUMN',
+            help='Map a PayFastOrder field to a CSV column (repeatable). Defaults: {}'.format(
+                ', '.join('{}={}'.format(*item) for item in reconcile.DEFAULT_COLUMNS.items())))
+        parser.add_argument(
+            '--chunk-size', type=int, default=reconcile.DEFAULT_CHUNK_SIZE,
+            help='Rows reconciled (and orders fetched) at a time.')
+        parser.add_argument(
+            '--checkpoint', metavar='PATH',
+            help='Save progress to this file after each chunk, and resume from it.')
+        parser.add_argument(
+            '--report', metavar='PATH',
+            help='Write discrepancies to this CSV file, instead of stdout.')
+
+    def handle(self, *args, **options):
+        source = os.path.abspath(options['path'])
+        columns = reconcile.DEFAULT_COLUMNS.copy()
+        columns.update(options['column'])
+
+        if options['checkpoint']:
+            try:
+                checkpoint = reconcile.Checkpoint.load(options['checkpoint'], source)
+            except ValueError as e:
+                raise CommandError(e)
+        else:
+            checkpoint = reconcile.Checkpoint(None, source)
+        if checkpoint.rows:
+            self.stderr.write('Resuming after row {}'.format(checkpoint.rows))
+
+        if options['report']:
+            # Append when resuming, so that earlier discrepancies are kept.
+            mode = 'a' if checkpoint.rows else 'w'
+            if six.PY2:
+                report_file = io.open(options['report'], mode + 'b')
+            else:
+                report_file = io.open(options['report'], mode, encoding='utf-8', newline='')
+            write = report_file.write
+        else:
+            report_file = None
+            write = self._write_stdout
+        try:
+            writer = csv.writer(_Writer(write))
+            if not checkpoint.rows:
+                writer.writerow(_csv_row(reconcile.Discrepancy._fields))
+
+            chunks = reconcile.reconcile(
+                _read_rows(source, options['encoding']),
+                columns=columns,
+                chunk_size=options['chunk_size'],
+                skip=checkpoint.rows,
+            )
+            for (rows, matched, discrepancies) in chunks:
+                for discrepancy in discrepancies:
+                    writer.writerow(_csv_row(discrepancy))
+                if report_file is not None:
+                    report_file.flush()
+                checkpoint.add(rows, matched, discrepancies)
+                if checkpoint.path:
+                    checkpoint.save()
+                if options['verbosity'] >= 2:
+                    self.stderr.write('  ...{} rows'.format(rows))
+        finally:
+            if report_file is not None:
+                report_file.close()
+
+        self.stderr.write('Reconciled {} rows: {}'.format(checkpoint.rows, ', '.join(
+            '{} {}'.format(count, kind) for (kind, count) in sorted(checkpoint.counts.items()))))
+
+    def _write_stdout(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        self.stdout.write(line, ending='')
+
+
+class _Writer(object):
+    """
+    Adapt a write function for `csv.writer`.
+    """
+
+    def __init__(self, write):
+        self.write = write
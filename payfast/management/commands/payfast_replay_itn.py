@@ -0,0 +1,78 @@
+"""
+Replay stored ITN payloads through the notify pipeline.
+
+Examples::
+
+    # Re-drive every ITN that was rejected or unmatched since an outage began:
+    manage.py payfast_replay_itn --verdict rejected --verdict not_found \\
+        --since 2018-01-01T10:00 --concurrency 8
+
+    # Validate (without saving or signalling) payloads exported as JSON lines:
+    manage.py payfast_replay_itn --jsonl itns.jsonl --dry-run
+"""
+from __future__ import unicode_literals
+
+import io
+
+from django.core.management.base import BaseCommand
+
+from payfast import replay
+from payfast.management.arguments import datetime_argument
+from payfast.models import PayFastITNLog
+
+
+class Command(BaseCommand):
+    help = 'Replay stored PayFast ITN payloads through the notify pipeline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--jsonl', metavar='PATH',
+            help='Read payloads from a JSON lines file, instead of the ITN log.')
+        parser.add_argument(
+            '--verdict', action='append', choices=[v for (v, _) in PayFastITNLog.VERDICT_CHOICES],
+            help='Only replay ITN log entries with this verdict (repeatable).')
+        parser.add_argument(
+            '--since', type=datetime_argument,
+            help='Only replay ITN log entries received at or after this.')
+        parser.add_argument(
+            '--until', type=datetime_argument,
+            help='Only replay ITN log entries received before this.')
+        parser.add_argument(
+            '--concurrency', type=int, default=1,
+            help='Number of worker threads (default: 1)')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only validate payloads, without postbacks: do not save orders, '
+                 'record or send signals.')
+
+    def handle(self, *args, **options):
+        if options['jsonl']:
+            with io.open(options['jsonl'], encoding='utf-8') as f:
+                report = self._replay(replay.payloads_from_jsonl(f), options)
+        else:
+            entries = PayFastITNLog.objects.all()
+            if options['verdict']:
+                entries = entries.filter(verdict__in=options['verdict'])
+            if options['since']:
+                entries = entries.filter(received_at__gte=options['since'])
+            if options['until']:
+                entries = entries.filter(received_at__lt=options['until'])
+            report = self._replay(replay.payloads_from_log(entries), options)
+
+        self.stdout.write('Replayed {} ITNs in {:.2f}s ({:.1f}/s){}'.format(
+            report.total, report.elapsed, report.throughput,
+            ' (dry run)' if options['dry_run'] else ''))
+        for (outcome, count) in sorted(report.outcomes.items()):
+            self.stdout.write('  {}: {}'.format(outcome, count))
+
+    def _replay(self, payloads, options):
+        def progress(total):
+            if options['verbosity'] >= 2 and total % 100 == 0:
+                self.stdout.write('  ...{}'.format(total))
+
+        return replay.replay(
+            payloads,
+            concurrency=options['concurrency'],
+            dry_run=options['dry_run'],
+            progress=progress,
+        )
@@ -0,0 +1,55 @@
+"""
+Delete abandoned PayFast orders (never notified, without a pf_payment_id) in batches.
+
+Example::
+
+    manage.py payfast_sweep_orders --older-than-days 90 --batch-size 500 --sleep 1 --dry-run
+"""
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from payfast import batches
+from payfast import sweep
+
+
+class Command(BaseCommand):
+    help = 'Delete (or archive) abandoned PayFast orders (never notified) in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=float, default=sweep.DEFAULT_OLDER_THAN.days,
+            help='Only sweep orders created more than this many days ago.')
+        parser.add_argument(
+            '--batch-size', type=int, default=sweep.DEFAULT_BATCH_SIZE,
+            help='Orders deleted per batch.')
+        parser.add_argument(
+            '--sleep', type=float, default=batches.DEFAULT_SLEEP,
+            help='Seconds to pause between batches.')
+        parser.add_argument(
+            '--archive', action='store_true',
+            help='Move the orders into the archive table, instead of deleting them.')
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Only count the orders that would be swept.')
+
+    def handle(self, *args, **options):
+        verb = 'Would sweep' if options['dry_run'] else 'Swept'
+
+        def progress(report):
+            if options['verbosity'] >= 2:
+                self.stderr.write('  ...{} orders (pk {}-{})'.format(
+                    report.rows, report.first_pk, report.last_pk))
+
+        report = sweep.sweep(
+            older_than=timedelta(days=options['older_than_days']),
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            dry_run=options['dry_run'],
+            progress=progress,
+            archive=options['archive'],
+        )
+        if options['verbosity'] >= 1:
+            self.stdout.write('{} {} orders in {} batches'.format(
+                verb, report.rows, report.batches))
@@ -0,0 +1,281 @@
+"""
+Registry of the PayFast merchant accounts served by this site.
+
+By default, there is one merchant: `PAYFAST_MERCHANT_ID` and `PAYFAST_MERCHANT_KEY`.
+To serve several merchant accounts, list them by merchant id in `PAYFAST_MERCHANTS`::
+
+    PAYFAST_MERCHANTS = {
+        '10000100': {
+            'merchant_key': '46f0cd694581a',
+            'passphrase': 'secret',  # if set on the PayFast account
+            'test_mode': True,  # default: PAYFAST_TEST_MODE (or PAYFAST_SERVER)
+            'use_postback': True,  # default: PAYFAST_USE_POSTBACK
+        },
+    }
+
+`PAYFAST_MERCHANT_ID` remains the default merchant of `PayFastForm`.
+
+The registry is built from the settings on first use, and each merchant builds
+its `Signer` and `PostbackClient` once, on first use: routing an ITN to its
+merchant is a dict lookup.
+"""
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+from typing import Callable, Dict, Iterator, Mapping, Optional  # noqa: F401
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import cached_property
+
+from payfast import api
+from payfast import conf
+from payfast import metrics
+
+
+class Signer(object):
+    """
+    Sign checkout and ITN data with a merchant's passphrase (see `payfast.api`).
+    """
+
+    def __init__(self, passphrase=None):  # type: (Optional[str]) -> None
+        self.passphrase = passphrase or None
+
+    def checkout_signature(self, checkout_data):  # type: (Mapping[str, str]) -> str
+        return api.checkout_signature(checkout_data, self.passphrase)
+
+    def itn_signature(self, itn_data):  # type: (Mapping[str, str]) -> str
+        return api.itn_signature(itn_data, self.passphrase)
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a failing service for a while.
+
+    After `threshold` consecutive failures, the circuit opens: calls are refused
+    for `reset_timeout` seconds. Then one trial call is allowed: the circuit
+    closes if it succeeds, and opens again if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold, reset_timeout, clock=default_timer):
+        # type: (int, float, Callable[[], float]) -> None
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self._changed_at = clock()
+
+    def allow(self):  # type: () -> bool
+        """
+        Return whether to make a call now.
+        """
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            # An open circuit lets a trial call through after the timeout, and
+            # so does a half-open one whose trial call never reported back.
+            if self._clock() - self._changed_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self):  # type: () -> None
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):  # type: () -> None
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state):  # type: (str) -> None
+        self.state = state
+        self._changed_at = self._clock()
+
+    def stats(self):  # type: () -> Dict[str, object]
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures,
+                    'seconds_in_state': round(self._clock() - self._changed_at, 3)}
+
+
+class PostbackUnavailable(Exception):
+    """
+    The postback server is not called, because its circuit breaker is open.
+    """
+
+
+class PostbackClient(object):
+    """
+    Validate ITN data with a postback to a PayFast server (see `payfast.api.data_is_valid`).
+
+    With `PAYFAST_POSTBACK_POOL_SIZE`, postbacks reuse keep-alive connections from `pool`.
+
+    With `PAYFAST_POSTBACK_BREAKER_THRESHOLD`, postbacks that keep raising errors open
+    the `breaker`: while it is open, `validate` raises `PostbackUnavailable` without
+    calling the server. Like other postback errors, this leaves the order untouched:
+    the notify view answers 503, and PayFast retries the ITN later.
+    """
+
+    def __init__(self, server):  # type: (str) -> None
+        self.server = server
+        self.pool = (api.get_pool(server, conf.POSTBACK_POOL_SIZE) if conf.POSTBACK_POOL_SIZE else
+                     None)  # type: Optional[api.ConnectionPool]
+        self.breaker = (CircuitBreaker(conf.POSTBACK_BREAKER_THRESHOLD,
+                                       conf.POSTBACK_BREAKER_RESET)
+                        if conf.POSTBACK_BREAKER_THRESHOLD else
+                        None)  # type: Optional[CircuitBreaker]
+
+    def validate(self, post_data):  # type: (Mapping[str, str]) -> Optional[bool]
+        if self.breaker is not None and not self.breaker.allow():
+            raise PostbackUnavailable('Postback circuit open for {}'.format(self.server))
+        started = default_timer()
+        try:
+            is_valid = api.data_is_valid(post_data, self.server)
+        except Exception:
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+        finally:
+            metrics.POSTBACK_SECONDS.observe(default_timer() - started)
+        if self.breaker is not None:
+            self.breaker.record_success()
+        return is_valid
+
+
+class Merchant(object):
+    """
+    A PayFast merchant account.
+
+    `test_mode` and `use_postback` default to the global settings.
+    """
+
+    def __init__(
+            self,
+            merchant_id,  # type: str
+            merchant_key,  # type: str
+            passphrase=None,  # type: Optional[str]
+            test_mode=None,  # type: Optional[bool]
+            use_postback=None,  # type: Optional[bool]
+    ):  # type: (...) -> None
+        self.merchant_id = merchant_id
+        self.merchant_key = merchant_key
+        self.passphrase = passphrase
+        self._test_mode = test_mode
+        self._use_postback = use_postback
+
+    def __repr__(self):
+        return '<Merchant {}>'.format(self.merchant_id)
+
+    @property
+    def test_mode(self):  # type: () -> bool
+        return conf.TEST_MODE if self._test_mode is None else self._test_mode
+
+    @property
+    def server(self):  # type: () -> str
+        if self._test_mode is None:
+            return conf.SERVER  # Includes PAYFAST_SERVER
+        return conf.SANDBOX_SERVER if self._test_mode else conf.LIVE_SERVER
+
+    @property
+    def process_url(self):  # type: () -> str
+        return self.server + '/eng/process'
+
+    @property
+    def use_postback(self):  # type: () -> bool
+        return conf.USE_POSTBACK if self._use_postback is None else self._use_postback
+
+    @cached_property
+    def signer(self):  # type: () -> Signer
+        return Signer(self.passphrase)
+
+    @cached_property
+    def postback(self):  # type: () -> PostbackClient
+        return PostbackClient(self.server)
+
+
+class MerchantRegistry(object):
+    """
+    The configured merchants, by merchant id.
+    """
+
+    def __init__(self, merchants, default_id):  # type: (Iterator[Merchant], str) -> None
+        self._merchants = OrderedDict(
+            (merchant.merchant_id, merchant) for merchant in merchants
+        )  # type: Dict[str, Merchant]
+        self.default = self._merchants[default_id]
+
+    def get(self, merchant_id):  # type: (Optional[str]) -> Optional[Merchant]
+        """
+        Return the merchant with `merchant_id`, or None if there is none.
+        """
+        return self._merchants.get(merchant_id)
+
+    def __contains__(self, merchant_id):  # type: (str) -> bool
+        return merchant_id in self._merchants
+
+    def __iter__(self):  # type: () -> Iterator[Merchant]
+        return iter(self._merchants.values())
+
+    def __len__(self):  # type: () -> int
+        return len(self._merchants)
+
+    @classmethod
+    def from_settings(cls):  # type: () -> MerchantRegistry
+        """
+        Build the registry from `PAYFAST_MERCHANTS`, and the default merchant settings.
+        """
+        merchants = [Merchant(conf.MERCHANT_ID, conf.MERCHANT_KEY)]
+        for (merchant_id, options) in sorted(conf.MERCHANTS.items()):
+            try:
+                merchant = Merchant(merchant_id, **options)
+            except TypeError as e:
+                raise ImproperlyConfigured(
+                    'Invalid PAYFAST_MERCHANTS entry for {!r}: {}'.format(merchant_id, e))
+            if merchant_id == conf.MERCHANT_ID:
+                merchants[0] = merchant
+            else:
+                merchants.append(merchant)
+        return cls(merchants, conf.MERCHANT_ID)
+
+
+_registry = None  # type: Optional[MerchantRegistry]
+_registry_lock = threading.Lock()
+
+
+def get_registry():  # type: () -> MerchantRegistry
+    """
+    Return the process-wide merchant registry, building it on first use.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = MerchantRegistry.from_settings()
+    return _registry
+
+
+def reset():  # type: () -> None
+    """
+    Discard the registry, to rebuild it from the settings (mainly for tests).
+    """
+    global _registry
+    with _registry_lock:
+        _registry = None
+
+
+def get_merchant(merchant_id):  # type: (Optional[str]) -> Optional[Merchant]
+    """
+    Return the registered merchant with `merchant_id`, or None.
+    """
+    return get_registry().get(merchant_id)
@@ -0,0 +1,434 @@
+"""
+ITN metrics: counters and latency histograms, with a text exposition view.
+
+The notify view counts the ITNs it receives, accepts and rejects (by reason:
+see `payfast.forms.NotifyForm.rejection_reason`), and times the postbacks and
+its database work. The ITNs shed by admission control (see `payfast.admission`)
+are counted by reason. Metrics are kept per process, in per-thread shards, so
+updating them takes no locks.
+
+Mount the exposition view (Prometheus text format) with ``payfast.urls``, at
+``metrics/``, and enable it with `PAYFAST_METRICS_VIEW`. Protect the URL like
+any other internal endpoint.
+
+With several worker processes (gunicorn, uWSGI), set `PAYFAST_METRICS_DIR` to a
+directory shared by the workers: each worker writes its totals there (at most
+every `PAYFAST_METRICS_FLUSH_INTERVAL` seconds), and the view reports the sum
+of all the workers' files. Clear the directory when the service restarts.
+
+The files of workers that have exited are folded into one file
+(``payfast-metrics-exited.json``), so that their totals are kept when workers
+are recycled, and the directory does not grow. Workers are identified by their
+process id: only share the directory between the workers of one host.
+"""
+from __future__ import unicode_literals
+
+import errno
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from timeit import default_timer
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple  # noqa: F401
+
+import six
+from django.http import Http404, HttpResponse
+from six.moves import _thread
+
+from payfast import conf
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+#: Histogram bucket upper bounds, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Python 2 has no os.replace() (but POSIX os.rename() also replaces).
+_os_replace = getattr(os, 'replace', os.rename)
+
+
+class _Shards(object):
+    """
+    Per-thread cells of `size` numbers, summed on read.
+
+    Each cell is only written by its own thread, so updates need no lock.
+    Cells are keyed by thread id: a new thread may inherit a finished
+    thread's cell, and its totals, but never shares a cell with a live thread.
+    """
+
+    def __init__(self, size):  # type: (int) -> None
+        self._size = size
+        self._cells = {}  # type: Dict[int, List[float]]
+
+    def cell(self):  # type: () -> List[float]
+        ident = _thread.get_ident()
+        cell = self._cells.get(ident)
+        if cell is None:
+            cell = self._cells.setdefault(ident, [0] * self._size)
+        return cell
+
+    def totals(self):  # type: () -> List[float]
+        totals = [0] * self._size  # type: List[float]
+        for cell in list(self._cells.values()):
+            for (i, value) in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class Counter(object):
+    """
+    A monotonically increasing count.
+    """
+
+    def __init__(self):  # type: () -> None
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):  # type: (float) -> None
+        self._shards.cell()[0] += amount
+
+    def value(self):  # type: () -> float
+        return self._shards.totals()[0]
+
+
+class Histogram(object):
+    """
+    Counts of observations in fixed buckets, with their sum.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):  # type: (Sequence[float]) -> None
+        self.buckets = tuple(buckets)
+        # One cell per bucket, one for larger values, then the sum.
+        self._shards = _Shards(len(self.buckets) + 2)
+
+    def observe(self, value):  # type: (float) -> None
+        cell = self._shards.cell()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def value(self):  # type: () -> Dict[str, object]
+        totals = self._shards.totals()
+        return {'buckets': totals[:-1], 'sum': totals[-1]}
+
+
+class Family(object):
+    """
+    A named metric, with one `Counter` or `Histogram` per combination of label values.
+    """
+
+    def __init__(self, kind, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        # type: (str, str, str, Sequence[str], Sequence[float]) -> None
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._children = {}  # type: Dict[Tuple[str, ...], object]
+
+    def labels(self, **labels):  # type: (**str) -> object
+        key = tuple(labels[name] for name in self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(
+                key, Counter() if self.kind == 'counter' else Histogram(self.buckets))
+        return child
+
+    def inc(self, amount=1):  # type: (float) -> None
+        self.labels().inc(amount)  # type: ignore
+
+    def observe(self, value):  # type: (float) -> None
+        self.labels().observe(value)  # type: ignore
+
+    def clear(self):  # type: () -> None
+        self._children.clear()
+
+    def samples(self):  # type: () -> Dict[str, object]
+        """
+        Return the current values, by JSON-encoded label values.
+        """
+        return {json.dumps(list(key)): child.value()  # type: ignore
+                for (key, child) in list(self._children.items())}
+
+
+class Registry(object):
+
+    def __init__(self):  # type: () -> None
+        self.families = OrderedDict()  # type: Dict[str, Family]
+
+    def counter(self, name, documentation, label_names=()):
+        # type: (str, str, Sequence[str]) -> Family
+        return self._add(Family('counter', name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        # type: (str, str, Sequence[str], Sequence[float]) -> Family
+        return self._add(Family('histogram', name, documentation, label_names, buckets))
+
+    def _add(self, family):  # type: (Family) -> Family
+        self.families[family.name] = family
+        return family
+
+    def snapshot(self):  # type: () -> Dict[str, Dict[str, object]]
+        """
+        Return the current values of all metrics, in a JSON-compatible form.
+        """
+        return {name: family.samples() for (name, family) in self.families.items()}
+
+    def exposition(self, snapshot):  # type: (Dict[str, Dict[str, object]]) -> str
+        """
+        Render `snapshot` in the Prometheus text exposition format.
+        """
+        lines = []
+        for family in self.families.values():
+            lines.append('# HELP {} {}'.format(family.name, family.documentation))
+            lines.append('# TYPE {} {}'.format(family.name, family.kind))
+            for (key, value) in sorted(snapshot.get(family.name, {}).items()):
+                labels = list(zip(family.label_names, json.loads(key)))
+                if family.kind == 'counter':
+                    lines.append(_sample(family.name, labels, value))
+                    continue
+                cumulative = 0
+                bounds = [_number(bound) for bound in family.buckets] + ['+Inf']
+                for (bound, count) in zip(bounds, value['buckets']):  # type: ignore
+                    cumulative += count
+                    lines.append(_sample(family.name + '_bucket', labels + [('le', bound)],
+                                         cumulative))
+                lines.append(_sample(family.name + '_sum', labels, value['sum']))  # type: ignore
+                lines.append(_sample(family.name + '_count', labels, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value):  # type: (float) -> str
+    return repr(float(value)) if value != int(value) else '{:d}'.format(int(value))
+
+
+def _escape(value):  # type: (object) -> str
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):  # type: (str, List[Tuple[str, object]], float) -> str
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, _escape(v)) for (k, v) in labels) + '}'
+    return '{} {}'.format(name, _number(value))
+
+
+def merge(snapshots):
+    # type: (Iterable[Dict[str, Dict[str, object]]]) -> Dict[str, Dict[str, object]]
+    """
+    Sum snapshots (of different processes) into one.
+    """
+    merged = {}  # type: Dict[str, Dict[str, object]]
+    for snapshot in snapshots:
+        for (name, samples) in snapshot.items():
+            family = merged.setdefault(name, {})
+            for (key, value) in samples.items():
+                if key not in family:
+                    family[key] = value
+                elif isinstance(value, dict):
+                    total = family[key]  # type: Dict[str, object]
+                    buckets = zip(total['buckets'], value['buckets'])  # type: ignore
+                    family[key] = {
+                        'buckets': [a + b for (a, b) in buckets],
+                        'sum': total['sum'] + value['sum'],  # type: ignore
+                    }
+                else:
+                    family[key] = family[key] + value  # type: ignore
+    return merged
+
+
+#: The payfast metrics.
+REGISTRY = Registry()
+
+ITN_RECEIVED = REGISTRY.counter(
+    'payfast_itn_received_total', 'ITNs received by the notify view.')
+ITN_ACCEPTED = REGISTRY.counter(
+    'payfast_itn_accepted_total', 'ITNs accepted.')
+ITN_REJECTED = REGISTRY.counter(
+    'payfast_itn_rejected_total', 'ITNs rejected, by reason.', ['reason'])
+ITN_NOT_FOUND = REGISTRY.counter(
+    'payfast_itn_not_found_total', 'ITNs for unknown orders.')
+POSTBACK_SECONDS = REGISTRY.histogram(
+    'payfast_postback_seconds', 'Duration of postback validations.')
+ITN_DB_SECONDS = REGISTRY.histogram(
+    'payfast_itn_db_seconds', 'Database time of the notify view (order lookup and save).')
+ITN_SHED = REGISTRY.counter(
+    'payfast_itn_shed_total', 'ITNs shed by admission control, by reason.', ['reason'])
+
+
+def record_itn(verdict, reason=None, timings=None):
+    # type: (str, Optional[str], Optional[Dict[str, float]]) -> None
+    """
+    Count a processed ITN, with its rejection `reason`, and its stage `timings`
+    (in milliseconds, see `payfast.itn_log.StageTimer`).
+    """
+    # Avoid a circular import.
+    from payfast.models import PayFastITNLog
+
+    ITN_RECEIVED.inc()
+    if verdict == PayFastITNLog.VERDICT_ACCEPTED:
+        ITN_ACCEPTED.inc()
+    elif verdict == PayFastITNLog.VERDICT_REJECTED:
+        ITN_REJECTED.labels(reason=reason or 'unknown').inc()
+    else:
+        ITN_NOT_FOUND.inc()
+    if timings:
+        ITN_DB_SECONDS.observe(
+            sum(timings.get(stage, 0) for stage in ['lookup', 'save']) / 1000.0)
+    maybe_flush()
+
+
+_last_flush = [0.0]
+# Serialises the flushes of this process's threads.
+_flush_lock = threading.Lock()
+# Whether this process has checked for a file left by an exited process with its pid.
+_claimed = [False]
+
+_FILE_PREFIX = 'payfast-metrics-'
+EXITED_FILE = 'payfast-metrics-exited.json'
+_LOCK_FILE = 'payfast-metrics.lock'
+
+
+def reset():  # type: () -> None
+    """
+    Discard the collected metrics (mainly for tests).
+    """
+    for family in REGISTRY.families.values():
+        family.clear()
+    _last_flush[0] = 0.0
+    _claimed[0] = False
+
+
+def maybe_flush():  # type: () -> None
+    """
+    Write this process's metrics to `PAYFAST_METRICS_DIR`, if it is set and the
+    flush interval has passed.
+
+    This runs in the notify view, after the order is saved: failures are logged,
+    not raised.
+    """
+    if conf.METRICS_DIR and default_timer() - _last_flush[0] >= conf.METRICS_FLUSH_INTERVAL:
+        try:
+            flush()
+        except Exception:
+            logger.exception('Failed to write the PayFast metrics to %s', conf.METRICS_DIR)
+
+
+def _path(pid):  # type: (int) -> str
+    return os.path.join(conf.METRICS_DIR, '{}{}.json'.format(_FILE_PREFIX, pid))
+
+
+def _read(path):  # type: (str) -> Optional[Dict[str, Dict[str, object]]]
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        # Missing, or removed while listing.
+        return None
+
+
+def _write(path, snapshot):  # type: (str, Dict[str, Dict[str, object]]) -> None
+    # A temporary file of its own, so concurrent writers don't replace each other's.
+    (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.payfast-metrics-',
+                                       suffix='.tmp')
+    try:
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            # Python 2's json.dumps() returns bytes.
+            f.write(six.text_type(json.dumps(snapshot)))
+        # Readers never see a partly written (or missing) file.
+        _os_replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def flush():  # type: () -> None
+    with _flush_lock:
+        _last_flush[0] = default_timer()
+        if not os.path.isdir(conf.METRICS_DIR):
+            os.makedirs(conf.METRICS_DIR)
+        path = _path(os.getpid())
+        if not _claimed[0]:
+            # An exited process had our pid: keep its totals.
+            _claimed[0] = True
+            if os.path.exists(path):
+                fold([path])
+        _write(path, REGISTRY.snapshot())
+
+
+def _pid_exists(pid):  # type: (int) -> bool
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _worker_files():  # type: () -> Dict[int, str]
+    files = {}
+    for name in os.listdir(conf.METRICS_DIR):
+        pid = name[len(_FILE_PREFIX):-len('.json')]
+        if name.startswith(_FILE_PREFIX) and name.endswith('.json') and pid.isdigit():
+            files[int(pid)] = os.path.join(conf.METRICS_DIR, name)
+    return files
+
+
+def fold(paths):  # type: (Iterable[str]) -> None
+    """
+    Add the metrics files `paths` of exited processes to the exited file, and remove them.
+
+    This is serialised between processes with a lock file, where ``fcntl`` is
+    available: elsewhere, the files are left alone.
+    """
+    if fcntl is None:  # pragma: no cover
+        return
+    with io.open(os.path.join(conf.METRICS_DIR, _LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            exited_path = os.path.join(conf.METRICS_DIR, EXITED_FILE)
+            snapshots = [_read(exited_path) or {}]
+            folded = []
+            for path in paths:
+                # Another process may have folded it first.
+                snapshot = _read(path)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+                    folded.append(path)
+            if folded:
+                _write(exited_path, merge(snapshots))
+                for path in folded:
+                    os.remove(path)
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def collect():  # type: () -> Dict[str, Dict[str, object]]
+    """
+    Return the metrics of this process, or of all processes with `PAYFAST_METRICS_DIR`.
+    """
+    if not conf.METRICS_DIR:
+        return REGISTRY.snapshot()
+    flush()
+    exited = [path for (pid, path) in _worker_files().items()
+              if pid != os.getpid() and not _pid_exists(pid)]
+    if exited:
+        fold(exited)
+    paths = sorted(_worker_files().values()) + [os.path.join(conf.METRICS_DIR, EXITED_FILE)]
+    return merge(snapshot for snapshot in map(_read, paths) if snapshot is not None)
+
+
+def metrics_view(request):
+    """
+    Report the metrics in the Prometheus text format, if `PAYFAST_METRICS_VIEW` is enabled.
+    """
+    if not conf.METRICS_VIEW:
+        raise Http404('Metrics are disabled.')
+    return HttpResponse(REGISTRY.exposition(collect()), content_type=CONTENT_TYPE)
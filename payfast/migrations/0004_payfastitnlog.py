@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.0.13 on 2026-10-19 06:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payfast', '0003_update_payfastorder_m_payment_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayFastITNLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('m_payment_id', models.CharField(blank=True, db_index=True, max_length=100, null=True)),
+                ('received_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('source_ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('verdict', models.CharField(choices=[('accepted', 'Accepted'), ('rejected', 'Rejected'), ('not_found', 'Order not found')], max_length=20)),
+                ('errors', models.TextField(blank=True, default='')),
+                ('headers', models.TextField(blank=True, default='')),
+                ('body', models.BinaryField()),
+                ('timings', models.TextField(blank=True, default='')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='itn_logs', to='payfast.PayFastOrder')),
+            ],
+            options={
+                'verbose_name': 'PayFast ITN log entry',
+                'verbose_name_plural': 'PayFast ITN log',
+            },
+        ),
+    ]
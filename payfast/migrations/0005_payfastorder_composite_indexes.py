@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.0.13 on 2026-10-19 06:06
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('payfast', '0004_payfastitnlog'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='payfastorder',
+            index_together={('payment_status', 'created_at'), ('trusted', 'created_at'), ('user', 'created_at')},
+        ),
+    ]
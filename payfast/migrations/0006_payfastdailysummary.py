@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.0.13 on 2026-10-19 06:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payfast', '0005_payfastorder_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayFastDailySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('payment_status', models.CharField(blank=True, default='', max_length=20)),
+                ('merchant_id', models.CharField(max_length=15)),
+                ('count', models.IntegerField(default=0)),
+                ('amount_gross', models.DecimalField(decimal_places=2, default=0, max_digits=19)),
+                ('amount_fee', models.DecimalField(decimal_places=2, default=0, max_digits=19)),
+                ('amount_net', models.DecimalField(decimal_places=2, default=0, max_digits=19)),
+            ],
+            options={
+                'verbose_name': 'PayFast daily summary',
+                'verbose_name_plural': 'PayFast daily summaries',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='payfastdailysummary',
+            unique_together={('day', 'payment_status', 'merchant_id')},
+        ),
+    ]
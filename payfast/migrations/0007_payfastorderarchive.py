@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.0.13 on 2026-10-19 06:17
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('payfast', '0006_payfastdailysummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayFastOrderArchive',
+            fields=[
+                ('m_payment_id', models.CharField(blank=True, help_text="Unique transaction ID on the receiver's system.", max_length=100, null=True, unique=True)),
+                ('pf_payment_id', models.CharField(blank=True, help_text='Unique transaction ID on PayFast.', max_length=40, null=True, unique=True)),
+                ('payment_status', models.CharField(blank=True, help_text='The status of the payment.', max_length=20, null=True)),
+                ('item_name', models.CharField(help_text='The name of the item being charged for.', max_length=100)),
+                ('item_description', models.CharField(blank=True, help_text='The description of the item being charged for.', max_length=255, null=True)),
+                ('amount_gross', models.DecimalField(blank=True, decimal_places=2, help_text='The total amount which the payer paid.', max_digits=15, null=True)),
+                ('amount_fee', models.DecimalField(blank=True, decimal_places=2, help_text='The total in fees which was deducted from the amount.', max_digits=15, null=True)),
+                ('amount_net', models.DecimalField(blank=True, decimal_places=2, help_text="The net amount credited to the receiver's account.", max_digits=15, null=True)),
+                ('custom_str1', models.CharField(blank=True, max_length=255, null=True)),
+                ('custom_str2', models.CharField(blank=True, max_length=255, null=True)),
+                ('custom_str3', models.CharField(blank=True, max_length=255, null=True)),
+                ('custom_str4', models.CharField(blank=True, max_length=255, null=True)),
+                ('custom_str5', models.CharField(blank=True, max_length=255, null=True)),
+                ('custom_int1', models.IntegerField(blank=True, null=True)),
+                ('custom_int2', models.IntegerField(blank=True, null=True)),
+                ('custom_int3', models.IntegerField(blank=True, null=True)),
+                ('custom_int4', models.IntegerField(blank=True, null=True)),
+                ('custom_int5', models.IntegerField(blank=True, null=True)),
+                ('name_first', models.CharField(blank=True, help_text='First name of the payer.', max_length=100, null=True)),
+                ('name_last', models.CharField(blank=True, help_text='Last name of the payer.', max_length=100, null=True)),
+                ('email_address', models.CharField(blank=True, help_text='Email address of the payer.', max_length=100, null=True)),
+                ('merchant_id', models.CharField(help_text='The Merchant ID as given by the PayFast system.', max_length=15)),
+                ('signature', models.CharField(blank=True, help_text='A security signature of the transmitted data', max_length=32, null=True)),
+                ('request_ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('debug_info', models.CharField(blank=True, max_length=255, null=True)),
+                ('trusted', models.NullBooleanField(default=None)),
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'archived PayFast order',
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.0.13 on 2026-10-19 06:19
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payfast', '0007_payfastorderarchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payfastorder',
+            name='amount_fee_cents',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='payfastorder',
+            name='amount_gross_cents',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='payfastorder',
+            name='amount_net_cents',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='payfastorderarchive',
+            name='amount_fee_cents',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='payfastorderarchive',
+            name='amount_gross_cents',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='payfastorderarchive',
+            name='amount_net_cents',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+This migration fills in the integer cents columns added by 0008 for existing
+orders, one batch of primary keys at a time.
+"""
+# Generated by Django 2.0.13 on 2026-10-19 06:19
+from __future__ import unicode_literals
+
+from decimal import Decimal, ROUND_HALF_EVEN
+
+import django
+from django.db import migrations, models
+
+
+if django.VERSION < (1, 8):  # Django 1.7 compatibility: RunPython.noop was added in 1.8.
+    def noop(apps, schema_editor):
+        return None
+
+
+# Each row in a batch adds two query parameters per amount field to the UPDATE,
+# so keep batches well under SQLite's default limit of 999 variables per statement.
+BATCH_SIZE = 100
+AMOUNT_FIELDS = ['amount_gross', 'amount_fee', 'amount_net']
+
+
+def to_cents(amount):
+    """
+    Frozen copy of payfast.money.to_cents, for the DecimalField values.
+    """
+    if amount is None:
+        return None
+    return int(amount.quantize(Decimal('0.01'), rounding=ROUND_HALF_EVEN) * 100)
+
+
+def backfill_amount_cents(apps, schema_editor):
+    """
+    Set the cents columns from the amounts, with one UPDATE per batch
+    (or per order, before Django 1.8).
+    """
+    if django.VERSION < (1, 8):  # Django 1.7 compatibility: Case and When were added in 1.8.
+        Case = None
+    else:
+        from django.db.models import Case, Value, When
+
+    for model_name in ['PayFastOrder', 'PayFastOrderArchive']:
+        model = apps.get_model('payfast', model_name)
+        orders = model.objects.using(schema_editor.connection.alias).order_by('pk')
+        last_pk = None
+        while True:
+            batch = orders if last_pk is None else orders.filter(pk__gt=last_pk)
+            rows = list(batch.values_list('pk', *AMOUNT_FIELDS)[:BATCH_SIZE])
+            if not rows:
+                break
+            if Case is None:
+                for row in rows:
+                    orders.filter(pk=row[0]).update(**{
+                        name + '_cents': to_cents(row[i])
+                        for (i, name) in enumerate(AMOUNT_FIELDS, 1)
+                    })
+            else:
+                in_batch = orders.filter(pk__gte=rows[0][0], pk__lte=rows[-1][0])
+                in_batch.update(**{
+                    name + '_cents': Case(*[
+                        When(pk=row[0], then=Value(to_cents(row[i])))
+                        for row in rows if row[i] is not None
+                    ], default=Value(None), output_field=models.BigIntegerField())
+                    for (i, name) in enumerate(AMOUNT_FIELDS, 1)
+                })
+            last_pk = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payfast', '0008_amount_cents'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_amount_cents,
+            reverse_code=(noop if django.VERSION < (1, 8) else
+                          migrations.RunPython.noop),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+This migration adds the compact `payment_status_code` field, fills it in for
+existing orders one batch of primary keys at a time, and moves the status
+index to it.
+"""
+# Generated by Django 2.0.13 on 2026-10-19 06:22
+from __future__ import unicode_literals
+
+import django
+from django.conf import settings
+from django.db import migrations, models
+
+
+if django.VERSION < (1, 8):  # Django 1.7 compatibility: RunPython.noop was added in 1.8.
+    def noop(apps, schema_editor):
+        return None
+
+
+BATCH_SIZE = 1000
+
+# Frozen copy of payfast.models.PAYMENT_STATUS_CODES
+PAYMENT_STATUS_CODE_OTHER = 0
+PAYMENT_STATUS_CODES = [
+    ('COMPLETE', 1),
+    ('PENDING', 2),
+    ('FAILED', 3),
+    ('CANCELLED', 4),
+]
+
+
+def backfill_payment_status_code(apps, schema_editor):
+    """
+    Set payment_status_code from payment_status, with one UPDATE per distinct status in each batch.
+
+    Statuses are normalised like payfast.models.payment_status_code(): stripped
+    and upper-cased in Python, so the codes match those set by save().
+    """
+    codes = dict(PAYMENT_STATUS_CODES)
+    for model_name in ['PayFastOrder', 'PayFastOrderArchive']:
+        model = apps.get_model('payfast', model_name)
+        orders = (model.objects.using(schema_editor.connection.alias)
+                  .exclude(payment_status__isnull=True).exclude(payment_status='')
+                  .order_by('pk'))
+        pks = orders.values_list('pk', flat=True)
+        last_pk = None
+        while True:
+            batch = list((pks if last_pk is None else pks.filter(pk__gt=last_pk))[:BATCH_SIZE])
+            if not batch:
+                break
+            in_batch = orders.filter(pk__gte=batch[0], pk__lte=batch[-1])
+            statuses = set(in_batch.values_list('payment_status', flat=True))
+            for status in statuses:
+                code = codes.get(status.strip().upper(), PAYMENT_STATUS_CODE_OTHER)
+                in_batch.filter(payment_status=status).update(payment_status_code=code)
+            last_pk = batch[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('payfast', '0009_backfill_amount_cents'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payfastorder',
+            name='payment_status_code',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(1, 'Complete'), (2, 'Pending'), (3, 'Failed'), (4, 'Cancelled'), (0, 'Other')], editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='payfastorderarchive',
+            name='payment_status_code',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(1, 'Complete'), (2, 'Pending'), (3, 'Failed'), (4, 'Cancelled'), (0, 'Other')], editable=False, null=True),
+        ),
+        migrations.RunPython(
+            backfill_payment_status_code,
+            reverse_code=(noop if django.VERSION < (1, 8) else
+                          migrations.RunPython.noop),
+        ),
+        migrations.AlterIndexTogether(
+            name='payfastorder',
+            index_together={('user', 'created_at'), ('trusted', 'created_at'), ('payment_status_code', 'created_at')},
+        ),
+    ]
@@ -1,27 +1,209 @@
 from __future__ import unicode_literals
 
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta  # noqa: F401
+from decimal import Decimal  # noqa: F401
+from typing import Dict, Iterator, List, Optional, Sequence, Union  # noqa: F401
+
 import six
+from six.moves import reduce
 from django.db import models
+from django.db.models import Q, Sum
 from django.conf import settings
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
+from payfast import money
 from payfast import readable_models
 
 
+#: Values of `PayFastOrder.payment_status` sent by PayFast.
+PAYMENT_STATUS_COMPLETE = 'COMPLETE'
+PAYMENT_STATUS_PENDING = 'PENDING'
+PAYMENT_STATUS_FAILED = 'FAILED'
+PAYMENT_STATUS_CANCELLED = 'CANCELLED'
+
+#: Compact codes for `PayFastOrder.payment_status`, stored in `payment_status_code`.
+#: Unknown statuses are stored as `PAYMENT_STATUS_CODE_OTHER`, with the raw string.
+PAYMENT_STATUS_CODE_OTHER = 0
+PAYMENT_STATUS_CODES = OrderedDict([
+    (PAYMENT_STATUS_COMPLETE, 1),
+    (PAYMENT_STATUS_PENDING, 2),
+    (PAYMENT_STATUS_FAILED, 3),
+    (PAYMENT_STATUS_CANCELLED, 4),
+])
+PAYMENT_STATUS_CODE_CHOICES = [
+    (code, status.capitalize()) for (status, code) in PAYMENT_STATUS_CODES.items()
+] + [(PAYMENT_STATUS_CODE_OTHER, 'Other')]
+
+
+def payment_status_code(payment_status):  # type: (Optional[str]) -> Optional[int]
+    """
+    Return the code of `payment_status`, or None if there is no status.
+    """
+    if not payment_status:
+        return None
+    return PAYMENT_STATUS_CODES.get(payment_status.strip().upper(), PAYMENT_STATUS_CODE_OTHER)
+
+
+def payment_status_q(payment_status):  # type: (Optional[str]) -> Q
+    """
+    Return a filter for orders with `payment_status` that can use `payment_status_code` indexes.
+    """
+    code = payment_status_code(payment_status)
+    if code is None:
+        return Q(payment_status_code__isnull=True)
+    elif code == PAYMENT_STATUS_CODE_OTHER:
+        return Q(payment_status_code=code, payment_status=payment_status)
+    return Q(payment_status_code=code)
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+#: The amount fields, each of which has an integer cents counterpart (see `payfast.money`).
+AMOUNT_FIELDS = ['amount_gross', 'amount_fee', 'amount_net']
+
+
+class PayFastOrderQuerySet(models.QuerySet):
+    """
+    Status helpers and bulk state transitions for `PayFastOrder`.
+
+    The helpers filter on ``payment_status_code`` or ``trusted`` by equality, so that
+    (combined with a ``created_at`` range or ordering) they can use the composite
+    ``(payment_status_code, created_at)`` and ``(trusted, created_at)`` indexes.
+    """
+
+    def trusted(self):
+        """
+        Orders with a valid ITN.
+        """
+        return self.filter(trusted=True)
+
+    def untrusted(self):
+        """
+        Orders whose latest ITN was rejected.
+        """
+        return self.filter(trusted=False)
+
+    def with_status(self, payment_status):  # type: (str) -> PayFastOrderQuerySet
+        """
+        Orders with a valid ITN reporting `payment_status`.
+        """
+        return self.filter(payment_status_q(payment_status), trusted=True)
+
+    def complete(self):
+        return self.with_status(PAYMENT_STATUS_COMPLETE)
+
+    def pending(self):
+        return self.with_status(PAYMENT_STATUS_PENDING)
+
+    def stale(self, older_than):  # type: (Union[timedelta, datetime]) -> PayFastOrderQuerySet
+        """
+        Orders that never received an ITN, and were created before `older_than`
+        (a datetime, or a timedelta before now).
+        """
+        if isinstance(older_than, timedelta):
+            older_than = timezone.now() - older_than
+        return self.filter(trusted__isnull=True, created_at__lt=older_than)
+
+    def transition(
+            self,
+            payment_status,  # type: str
+            from_statuses=None,  # type: Optional[Sequence[Optional[str]]]
+            batch_size=DEFAULT_BATCH_SIZE,  # type: int
+    ):  # type: (...) -> int
+        """
+        Set the `payment_status` of these orders, and return the number changed.
+
+        If `from_statuses` is given, only orders currently in one of those
+        statuses (None for no status) are changed.
+        """
+        condition = ~payment_status_q(payment_status)
+        if from_statuses is not None:
+            condition = reduce(lambda a, b: a | b, [payment_status_q(s) for s in from_statuses])
+        return self._update_batched(condition, batch_size, payment_status=payment_status,
+                                    payment_status_code=payment_status_code(payment_status))
+
+    def mark_untrusted(self, debug_info, batch_size=DEFAULT_BATCH_SIZE):
+        # type: (str, int) -> int
+        """
+        Mark these orders as untrusted (unless they already are), recording
+        `debug_info` as the reason, and return the number changed.
+        """
+        condition = ~Q(trusted=False)
+        return self._update_batched(condition, batch_size,
+                                    trusted=False, debug_info=debug_info[:255])
+
+    def _update_batched(self, condition, batch_size, **values):  # type: (Q, int, **object) -> int
+        """
+        Update the orders matching `condition` with one ``UPDATE`` per batch of
+        `batch_size` primary keys, and return the number of rows changed.
+
+        Like `QuerySet.update`, this does not call `save()` or send signals,
+        and doesn't update `PayFastDailySummary`: see `payfast.summaries`.
+        """
+        values.setdefault('updated_at', timezone.now())
+        # Leave the database to the router (the primary), unless one was chosen explicitly.
+        orders = self.model._base_manager.using(self._db)
+        changed = 0
+        for batch in self.filter(condition).pk_batches(batch_size):
+            # Check the condition again, in case an order changed since it was selected.
+            changed += orders.filter(condition, pk__in=batch).update(**values)
+        return changed
+
+    def amount_totals(self):  # type: () -> Dict[str, Optional[Decimal]]
+        """
+        Return the total of each amount field of these orders.
+
+        The totals are summed from the integer cents columns, which is cheaper
+        than summing decimals on most databases.
+        """
+        totals = self.aggregate(**{name: Sum(name + '_cents') for name in AMOUNT_FIELDS})
+        return {name: money.from_cents(total) for (name, total) in totals.items()}
+
+    def pk_batches(self, batch_size=DEFAULT_BATCH_SIZE):  # type: (int) -> Iterator[List[int]]
+        """
+        Yield the primary keys of these orders in ascending order, `batch_size` at a time.
+
+        Each batch is selected after the previous one was processed (starting after
+        its last primary key), so processing may delete or update the orders.
+        """
+        pks = self.order_by('pk').values_list('pk', flat=True)
+        last_pk = None
+        while True:
+            batch = list((pks if last_pk is None else pks.filter(pk__gt=last_pk))[:batch_size])
+            if not batch:
+                return
+            yield batch
+            last_pk = batch[-1]
+
+
 @python_2_unicode_compatible
 # see http://djangosnippets.org/snippets/2180/
-class PayFastOrder(six.with_metaclass(readable_models.ModelBase, models.Model)):
+class AbstractPayFastOrder(six.with_metaclass(readable_models.ModelBase, models.Model)):
+    """
+    The fields shared by `PayFastOrder` and `PayFastOrderArchive`.
+    """
 
     # Transaction Details
     m_payment_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
     pf_payment_id = models.CharField(max_length=40, unique=True, null=True, blank=True)
     payment_status = models.CharField(max_length=20, null=True, blank=True)
+    # Kept in step with payment_status by save(), for compact indexes and filters.
+    payment_status_code = models.PositiveSmallIntegerField(
+        null=True, blank=True, editable=False, choices=PAYMENT_STATUS_CODE_CHOICES)
     item_name = models.CharField(max_length=100)
     item_description = models.CharField(max_length=255, null=True, blank=True)
     amount_gross = models.DecimalField(max_digits=15, decimal_places=2, null=True, blank=True)
     amount_fee = models.DecimalField(max_digits=15, decimal_places=2, null=True, blank=True)
     amount_net = models.DecimalField(max_digits=15, decimal_places=2, null=True, blank=True)
 
+    # The amounts in integer cents, kept in step by save(): see payfast.money
+    amount_gross_cents = models.BigIntegerField(null=True, blank=True, editable=False)
+    amount_fee_cents = models.BigIntegerField(null=True, blank=True, editable=False)
+    amount_net_cents = models.BigIntegerField(null=True, blank=True, editable=False)
+
     # The series of 5 custom string variables (custom_str1, custom_str2...)
     # originally passed by the receiver during the payment request.
     custom_str1 = models.CharField(max_length=255, null=True, blank=True)
@@ -58,6 +240,8 @@ class PayFastOrder(six.with_metaclass(readable_models.ModelBase, models.Model)):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
                              on_delete=models.CASCADE)
 
+    objects = PayFastOrderQuerySet.as_manager()
+
     class HelpText:
         m_payment_id = "Unique transaction ID on the receiver's system."
         pf_payment_id = "Unique transaction ID on PayFast."
@@ -75,13 +259,138 @@ class PayFastOrder(six.with_metaclass(readable_models.ModelBase, models.Model)):
         merchant_id = "The Merchant ID as given by the PayFast system."
         signature = "A security signature of the transmitted data"
 
+    def save(self, *args, **kwargs):
+        # Keep the derived fields in step.
+        derived = [(name, name + '_cents', money.to_cents) for name in AMOUNT_FIELDS]
+        derived.append(('payment_status', 'payment_status_code', payment_status_code))
+        update_fields = kwargs.get('update_fields')
+        for (name, derived_name, derive) in derived:
+            setattr(self, derived_name, derive(getattr(self, name)))
+            if update_fields is not None and name in update_fields:
+                kwargs['update_fields'] = list(kwargs['update_fields']) + [derived_name]
+        super(AbstractPayFastOrder, self).save(*args, **kwargs)
+
     def __str__(self):
-        return 'PayFastOrder {id} ({created_at})'.format(
+        return '{model} {id} ({created_at})'.format(
+            model=type(self).__name__,
             # Transitional code: Show the pk if m_payment_id is missing.
             id=('pk={}'.format(self.pk) if self.m_payment_id is None else
                 self.m_payment_id),
             created_at=self.created_at,
         )
 
+    class Meta:
+        abstract = True
+
+
+class PayFastOrder(AbstractPayFastOrder):
+
     class Meta:
         verbose_name = 'PayFast order'
+        # Composite indexes for the admin's list filters and date drill-down,
+        # and for reporting scans of orders by status and date.
+        index_together = [
+            ('payment_status_code', 'created_at'),
+            ('trusted', 'created_at'),
+            ('user', 'created_at'),
+        ]
+
+
+class PayFastOrderArchive(AbstractPayFastOrder):
+    """
+    Settled orders moved out of `PayFastOrder`, to keep the live table small.
+
+    Archived orders keep their `PayFastOrder` primary key and timestamps.
+    See `payfast.archive`.
+    """
+
+    id = models.IntegerField(primary_key=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = 'archived PayFast order'
+
+
+@python_2_unicode_compatible
+class PayFastITNLog(models.Model):
+    """
+    Append-only record of a received ITN submission.
+
+    Unlike `PayFastOrder.debug_info`, this keeps the full raw request body
+    (zlib-compressed), and is never updated after it is written.
+    See `payfast.itn_log` for how entries are recorded.
+    """
+
+    VERDICT_ACCEPTED = 'accepted'
+    VERDICT_REJECTED = 'rejected'
+    VERDICT_NOT_FOUND = 'not_found'
+    VERDICT_CHOICES = [
+        (VERDICT_ACCEPTED, 'Accepted'),
+        (VERDICT_REJECTED, 'Rejected'),
+        (VERDICT_NOT_FOUND, 'Order not found'),
+    ]
+
+    order = models.ForeignKey(PayFastOrder, null=True, blank=True, related_name='itn_logs',
+                              on_delete=models.SET_NULL)
+    m_payment_id = models.CharField(max_length=100, null=True, blank=True, db_index=True)
+    received_at = models.DateTimeField(default=timezone.now, db_index=True)
+    source_ip = models.GenericIPAddressField(null=True, blank=True)
+    verdict = models.CharField(max_length=20, choices=VERDICT_CHOICES)
+    errors = models.TextField(blank=True, default='')
+
+    # JSON-encoded request.META values (see `settings.PAYFAST_ITN_LOG_HEADERS`)
+    headers = models.TextField(blank=True, default='')
+    # zlib-compressed raw request body
+    body = models.BinaryField()
+    # JSON-encoded mapping of processing stage name to elapsed milliseconds
+    timings = models.TextField(blank=True, default='')
+
+    def raw_body(self):  # type: () -> bytes
+        """
+        Return the decompressed raw request body.
+        """
+        return zlib.decompress(bytes(self.body))
+
+    def __str__(self):
+        return 'PayFast ITN {id} ({verdict}, {received_at})'.format(
+            id=self.m_payment_id,
+            verdict=self.verdict,
+            received_at=self.received_at,
+        )
+
+    class Meta:
+        verbose_name = 'PayFast ITN log entry'
+        verbose_name_plural = 'PayFast ITN log'
+
+
+@python_2_unicode_compatible
+class PayFastDailySummary(models.Model):
+    """
+    Running totals of trusted orders, per creation day, payment status and merchant.
+
+    Maintained incrementally as ITNs are processed, and rebuilt from scratch by
+    the ``payfast_rebuild_summaries`` command. See `payfast.summaries`.
+    """
+
+    day = models.DateField()
+    payment_status = models.CharField(max_length=20, blank=True, default='')
+    merchant_id = models.CharField(max_length=15)
+
+    count = models.IntegerField(default=0)
+    amount_gross = models.DecimalField(max_digits=19, decimal_places=2, default=0)
+    amount_fee = models.DecimalField(max_digits=19, decimal_places=2, default=0)
+    amount_net = models.DecimalField(max_digits=19, decimal_places=2, default=0)
+
+    def __str__(self):
+        return 'PayFast summary {day} {payment_status} ({merchant_id})'.format(
+            day=self.day,
+            payment_status=self.payment_status,
+            merchant_id=self.merchant_id,
+        )
+
+    class Meta:
+        verbose_name = 'PayFast daily summary'
+        verbose_name_plural = 'PayFast daily summaries'
+        unique_together = [('day', 'payment_status', 'merchant_id')]
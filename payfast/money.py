@@ -0,0 +1,98 @@
+"""
+Integer cents representation of PayFast amounts.
+
+PayFast amounts have two decimal places, and reach this package as strings
+(ITN and export data), ints and Decimals (checkout and model values).
+Converting them all to integer cents makes comparisons exact regardless of
+the source type, and lets the database sum plain integers instead of decimals
+(see `PayFastOrderQuerySet.amount_totals`).
+
+Like `api`, this module can be used without Django.
+"""
+from __future__ import unicode_literals
+
+from decimal import Decimal, ROUND_HALF_EVEN
+from typing import Optional, Union  # noqa: F401
+
+import six
+
+
+Amount = Union[six.text_type, int, float, Decimal, None]
+
+_CENT = Decimal('0.01')
+_HUNDRED = Decimal(100)
+
+
+def to_cents(value):  # type: (Amount) -> Optional[int]
+    """
+    Convert an amount to integer cents, or None for a missing amount.
+
+    Amounts with more than two decimal places are rounded to the cent,
+    half to even (like `DecimalField`).
+
+    :raise ValueError: If `value` is not a valid amount.
+    """
+    # The common cases first: Decimal values from models and forms, and ITN strings.
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            raise ValueError('Invalid amount: {!r}'.format(value))
+        scaled = value * _HUNDRED
+        if scaled == scaled.to_integral_value():
+            return int(scaled)
+        return int(value.quantize(_CENT, rounding=ROUND_HALF_EVEN) * _HUNDRED)
+    if isinstance(value, six.string_types):
+        if not value:
+            return None
+        (whole, _, fraction) = value.strip().partition('.')
+        negative = whole.startswith('-')
+        digits = whole[1:] if negative else whole
+        if digits.isdigit() and len(fraction) <= 2 and (fraction.isdigit() or not fraction):
+            cents = int(digits) * 100 + int(fraction.ljust(2, '0') or 0)
+            return -cents if negative else cents
+        return to_cents(_parse_decimal(value))
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError('Invalid amount: {!r}'.format(value))
+    if isinstance(value, six.integer_types):
+        return value * 100
+    if isinstance(value, float):
+        return to_cents(Decimal(repr(value)))
+    raise ValueError('Invalid amount: {!r}'.format(value))
+
+
+def _parse_decimal(text):  # type: (six.text_type) -> Decimal
+    try:
+        value = Decimal(text.strip())
+    except ArithmeticError:
+        raise ValueError('Invalid amount: {!r}'.format(text))
+    if not value.is_finite():
+        raise ValueError('Invalid amount: {!r}'.format(text))
+    return value
+
+
+def from_cents(cents):  # type: (Optional[int]) -> Optional[Decimal]
+    """
+    Convert integer cents to a two-place `Decimal` amount.
+    """
+    if cents is None:
+        return None
+    return Decimal(cents).scaleb(-2)
+
+
+def format_cents(cents):  # type: (int) -> six.text_type
+    """
+    Format integer cents as a PayFast amount string, like ``'-2.80'``.
+    """
+    (whole, part) = divmod(abs(cents), 100)
+    return '{}{}.{:02d}'.format('-' if cents < 0 else '', whole, part)
+
+
+def format_amount(value):  # type: (Amount) -> six.text_type
+    """
+    Format an amount as a PayFast amount string, with two decimal places.
+    """
+    cents = to_cents(value)
+    if cents is None:
+        raise ValueError('Missing amount')
+    return format_cents(cents)
@@ -0,0 +1,320 @@
+"""
+Sampling profiler for the payfast views, for use under production traffic.
+
+Profiling every request of a site is too noisy (and too slow): this profiles
+only a sampled fraction of the requests to selected views, aggregates the
+results in memory, and periodically dumps them to files.
+
+To profile the notify view, add the middleware::
+
+    MIDDLEWARE += ['payfast.profiling.ProfilingMiddleware']
+    PAYFAST_PROFILE_RATE = 0.01  # Profile 1% of the requests.
+
+and to profile your checkout view, decorate it::
+
+    from payfast.profiling import profiled
+
+    @profiled('checkout')
+    def checkout(request):
+        ...
+
+Settings:
+
+* `PAYFAST_PROFILE_RATE`: The fraction of requests to profile (default: 0, off).
+* `PAYFAST_PROFILE_MODE`: ``'cprofile'`` (default) to profile with `cProfile`,
+  and dump `pstats` files, or ``'stack'`` to sample the request thread's stack
+  every `PAYFAST_PROFILE_STACK_INTERVAL` seconds (default 0.005) and dump
+  collapsed stacks, for flame graphs.
+* `PAYFAST_PROFILE_URL_NAMES`: The URL names the middleware profiles
+  (default: ``['payfast_notify']``).
+* `PAYFAST_PROFILE_DIR`: Where to dump the profiles (default: a ``payfast-profiles``
+  directory in the system's temporary directory).
+* `PAYFAST_PROFILE_DUMP_INTERVAL`: Seconds between dumps (default 60).
+
+Each process dumps one file per profile name, ``payfast-<name>-<pid>.pstats``
+(or ``.collapsed``), with the totals since it started. Combine them with
+`pstats.Stats.add`, or by concatenating the collapsed stack files.
+
+A request that is not sampled costs one random number.
+"""
+from __future__ import unicode_literals
+
+import cProfile
+import os
+import pstats
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from timeit import default_timer
+from typing import Callable, Dict, List, Optional  # noqa: F401
+
+from payfast import conf
+
+# Django 1.10 introduces new-style middleware
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:  # pragma: no cover
+    MiddlewareMixin = object
+
+
+MODE_CPROFILE = 'cprofile'
+MODE_STACK = 'stack'
+
+# Python 2 has no os.replace() (but POSIX os.rename() also replaces).
+_os_replace = getattr(os, 'replace', os.rename)
+
+
+def _collapse(frame):  # type: (...) -> str
+    """
+    Return the stack of `frame` in collapsed form: ``module.function;...``, outermost first.
+    """
+    names = []
+    while frame is not None:
+        names.append('{}.{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(object):
+    """
+    Sample the stacks of registered threads every `interval` seconds, on a background thread.
+
+    The background thread only wakes up while some thread is registered.
+    """
+
+    def __init__(self, interval):  # type: (float) -> None
+        self.interval = interval
+        self._targets = {}  # type: Dict[int, Counter]
+        self._condition = threading.Condition()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def start(self, ident):  # type: (int) -> None
+        with self._condition:
+            self._targets[ident] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='payfast-profiler')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self, ident):  # type: (int) -> Counter
+        """
+        Stop sampling the thread `ident`, and return its sampled stacks.
+        """
+        with self._condition:
+            return self._targets.pop(ident)
+
+    def _run(self):  # type: () -> None
+        while True:
+            with self._condition:
+                while not self._targets:
+                    self._condition.wait()
+            self._sample()
+            # Sleeping outside the lock keeps start() and stop() cheap.
+            time.sleep(self.interval)
+
+    def _sample(self):  # type: () -> None
+        frames = sys._current_frames()
+        with self._condition:
+            for (ident, stacks) in self._targets.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[_collapse(frame)] += 1
+
+
+class ProfileStore(object):
+    """
+    Aggregate profiles by name in memory, and dump them every `interval` seconds.
+    """
+
+    def __init__(self, directory, interval, clock=default_timer):
+        # type: (str, float, Callable[[], float]) -> None
+        self.directory = directory
+        self.interval = interval
+        self._clock = clock
+        self._stats = {}  # type: Dict[str, pstats.Stats]
+        self._stacks = {}  # type: Dict[str, Counter]
+        self._lock = threading.Lock()
+        self._last_dump = clock()
+
+    def add_profile(self, name, profile):  # type: (str, cProfile.Profile) -> None
+        stats = pstats.Stats(profile)
+        with self._lock:
+            if name in self._stats:
+                self._stats[name].add(stats)
+            else:
+                self._stats[name] = stats
+        self._maybe_dump()
+
+    def add_stacks(self, name, stacks):  # type: (str, Counter) -> None
+        with self._lock:
+            self._stacks.setdefault(name, Counter()).update(stacks)
+        self._maybe_dump()
+
+    def _maybe_dump(self):  # type: () -> None
+        if self._clock() - self._last_dump >= self.interval:
+            self.dump()
+
+    def dump(self):  # type: () -> List[str]
+        """
+        Write the profiles to the directory now, and return their paths.
+        """
+        paths = []
+        with self._lock:
+            self._last_dump = self._clock()
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for (name, stats) in self._stats.items():
+                path = self._path(name, 'pstats')
+                stats.dump_stats(path + '.tmp')
+                paths.append(self._replace(path))
+            for (name, stacks) in self._stacks.items():
+                path = self._path(name, 'collapsed')
+                with open(path + '.tmp', 'w') as f:
+                    for (stack, count) in sorted(stacks.items()):
+                        f.write('{} {}\n'.format(stack, count))
+                paths.append(self._replace(path))
+        return paths
+
+    def _path(self, name, extension):  # type: (str, str) -> str
+        return os.path.join(self.directory, 'payfast-{}-{}.{}'.format(name, os.getpid(), extension))
+
+    @staticmethod
+    def _replace(path):  # type: (str) -> str
+        # Readers never see a partly written (or missing) file.
+        _os_replace(path + '.tmp', path)
+        return path
+
+
+_store = None  # type: Optional[ProfileStore]
+_sampler = None  # type: Optional[StackSampler]
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_store():  # type: () -> ProfileStore
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                directory = conf.PROFILE_DIR or os.path.join(tempfile.gettempdir(),
+                                                             'payfast-profiles')
+                _store = ProfileStore(directory, conf.PROFILE_DUMP_INTERVAL)
+    return _store
+
+
+def _get_sampler():  # type: () -> StackSampler
+    global _sampler
+    if _sampler is None:
+        with _lock:
+            if _sampler is None:
+                _sampler = StackSampler(conf.PROFILE_STACK_INTERVAL)
+    return _sampler
+
+
+def reset():  # type: () -> None
+    """
+    Discard the collected profiles, and the settings read from them (mainly for tests).
+    """
+    global _store, _sampler
+    with _lock:
+        (_store, _sampler) = (None, None)
+
+
+class Session(object):
+    """
+    An in-progress profile of one request (see `start`).
+    """
+
+    def __init__(self, name):  # type: (str) -> None
+        self.name = name
+        self.profile = None  # type: Optional[cProfile.Profile]
+        self.thread_ident = None  # type: Optional[int]
+
+
+def start(name):  # type: (str) -> Optional[Session]
+    """
+    Decide whether to profile the current request, and if so, start profiling it.
+
+    Return the session to pass to `finish`, or None if the request is not sampled
+    (or the thread is already being profiled).
+    """
+    rate = conf.PROFILE_RATE
+    if not rate or (rate < 1 and random.random() >= rate):
+        return None
+    if getattr(_local, 'active', False):
+        return None
+    session = Session(name)
+    if conf.PROFILE_MODE == MODE_STACK:
+        session.thread_ident = threading.current_thread().ident
+        _get_sampler().start(session.thread_ident)
+    else:
+        session.profile = cProfile.Profile()
+        session.profile.enable()
+    _local.active = True
+    return session
+
+
+def finish(session):  # type: (Session) -> None
+    """
+    Stop profiling, and add the profile to the store.
+    """
+    _local.active = False
+    if session.profile is not None:
+        session.profile.disable()
+        get_store().add_profile(session.name, session.profile)
+    else:
+        get_store().add_stacks(session.name, _get_sampler().stop(session.thread_ident))
+
+
+def profiled(name=None):  # type: (Optional[str]) -> Callable[[Callable], Callable]
+    """
+    Decorate a view (or any function) to profile a sample of its calls, under
+    `name` (default: the function's name).
+    """
+    def decorator(fn):  # type: (Callable) -> Callable
+        label = name or fn.__name__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            session = start(label)
+            if session is None:
+                return fn(*args, **kwargs)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                finish(session)
+        return wrapper
+    return decorator
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+    Profile a sample of the requests to the views named in `PAYFAST_PROFILE_URL_NAMES`,
+    under their URL name.
+
+    The profile covers the view and the middleware after this one.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.url_name in conf.PROFILE_URL_NAMES:
+            request._payfast_profile = start(match.url_name)
+
+    def process_exception(self, request, exception):
+        self._finish(request)
+
+    def process_response(self, request, response):
+        self._finish(request)
+        return response
+
+    @staticmethod
+    def _finish(request):
+        session = getattr(request, '_payfast_profile', None)
+        if session is not None:
+            request._payfast_profile = None
+            finish(session)
@@ -0,0 +1,76 @@
+"""
+pytest plugin: resource budget fixtures for the payfast entry points.
+
+Enable it in your ``conftest.py``::
+
+    pytest_plugins = ['payfast.pytest_plugin']
+
+or with ``pytest -p payfast.pytest_plugin``. Then::
+
+    from payfast.views import ITN_BUDGETS
+
+    def test_notify(client, payfast_budget):
+        with payfast_budget(ITN_BUDGETS['accepted']):
+            client.post('/payfast/notify/', data)
+
+or hold a whole test to a budget with the ``payfast_budget`` marker::
+
+    @pytest.mark.payfast_budget(ITN_BUDGETS['accepted'])
+    def test_notify(client):
+        client.post('/payfast/notify/', data)
+
+The marker takes the `databases` of `payfast.testing.record_usage` as a keyword.
+``--payfast-budget-time-factor`` scales the time budgets (see `payfast.testing`).
+The database fixtures come from pytest-django, as usual.
+"""
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+
+from payfast import testing
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--payfast-budget-time-factor', type=float, default=None,
+        help='Scale the time budgets of the payfast entry points by this factor.')
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'payfast_budget(budget, databases=None): '
+                   'fail the test if it exceeds the payfast.budgets.Budget.')
+    factor = config.getoption('--payfast-budget-time-factor')
+    if factor is not None:
+        os.environ['PAYFAST_BUDGET_TIME_FACTOR'] = str(factor)
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    marker = item.get_closest_marker('payfast_budget')
+    if marker is None:
+        yield
+        return
+    with testing.record_usage(marker.kwargs.get('databases')) as usage:
+        outcome = yield
+    # Don't hide the test's own failure.
+    if outcome.excinfo is None:
+        testing.check_budget(usage, marker.args[0])
+
+
+@pytest.fixture
+def payfast_budget():
+    """
+    `payfast.testing.assert_budget`: check a block against a `payfast.budgets.Budget`.
+    """
+    return testing.assert_budget
+
+
+@pytest.fixture
+def payfast_usage():
+    """
+    `payfast.testing.record_usage`: record a block's queries, postbacks and wall time.
+    """
+    return testing.record_usage
@@ -0,0 +1,216 @@
+"""
+Reconciliation of PayFast transaction history exports against `PayFastOrder`.
+
+The export is streamed in chunks: each chunk's orders are fetched with one
+`in_bulk` lookup per ID field and table (instead of a query per row), so memory use is
+bounded by the chunk size. This is the implementation of the `payfast_reconcile`
+management command, which adds resumable checkpoints on top.
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+from collections import namedtuple, OrderedDict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple  # noqa: F401
+
+import six
+
+from payfast import archive
+from payfast import money
+from payfast.models import AbstractPayFastOrder  # noqa: F401
+
+
+#: The default mapping of `PayFastOrder` fields to transaction history CSV columns.
+DEFAULT_COLUMNS = OrderedDict([
+    ('pf_payment_id', 'PF Payment ID'),
+    ('m_payment_id', 'M Payment ID'),
+    ('amount_gross', 'Gross'),
+    ('amount_fee', 'Fee'),
+    ('amount_net', 'Net'),
+    ('payment_status', 'Status'),
+])
+
+#: Fields compared between the export and the order, if their column is present.
+COMPARED_FIELDS = ['amount_gross', 'amount_fee', 'amount_net', 'payment_status']
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# Python 2 has no os.replace() (but POSIX os.rename() also replaces).
+_replace = getattr(os, 'replace', os.rename)
+
+#: Discrepancy kinds.
+MISSING = 'missing'
+MISMATCH = 'mismatch'
+UNTRUSTED = 'untrusted'
+
+
+#: A reconciliation problem with the export row at `row_number` (1-based, excluding the header).
+#: `details` describes the problem.
+Discrepancy = namedtuple('Discrepancy', [
+    'kind', 'row_number', 'pf_payment_id', 'm_payment_id', 'details',
+])
+
+
+def _in_bulk(field_name, values):
+    # type: (str, Iterable[str]) -> Dict[str, AbstractPayFastOrder]
+    # Exports can include archived orders: see payfast.archive.
+    return archive.history.in_bulk(
+        [value for value in values if value], field_name,
+        only=['pf_payment_id', 'm_payment_id', 'trusted'] + COMPARED_FIELDS)
+
+
+def _normalise(field_name, value):  # type: (str, Optional[object]) -> Optional[object]
+    if value is None or value == '':
+        return None
+    if field_name == 'payment_status':
+        return six.text_type(value).strip().upper()
+    if isinstance(value, six.string_types):
+        value = value.replace(',', '')
+    try:
+        return money.to_cents(value)
+    except ValueError:
+        return six.text_type(value)
+
+
+def _display(value):  # type: (Optional[object]) -> object
+    # Amounts are normalised to integer cents.
+    return money.format_cents(value) if isinstance(value, six.integer_types) else value
+
+
+def compare(
+        row,  # type: Mapping[str, str]
+        order,  # type: AbstractPayFastOrder
+        columns,  # type: Mapping[str, str]
+):  # type: (...) -> List[str]
+    """
+    Return a description of each compared field that differs between `row` and `order`.
+    """
+    differences = []
+    for field_name in COMPARED_FIELDS:
+        column = columns.get(field_name)
+        if column is None or column not in row:
+            continue
+        expected = _normalise(field_name, row[column])
+        actual = _normalise(field_name, getattr(order, field_name))
+        if expected != actual:
+            differences.append('{}: {} != {}'.format(
+                field_name, _display(expected), _display(actual)))
+    return differences
+
+
+def reconcile_chunk(
+        rows,  # type: List[Tuple[int, Mapping[str, str]]]
+        columns=DEFAULT_COLUMNS,  # type: Mapping[str, str]
+):  # type: (...) -> Tuple[int, List[Discrepancy]]
+    """
+    Reconcile a chunk of numbered export rows.
+
+    Return the number of rows that matched their order exactly, and the discrepancies.
+    """
+    def row_value(row, field_name):
+        column = columns.get(field_name)
+        return (row.get(column) or '').strip() if column else ''
+
+    by_pf_payment_id = _in_bulk('pf_payment_id', (row_value(row, 'pf_payment_id')
+                                                  for (_, row) in rows))
+    # Only look up unmatched rows by m_payment_id.
+    by_m_payment_id = _in_bulk('m_payment_id', (
+        row_value(row, 'm_payment_id') for (_, row) in rows
+        if row_value(row, 'pf_payment_id') not in by_pf_payment_id
+    ))
+
+    matched = 0
+    discrepancies = []
+    for (row_number, row) in rows:
+        pf_payment_id = row_value(row, 'pf_payment_id')
+        m_payment_id = row_value(row, 'm_payment_id')
+
+        def discrepancy(kind, details):
+            return Discrepancy(kind, row_number, pf_payment_id, m_payment_id, details)
+
+        order = (by_pf_payment_id.get(pf_payment_id) or
+                 by_m_payment_id.get(m_payment_id))
+        if order is None:
+            discrepancies.append(discrepancy(MISSING, 'No matching PayFastOrder'))
+            continue
+
+        ok = True
+        differences = compare(row, order, columns)
+        if differences:
+            discrepancies.append(discrepancy(MISMATCH, '; '.join(differences)))
+            ok = False
+        if order.trusted is not True:
+            discrepancies.append(discrepancy(UNTRUSTED, 'trusted={}'.format(order.trusted)))
+            ok = False
+        matched += ok
+    return (matched, discrepancies)
+
+
+def reconcile(
+        rows,  # type: Iterable[Mapping[str, str]]
+        columns=DEFAULT_COLUMNS,  # type: Mapping[str, str]
+        chunk_size=DEFAULT_CHUNK_SIZE,  # type: int
+        skip=0,  # type: int
+):  # type: (...) -> Iterator[Tuple[int, int, List[Discrepancy]]]
+    """
+    Reconcile export rows in chunks, skipping the first `skip` rows.
+
+    For each chunk, yield the number of rows processed so far (including skipped rows),
+    the number of exactly matched rows in the chunk, and the chunk's discrepancies.
+    """
+    numbered = enumerate(rows, 1)
+    for _ in islice(numbered, skip):
+        pass
+
+    while True:
+        chunk = list(islice(numbered, chunk_size))
+        if not chunk:
+            return
+        (matched, discrepancies) = reconcile_chunk(chunk, columns)
+        yield (chunk[-1][0], matched, discrepancies)
+
+
+class Checkpoint(object):
+    """
+    Resumable reconciliation progress, persisted as JSON at `path`.
+
+    `rows` is the number of export rows processed, and `counts` the running
+    totals of matched rows and discrepancy kinds.
+    """
+
+    def __init__(self, path, source, rows=0, counts=None):
+        # type: (str, str, int, Optional[Dict[str, int]]) -> None
+        self.path = path
+        self.source = source
+        self.rows = rows
+        self.counts = counts or {}  # type: Dict[str, int]
+
+    @classmethod
+    def load(cls, path, source):  # type: (str, str) -> Checkpoint
+        """
+        Load the checkpoint at `path`, or start a new one if there is none.
+
+        :raise ValueError: If the checkpoint belongs to a different source file.
+        """
+        if not os.path.exists(path):
+            return cls(path, source)
+        with open(path) as f:
+            data = json.load(f)
+        if data['source'] != source:
+            raise ValueError('Checkpoint {} is for {}, not {}'.format(
+                path, data['source'], source))
+        return cls(path, source, data['rows'], data['counts'])
+
+    def save(self):  # type: () -> None
+        # Write and rename, so that an interrupted save leaves the previous checkpoint.
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'source': self.source, 'rows': self.rows, 'counts': self.counts}, f)
+        _replace(temp_path, self.path)
+
+    def add(self, rows, matched, discrepancies):  # type: (int, int, List[Discrepancy]) -> None
+        self.rows = rows
+        self.counts['matched'] = self.counts.get('matched', 0) + matched
+        for d in discrepancies:
+            self.counts[d.kind] = self.counts.get(d.kind, 0) + 1
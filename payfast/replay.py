@@ -0,0 +1,167 @@
+"""
+Re-drive stored ITN payloads through the notify pipeline (`payfast.views.process_itn`).
+
+This is the implementation of the `payfast_replay_itn` management command.
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import threading
+from collections import Counter, namedtuple
+from timeit import default_timer
+from typing import Callable, Iterable, Iterator, Optional  # noqa: F401
+
+import six
+from django.db import connection
+from django.http import HttpRequest  # noqa: F401
+from django.test.client import RequestFactory
+from six.moves import queue
+from six.moves.urllib.parse import urlencode
+
+from payfast import conf
+from payfast.models import PayFastITNLog
+from payfast.views import process_itn
+
+
+logger = logging.getLogger(__name__)
+
+#: Marks replayed requests, so that they can be told apart in the ITN log.
+REPLAY_HEADER = 'HTTP_X_PAYFAST_REPLAY'
+
+#: Outcome for payloads that raised an exception while being processed.
+OUTCOME_ERROR = 'error'
+
+
+#: A stored ITN submission: the raw urlencoded body, and the IP address it came from.
+ITNPayload = namedtuple('ITNPayload', ['body', 'source_ip'])
+
+
+class ReplayReport(namedtuple('ReplayReport', ['outcomes', 'total', 'elapsed'])):
+    """
+    Summary of a replay run: counts per outcome, the total, and the elapsed seconds.
+    """
+
+    @property
+    def throughput(self):  # type: () -> float
+        """
+        Replayed payloads per second.
+        """
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+
+def payloads_from_log(queryset=None):  # type: (...) -> Iterator[ITNPayload]
+    """
+    Yield the payloads of `PayFastITNLog` entries (by default, all of them), oldest first.
+    """
+    if queryset is None:
+        queryset = PayFastITNLog.objects.all()
+    entries = queryset.order_by('pk').only('body', 'source_ip')
+    for entry in entries.iterator():
+        yield ITNPayload(entry.raw_body(), entry.source_ip)
+
+
+def payloads_from_jsonl(lines):  # type: (Iterable[str]) -> Iterator[ITNPayload]
+    """
+    Yield the payloads of JSON lines.
+
+    Each line is an object with a ``source_ip``, and either the raw urlencoded
+    ``body`` string, or the submitted ``data`` as an object. Non-string values
+    in ``data`` (such as numbers) are submitted as text.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if 'body' in item:
+            body = item['body'].encode('utf-8')
+        else:
+            body = urlencode(sorted(
+                (k, six.text_type(v).encode('utf-8')) for (k, v) in item['data'].items()
+            )).encode('ascii')
+        yield ITNPayload(body, item.get('source_ip'))
+
+
+def build_request(payload):  # type: (ITNPayload) -> HttpRequest
+    """
+    Build a notify request for a stored payload, as PayFast would have sent it.
+    """
+    extra = {REPLAY_HEADER: '1'}
+    if payload.source_ip is not None:
+        extra[conf.IP_HEADER] = payload.source_ip
+    return RequestFactory().post(
+        '/', data=payload.body, content_type='application/x-www-form-urlencoded', **extra)
+
+
+def replay_one(payload, dry_run=False):  # type: (ITNPayload, bool) -> str
+    """
+    Replay a single payload, and return its outcome (verdict).
+
+    A `dry_run` only validates the payload, without postback validation:
+    it saves, records, signals and sends nothing.
+    """
+    try:
+        return process_itn(build_request(payload), commit=not dry_run,
+                           postback=not dry_run).verdict
+    except Exception:
+        logger.exception('Failed to replay PayFast ITN from %s', payload.source_ip)
+        return OUTCOME_ERROR
+
+
+def replay(
+        payloads,  # type: Iterable[ITNPayload]
+        concurrency=1,  # type: int
+        dry_run=False,  # type: bool
+        progress=None,  # type: Optional[Callable[[int], None]]
+):  # type: (...) -> ReplayReport
+    """
+    Replay payloads across `concurrency` worker threads.
+
+    Payloads are consumed lazily through a bounded queue, so memory use does
+    not depend on how many there are. With a `concurrency` of 1, payloads are
+    replayed in the calling thread.
+
+    :param progress: Called with the running total after each replayed payload.
+    """
+    outcomes = Counter()  # type: Counter
+    lock = threading.Lock()
+
+    def count(outcome):
+        with lock:
+            outcomes[outcome] += 1
+            total = sum(outcomes.values())
+        if progress is not None:
+            progress(total)
+
+    started = default_timer()
+    if concurrency <= 1:
+        for payload in payloads:
+            count(replay_one(payload, dry_run=dry_run))
+    else:
+        work = queue.Queue(maxsize=concurrency * 2)  # type: queue.Queue
+        done = object()
+
+        def worker():
+            try:
+                while True:
+                    payload = work.get()
+                    if payload is done:
+                        return
+                    count(replay_one(payload, dry_run=dry_run))
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, name='payfast-replay-{}'.format(n))
+                   for n in range(concurrency)]
+        for thread in workers:
+            thread.start()
+        try:
+            for payload in payloads:
+                work.put(payload)
+        finally:
+            for _ in workers:
+                work.put(done)
+            for thread in workers:
+                thread.join()
+
+    return ReplayReport(dict(outcomes), sum(outcomes.values()), default_timer() - started)
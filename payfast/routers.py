@@ -0,0 +1,183 @@
+"""
+Database router for the payfast models, with read replicas.
+
+Add it to your settings to send reads of the payfast models (the admin,
+reports, exports and reconciliation) to replicas, away from the writes of
+the notify view::
+
+    DATABASE_ROUTERS = ['payfast.routers.PayFastRouter']
+    PAYFAST_DATABASE_REPLICAS = ['replica']
+
+Reads stay on the primary database when:
+
+* they are pinned with `use_primary`: `payfast.views.process_itn` and
+  the order lookup of `PayFastForm` are,
+* the primary has a transaction open (inside ``transaction.atomic``),
+* they are for an order that received an ITN less than
+  `PAYFAST_DATABASE_STICKY_SECONDS` ago (see `stick`), so that the return page
+  and notify receivers read their own writes. Reads through an order instance
+  (such as its related objects) are routed by it: wrap other reads of the order
+  in `use_primary_for`.
+
+Settings:
+
+* `PAYFAST_DATABASE_PRIMARY`: The database written to (default: ``'default'``).
+* `PAYFAST_DATABASE_REPLICAS`: The databases reads are spread over (default: none,
+  read from the primary).
+* `PAYFAST_DATABASE_STICKY_SECONDS`: How long reads of an order stay on the
+  primary after an ITN for it (default: 1 second). Set this to cover your
+  replication lag. Stickiness is kept in the default Django cache, so that it
+  is shared by worker processes if the cache is.
+
+Migrations of the payfast app are not run on the replicas.
+"""
+from __future__ import unicode_literals
+
+import math
+import random
+import threading
+from functools import wraps
+from typing import Callable, Optional, Type, Union  # noqa: F401
+
+import six
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Model  # noqa: F401
+
+from payfast import conf
+
+
+_APP_LABEL = 'payfast'
+
+_local = threading.local()
+
+
+class use_primary(object):
+    """
+    Pin the payfast reads of the current thread to the primary database.
+
+    Use as a context manager, or as a decorator::
+
+        with use_primary():
+            order = PayFastOrder.objects.get(m_payment_id=m_payment_id)
+
+        @use_primary()
+        def process(...):
+            ...
+    """
+
+    def __enter__(self):  # type: () -> None
+        _local.depth = getattr(_local, 'depth', 0) + 1
+
+    def __exit__(self, *exc_info):  # type: (*object) -> None
+        _local.depth -= 1
+
+    def __call__(self, fn):  # type: (Callable) -> Callable
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self:
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def is_pinned():  # type: () -> bool
+    """
+    Return True if the current thread's reads are pinned to the primary.
+    """
+    return getattr(_local, 'depth', 0) > 0
+
+
+class use_primary_for(use_primary):
+    """
+    Pin the payfast reads of the current thread to the primary database,
+    if the order `m_payment_id` is sticky (see `stick`)::
+
+        with use_primary_for(m_payment_id):
+            order = PayFastOrder.objects.get(m_payment_id=m_payment_id)
+    """
+
+    def __init__(self, m_payment_id):  # type: (Optional[str]) -> None
+        self.m_payment_id = m_payment_id
+
+    def __enter__(self):  # type: () -> None
+        self.pinned = is_sticky(self.m_payment_id)
+        if self.pinned:
+            super(use_primary_for, self).__enter__()
+
+    def __exit__(self, *exc_info):  # type: (*object) -> None
+        if self.pinned:
+            super(use_primary_for, self).__exit__(*exc_info)
+
+
+def _sticky_key(m_payment_id):  # type: (str) -> str
+    return 'payfast:routers:sticky:{}'.format(m_payment_id)
+
+
+def stick(m_payment_id, seconds=None):  # type: (Optional[str], Optional[float]) -> None
+    """
+    Keep the reads of the order `m_payment_id` on the primary for `seconds`
+    (default: `PAYFAST_DATABASE_STICKY_SECONDS`).
+    """
+    if m_payment_id is None or not conf.DATABASE_REPLICAS:
+        return
+    if seconds is None:
+        seconds = conf.DATABASE_STICKY_SECONDS
+    # Some cache backends only take whole seconds.
+    cache.set(_sticky_key(m_payment_id), True, int(math.ceil(seconds)))
+
+
+def is_sticky(m_payment_id):  # type: (Optional[str]) -> bool
+    """
+    Return True if the reads of the order `m_payment_id` must stay on the primary.
+    """
+    return m_payment_id is not None and cache.get(_sticky_key(m_payment_id)) is not None
+
+
+def unstick(m_payment_id):  # type: (str) -> None
+    """
+    End the stickiness of the order `m_payment_id` (mainly for tests).
+    """
+    cache.delete(_sticky_key(m_payment_id))
+
+
+class PayFastRouter(object):
+    """
+    Route payfast reads to the replicas, and writes to the primary.
+
+    Models of other apps are left to the other routers (or the default database).
+    """
+
+    def db_for_read(self, model, **hints):  # type: (type, **object) -> Optional[str]
+        if model._meta.app_label != _APP_LABEL:
+            return None
+        primary = conf.DATABASE_PRIMARY
+        replicas = conf.DATABASE_REPLICAS
+        if not replicas or is_pinned() or connections[primary].in_atomic_block:
+            return primary
+        # Reads through an order, such as of its related objects.
+        instance = hints.get('instance')
+        if instance is not None and is_sticky(getattr(instance, 'm_payment_id', None)):
+            return primary
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):  # type: (type, **object) -> Optional[str]
+        if model._meta.app_label != _APP_LABEL:
+            return None
+        return conf.DATABASE_PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # type: (Model, Model, **object) -> Optional[bool]
+        # The replicas hold the same data as the primary.
+        databases = set([conf.DATABASE_PRIMARY] + list(conf.DATABASE_REPLICAS))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # type: (str, Union[str, Type[Model]], Optional[str], **object) -> Optional[bool]
+        if not isinstance(app_label, six.string_types):
+            # Django 1.7 compatibility: allow_migrate(db, model)
+            app_label = app_label._meta.app_label
+        if app_label == _APP_LABEL and db in conf.DATABASE_REPLICAS:
+            return False
+        return None
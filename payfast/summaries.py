@@ -0,0 +1,157 @@
+"""
+Incrementally maintained daily totals of trusted orders (`PayFastDailySummary`).
+
+While an order is trusted, it contributes its count and amounts to the summary
+row for its creation day, payment status and merchant. `process_itn` takes the
+order's `contribution` before validating an ITN, and passes it to `update` after
+saving, which moves the contribution between rows with atomic ``F()`` increments.
+
+Reporting queries can then read one row per day and status instead of scanning
+every order, for example::
+
+    PayFastDailySummary.objects.filter(day__gte=since).values('day').annotate(
+        gross=Sum('amount_gross'))
+
+`rebuild` recomputes the table from `PayFastOrder`, for the initial backfill
+(see the ``payfast_rebuild_summaries`` command).
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple
+from datetime import date, datetime  # noqa: F401
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional  # noqa: F401
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from payfast.models import AbstractPayFastOrder  # noqa: F401
+from payfast.models import PayFastDailySummary, PayFastOrder, PayFastOrderArchive
+
+
+DEFAULT_CHUNK_SIZE = 2000
+
+#: Identifies a `PayFastDailySummary` row.
+SummaryKey = namedtuple('SummaryKey', ['day', 'payment_status', 'merchant_id'])
+
+#: An order's contribution to the summary row identified by `key`.
+Contribution = namedtuple('Contribution', ['key', 'amount_gross', 'amount_fee', 'amount_net'])
+
+_ZERO = Decimal('0.00')
+
+
+def day_of(created_at):  # type: (datetime) -> date
+    """
+    Return the summary day of an order created at `created_at`, in the current time zone.
+    """
+    if settings.USE_TZ and timezone.is_aware(created_at):
+        created_at = timezone.localtime(created_at)
+    return created_at.date()
+
+
+def contribution(order):  # type: (AbstractPayFastOrder) -> Optional[Contribution]
+    """
+    Return `order`'s contribution to the summaries, or None if it is not trusted.
+    """
+    if order.trusted is not True or order.created_at is None:
+        return None
+    key = SummaryKey(day_of(order.created_at), order.payment_status or '', order.merchant_id)
+    return Contribution(key,
+                        _decimal(order.amount_gross),
+                        _decimal(order.amount_fee),
+                        _decimal(order.amount_net))
+
+
+def _decimal(value):  # type: (object) -> Decimal
+    return _ZERO if value is None or value == '' else Decimal(value)
+
+
+def _add(sign, c):  # type: (int, Contribution) -> None
+    summaries = PayFastDailySummary.objects.filter(**c.key._asdict())
+    updated = summaries.update(
+        count=F('count') + sign,
+        amount_gross=F('amount_gross') + sign * c.amount_gross,
+        amount_fee=F('amount_fee') + sign * c.amount_fee,
+        amount_net=F('amount_net') + sign * c.amount_net,
+    )
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            PayFastDailySummary.objects.create(
+                count=sign,
+                amount_gross=sign * c.amount_gross,
+                amount_fee=sign * c.amount_fee,
+                amount_net=sign * c.amount_net,
+                **c.key._asdict()
+            )
+    except IntegrityError:
+        # Another process created the row first: increment it instead.
+        _add(sign, c)
+
+
+def update(before, after):  # type: (Optional[Contribution], Optional[Contribution]) -> None
+    """
+    Move an order's contribution from `before` to `after` (either may be None).
+    """
+    if before == after:
+        return
+    changes = [(-1, before), (1, after)]
+    # Update rows in key order, so that concurrent updates can't deadlock.
+    changes = sorted(((sign, c) for (sign, c) in changes if c is not None),
+                     key=lambda change: change[1].key)
+    with transaction.atomic():
+        for (sign, c) in changes:
+            _add(sign, c)
+
+
+def rebuild(
+        chunk_size=DEFAULT_CHUNK_SIZE,  # type: int
+        progress=None,  # type: Optional[Callable[[int], None]]
+):  # type: (...) -> int
+    """
+    Recompute all summary rows from the live and archived orders, and return
+    the number of rows.
+
+    Orders are read in primary key order, `chunk_size` at a time, and totalled in
+    memory (one entry per summary row). The summary table is then replaced in
+    a single transaction. `progress` is called with the number of orders read
+    after each chunk.
+
+    ITNs processed while this runs may be missed, so run it while ITN traffic is quiet.
+    """
+    totals = {}  # type: Dict[SummaryKey, List]
+    done = 0
+    # Archived orders still count.
+    for model in [PayFastOrder, PayFastOrderArchive]:
+        orders = model.objects.trusted().order_by('pk').only(
+            'pk', 'created_at', 'payment_status', 'merchant_id', 'trusted',
+            'amount_gross', 'amount_fee', 'amount_net')
+        last_pk = None
+        while True:
+            chunk = orders if last_pk is None else orders.filter(pk__gt=last_pk)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                break
+            for order in chunk:
+                c = contribution(order)
+                total = totals.setdefault(c.key, [0, _ZERO, _ZERO, _ZERO])
+                total[0] += 1
+                total[1] += c.amount_gross
+                total[2] += c.amount_fee
+                total[3] += c.amount_net
+            last_pk = chunk[-1].pk
+            done += len(chunk)
+            if progress is not None:
+                progress(done)
+
+    with transaction.atomic():
+        PayFastDailySummary.objects.all().delete()
+        PayFastDailySummary.objects.bulk_create([
+            PayFastDailySummary(count=count, amount_gross=gross, amount_fee=fee, amount_net=net,
+                                **key._asdict())
+            for (key, (count, gross, fee, net)) in sorted(totals.items())
+        ], batch_size=chunk_size)
+    return len(totals)
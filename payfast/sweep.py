@@ -0,0 +1,63 @@
+"""
+Chunked removal of abandoned orders.
+
+`PayFastForm` creates a `PayFastOrder` for every checkout form, so most orders
+are never paid. `sweep` deletes (or archives) orders that never received an ITN,
+and so have no ``pf_payment_id``, once they are older than a given age.
+
+Orders are processed in batches of consecutive primary keys (see `payfast.batches`),
+so that each statement is short and replicas can keep up.
+This backs the ``payfast_sweep_orders`` management command.
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta  # noqa: F401
+from typing import Callable, Optional, Union  # noqa: F401
+
+from django.db.models import QuerySet  # noqa: F401
+from django.utils import timezone
+
+from payfast import archive as payfast_archive
+from payfast.batches import BatchProgress, DEFAULT_SLEEP, run_batches  # noqa: F401
+from payfast.models import DEFAULT_BATCH_SIZE, PayFastOrder
+
+
+DEFAULT_OLDER_THAN = timedelta(days=30)
+
+
+def abandoned_orders(older_than=DEFAULT_OLDER_THAN):
+    # type: (Union[timedelta, datetime]) -> QuerySet
+    """
+    Return the orders created before `older_than` that never received an ITN.
+    """
+    return PayFastOrder.objects.stale(older_than).filter(pf_payment_id__isnull=True)
+
+
+def _delete(queryset):  # type: (QuerySet) -> int
+    result = queryset.delete()
+    # Django 1.9+ returns the number of deleted objects per model.
+    if result is None:
+        return 0
+    return result[1].get(PayFastOrder._meta.label, 0)
+
+
+def sweep(
+        older_than=DEFAULT_OLDER_THAN,  # type: Union[timedelta, datetime]
+        batch_size=DEFAULT_BATCH_SIZE,  # type: int
+        sleep=DEFAULT_SLEEP,  # type: float
+        dry_run=False,  # type: bool
+        progress=None,  # type: Optional[Callable[[BatchProgress], None]]
+        archive=False,  # type: bool
+):  # type: (...) -> BatchProgress
+    """
+    Delete abandoned orders (see `abandoned_orders`) in batches, and return the totals.
+
+    If `archive` is true, move them into `PayFastOrderArchive` instead (see `payfast.archive`).
+    See `payfast.batches.run_batches` for the other arguments.
+    """
+    if isinstance(older_than, timedelta):
+        # Fix the cutoff for the whole sweep.
+        older_than = timezone.now() - older_than
+    return run_batches(abandoned_orders(older_than),
+                       payfast_archive.move if archive else _delete,
+                       batch_size=batch_size, sleep=sleep, dry_run=dry_run, progress=progress)
@@ -0,0 +1,116 @@
+"""
+Test helpers: record and enforce the resource budgets of the payfast entry points.
+
+`record_usage` records the database queries, outbound HTTP calls (PayFast postbacks)
+and wall time of a block of code, and `assert_budget` fails if they exceed a
+`payfast.budgets.Budget`::
+
+    from payfast import testing
+    from payfast.views import ITN_BUDGETS
+
+    with testing.assert_budget(ITN_BUDGETS[PayFastITNLog.VERDICT_ACCEPTED]):
+        response = self.client.post(notify_url(), notify_data)
+
+For pytest, `payfast.pytest_plugin` provides these as fixtures.
+
+Set the `PAYFAST_BUDGET_TIME_FACTOR` environment variable to scale the time
+budgets on slow machines (such as under coverage).
+"""
+from __future__ import unicode_literals
+
+import os
+import re
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+from typing import Iterator, List, Optional  # noqa: F401
+
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+from payfast import api
+from payfast.budgets import Budget  # noqa: F401
+
+
+_SAVEPOINT_RE = re.compile(r'^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.I)
+
+
+class Usage(object):
+    """
+    The resources used by a block of code (see `record_usage`).
+    """
+
+    def __init__(self):  # type: () -> None
+        self.queries = []  # type: List[str]
+        self.http_calls = []  # type: List[str]
+        self.seconds = None  # type: Optional[float]
+
+    def __repr__(self):
+        return '<Usage: {} queries, {} HTTP calls, {} seconds>'.format(
+            len(self.queries), len(self.http_calls), self.seconds)
+
+
+@contextmanager
+def record_usage(databases=None):  # type: (Optional[List[str]]) -> Iterator[Usage]
+    """
+    Record the queries (on all `databases`, by default all of them), postbacks
+    and wall time of the block.
+
+    Postbacks are recorded at `payfast.api.data_is_valid`, so a test's
+    replacement of that function is recorded too, if installed before the block.
+    """
+    usage = Usage()
+    lock = threading.Lock()
+    data_is_valid = api.data_is_valid
+
+    def recording_data_is_valid(post_data, postback_server=api.POSTBACK_SERVER):
+        with lock:
+            usage.http_calls.append(postback_server)
+        return data_is_valid(post_data, postback_server)
+
+    contexts = [CaptureQueriesContext(connections[alias])
+                for alias in (connections if databases is None else databases)]
+    for context in contexts:
+        context.__enter__()
+    api.data_is_valid = recording_data_is_valid
+    started = default_timer()
+    try:
+        yield usage
+    finally:
+        usage.seconds = default_timer() - started
+        api.data_is_valid = data_is_valid
+        for context in contexts:
+            context.__exit__(None, None, None)
+            usage.queries.extend(query['sql'] for query in context.captured_queries
+                                 if not _SAVEPOINT_RE.match(query['sql']))
+
+
+def check_budget(usage, budget):  # type: (Usage, Budget) -> None
+    """
+    :raise AssertionError: If `usage` exceeds `budget`.
+    """
+    problems = []
+    if budget.queries is not None and len(usage.queries) > budget.queries:
+        problems.append('{} queries, budget {}:\n{}'.format(
+            len(usage.queries), budget.queries,
+            '\n'.join('  {}. {}'.format(n, sql) for (n, sql) in enumerate(usage.queries, 1))))
+    if budget.http_calls is not None and len(usage.http_calls) > budget.http_calls:
+        problems.append('{} HTTP calls, budget {}: {}'.format(
+            len(usage.http_calls), budget.http_calls, ', '.join(usage.http_calls)))
+    if budget.seconds is not None:
+        seconds = budget.seconds * float(os.environ.get('PAYFAST_BUDGET_TIME_FACTOR', 1))
+        if usage.seconds > seconds:
+            problems.append('{:.3f} seconds, budget {:.3f}'.format(usage.seconds, seconds))
+    if problems:
+        raise AssertionError('Over budget: ' + '\n'.join(problems))
+
+
+@contextmanager
+def assert_budget(budget, databases=None):
+    # type: (Budget, Optional[List[str]]) -> Iterator[Usage]
+    """
+    Record the block's usage (see `record_usage`), and check it against `budget`.
+    """
+    with record_usage(databases) as usage:
+        yield usage
+    check_budget(usage, budget)
@@ -1,21 +1,77 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import datetime
+import hashlib
+import importlib
+import io
 import json
+import os
+import pstats
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 from collections import OrderedDict
+from decimal import Decimal
 
 import django
+import six
+from six.moves.urllib.parse import urlencode
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from django.apps import apps as django_apps
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase, SimpleTestCase, override_settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import DatabaseError, connection, transaction
+from django.test.utils import CaptureQueriesContext, patch_logger
+from django.utils.timezone import utc
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, override_settings
+from django.test import RequestFactory
 
 from payfast import api
 from payfast import conf
-from payfast.forms import notify_url, PayFastForm, is_payfast_ip_address
-from payfast.models import PayFastOrder
+from payfast import admin as payfast_admin
+from payfast import archive
+from payfast import admission
+from payfast import dispatch
+from payfast import export
+from payfast import health
+from payfast import itn_log
+from payfast import merchants
+from payfast import metrics
+from payfast import money
+from payfast import profiling
+from payfast import reconcile
+from payfast import replay
+from payfast import routers
+from payfast import summaries
+from payfast import sweep
+from payfast import testing
+from payfast import tracing
+from payfast import views
+from payfast import warmup
+from payfast.apps import PayFastConfig
+from payfast.budgets import Budget
+from payfast.forms import notify_url, PayFastForm, is_payfast_ip_address, CHECKOUT_BUDGETS
+from payfast.forms import NotifyForm
+from payfast.models import PayFastOrder, PayFastOrderArchive, PayFastITNLog, PayFastDailySummary
+from payfast.models import payment_status_code, payment_status_q
+from payfast.views import ITN_BUDGETS
 import payfast.signals
 
+# Django 1.10 introduces django.urls
+if django.VERSION < (1, 10):
+    from django.core.urlresolvers import reverse
+else:
+    from django.urls import reverse
+
 
 class PayFastFormTest(TestCase):
 
@@ -121,6 +177,32 @@ class PayFastFormTest(TestCase):
         }, form.initial)
         self.assertEqual(user, form.order.user)
 
+    def test_budgets(self):
+        user = User.objects.create(username='example_user')
+        initial = {'amount': '100', 'item_name': 'Example item'}
+        with testing.assert_budget(_untimed(CHECKOUT_BUDGETS['created'])):
+            PayFastForm(initial=dict(initial), user=user)
+        with testing.assert_budget(_untimed(CHECKOUT_BUDGETS['created'])):
+            PayFastForm(initial=dict(initial, m_payment_id='order-1'), user=user)
+        with testing.assert_budget(_untimed(CHECKOUT_BUDGETS['existing'])) as usage:
+            PayFastForm(initial=dict(initial, m_payment_id='order-1'), user=user)
+        self.assertEqual(len(usage.queries), 1)
+        # A stale amount_gross_cents doesn't cause a needless save.
+        PayFastOrder.objects.update(amount_gross_cents=1)
+        with testing.assert_budget(_untimed(CHECKOUT_BUDGETS['existing'])) as usage:
+            PayFastForm(initial=dict(initial, m_payment_id='order-1'), user=user)
+        self.assertEqual(len(usage.queries), 1)
+        with testing.assert_budget(_untimed(CHECKOUT_BUDGETS['updated'])):
+            PayFastForm(initial=dict(initial, m_payment_id='order-1', amount='200'), user=user)
+        self.assertEqual(PayFastOrder.objects.get(m_payment_id='order-1').amount_gross,
+                         Decimal('200'))
+
+    def test_over_budget(self):
+        with self.assertRaises(AssertionError) as cm:
+            with testing.assert_budget(Budget(queries=0, http_calls=0, seconds=None)):
+                PayFastForm(initial={'amount': 100, 'item_name': 'Example item'})
+        self.assertIn('2 queries, budget 0', str(cm.exception))
+
 
 def _test_data():
     return OrderedDict([
@@ -150,6 +232,14 @@ def _itn_data_from_checkout(checkout_data, payment_form):
     return notify_data
 
 
+def _untimed(budget):  # type: (Budget) -> Budget
+    """
+    Return `budget` without its wall time limit: the tests check queries and
+    postbacks, which don't depend on the machine.
+    """
+    return budget._replace(seconds=None)
+
+
 def _order():
     return PayFastOrder.objects.all()[0]
 
@@ -171,6 +261,16 @@ class SignatureTest(unittest.TestCase):
         data['name_last'] = ''
         self.assertEqual(api.checkout_signature(data), '8f6435965cd9b00a9a965d93fc6c4c48')
 
+    def test_passphrase(self):
+        """
+        The passphrase is signed last, as if it were another field.
+        """
+        data = OrderedDict([('merchant_id', '10000100'), ('amount', '234')])
+        with_passphrase = OrderedDict(data, passphrase='secret')
+        self.assertEqual(api.checkout_signature(data, ' secret '),
+                         hashlib.md5(urlencode(with_passphrase).encode('ascii')).hexdigest())
+        self.assertEqual(api.checkout_signature(data, ''), api.checkout_signature(data))
+
     def test_known_good_itn_signature(self):
         known_good_itn_data = {
             'amount_fee': '-2.80',
@@ -245,7 +345,8 @@ class NotifyTest(TestCase):
         order = _order()
 
         # the server sends a notification
-        response = self.client.post(notify_url(), notify_data)
+        with testing.assert_budget(_untimed(ITN_BUDGETS[PayFastITNLog.VERDICT_ACCEPTED])):
+            response = self.client.post(notify_url(), notify_data)
         self.assertEqual(response.status_code, 200, response.content)
         self.assertEqual(self.notify_handler_orders, [order])
 
@@ -254,6 +355,53 @@ class NotifyTest(TestCase):
         self.assertEqual(order.debug_info, '')
         self.assertEqual(order.trusted, True)
 
+        [log] = PayFastITNLog.objects.all()
+        self.assertEqual(log.order, order)
+        self.assertEqual(log.verdict, PayFastITNLog.VERDICT_ACCEPTED)
+        self.assertEqual(log.source_ip, '127.0.0.1')
+        self.assertEqual(set(json.loads(log.timings)), {'lookup', 'validate', 'save', 'signal'})
+
+        [summary] = PayFastDailySummary.objects.all()
+        self.assertEqual(
+            (summary.day, summary.merchant_id, summary.count, summary.amount_gross),
+            (summaries.day_of(order.created_at), order.merchant_id, 1, order.amount_gross))
+
+    def test_stale_amount_cents(self):
+        notify_data = self._create_order()
+        # amount_gross_cents goes stale when amount_gross is updated without save().
+        PayFastOrder.objects.update(amount_gross_cents=1)
+        response = self.client.post(notify_url(), notify_data)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(_order().trusted, True)
+
+    def test_receiver_error(self):
+        notify_data = self._create_order()
+
+        def failing_handler(sender, order, **kwargs):
+            raise ValueError('receiver failed')
+
+        payfast.signals.notify.connect(failing_handler)
+        try:
+            with self.assertRaises(ValueError):
+                self.client.post(notify_url(), notify_data)
+        finally:
+            payfast.signals.notify.disconnect(failing_handler)
+        # The order was saved, so the ITN is logged as accepted.
+        [log] = PayFastITNLog.objects.all()
+        self.assertEqual(log.verdict, PayFastITNLog.VERDICT_ACCEPTED)
+
+    def test_duplicate(self):
+        notify_data = self._create_order()
+        self.client.post(notify_url(), notify_data)
+
+        # PayFast retries the same ITN.
+        with testing.assert_budget(_untimed(ITN_BUDGETS['duplicate'])):
+            response = self.client.post(notify_url(), notify_data)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(len(self.notify_handler_orders), 2)
+        [summary] = PayFastDailySummary.objects.all()
+        self.assertEqual(summary.count, 1)
+
     def test_untrusted_ip(self):
         """
         The notify handler rejects notification attempts from untrusted IP address.
@@ -261,7 +409,8 @@ class NotifyTest(TestCase):
         notify_data = self._create_order()
 
         # the server sends a notification
-        response = self.client.post(notify_url(), notify_data, REMOTE_ADDR='127.0.0.2')
+        with testing.assert_budget(_untimed(ITN_BUDGETS[PayFastITNLog.VERDICT_REJECTED])):
+            response = self.client.post(notify_url(), notify_data, REMOTE_ADDR='127.0.0.2')
         self._assertBadRequest(response, {
             '__all__': [{'code': '', 'message': 'untrusted ip: 127.0.0.2'}],
         })
@@ -272,12 +421,21 @@ class NotifyTest(TestCase):
         self.assertEqual(order.debug_info, '__all__: untrusted ip: 127.0.0.2')
         self.assertEqual(order.trusted, False)
 
+        [log] = PayFastITNLog.objects.all()
+        self.assertEqual(log.order, order)
+        self.assertEqual(log.verdict, PayFastITNLog.VERDICT_REJECTED)
+        self.assertEqual(log.errors, '__all__: untrusted ip: 127.0.0.2')
+
     def test_non_existing_order(self):
-        response = self.client.post(notify_url(), {})
+        with testing.assert_budget(_untimed(ITN_BUDGETS[PayFastITNLog.VERDICT_NOT_FOUND])):
+            response = self.client.post(notify_url(), {})
         self.assertEqual(response.status_code, 404)
         self.assertEqual(self.notify_handler_orders, [])
 
         self.assertQuerysetEqual(PayFastOrder.objects.all(), [])
+        [log] = PayFastITNLog.objects.all()
+        self.assertEqual(log.verdict, PayFastITNLog.VERDICT_NOT_FOUND)
+        self.assertIsNone(log.order)
 
     def test_invalid_request(self):
         form = PayFastForm(initial={'amount': 100, 'item_name': 'foo'})
@@ -308,6 +466,1712 @@ class NotifyTest(TestCase):
         self.assertEqual(order.trusted, False)
 
 
+@override_settings(PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class ITNLogTest(TestCase):
+
+    def setUp(self):
+        conf.USE_POSTBACK = False
+        conf.MERCHANT_ID = '10000100'
+        self.payment_form = PayFastForm(initial={'amount': 100, 'item_name': 'foo'})
+
+    def tearDown(self):
+        conf.ITN_LOG_MODE = 'sync'
+        if itn_log._buffer is not None:
+            itn_log._buffer.stop()
+        itn_log._buffer = None
+
+    def test_full_body(self):
+        """
+        The log keeps the full raw body, beyond debug_info's 255 characters.
+        """
+        notify_data = {
+            'm_payment_id': self.payment_form.order.m_payment_id,
+            'item_description': 'x' * 1000,
+        }
+        response = self.client.post(notify_url(), notify_data, HTTP_USER_AGENT='PayFast')
+        self.assertEqual(response.status_code, 400)
+
+        [log] = PayFastITNLog.objects.all()
+        self.assertIn(b'x' * 1000, log.raw_body())
+        self.assertLess(len(log.body), 1000)
+        self.assertEqual(json.loads(log.headers)['HTTP_USER_AGENT'], 'PayFast')
+
+    def test_buffered(self):
+        conf.ITN_LOG_MODE = 'buffered'
+        itn_log._buffer = itn_log.ITNLogBuffer(batch_size=3, flush_interval=60)
+
+        notify_data = {'m_payment_id': self.payment_form.order.m_payment_id}
+        for _ in range(2):
+            self.client.post(notify_url(), notify_data)
+        self.assertEqual(PayFastITNLog.objects.count(), 0)
+        self.assertEqual(len(itn_log.get_buffer()), 2)
+
+        # The third entry fills the batch.
+        self.client.post(notify_url(), notify_data)
+        self.assertEqual(PayFastITNLog.objects.count(), 3)
+        self.assertEqual(len(itn_log.get_buffer()), 0)
+
+        self.client.post(notify_url(), notify_data)
+        self.assertEqual(itn_log.get_buffer().flush(), 1)
+        self.assertEqual(PayFastITNLog.objects.count(), 4)
+
+        # Stopping writes the rest, and ends the background thread.
+        self.client.post(notify_url(), notify_data)
+        flusher = itn_log.get_buffer()._flusher
+        self.assertEqual(itn_log.get_buffer().stop(), 1)
+        flusher.join(5)
+        self.assertFalse(flusher.is_alive())
+
+        # Once stopped, entries are written as they come.
+        self.client.post(notify_url(), notify_data)
+        self.assertEqual(PayFastITNLog.objects.count(), 6)
+        self.assertEqual(len(itn_log.get_buffer()), 0)
+
+    def test_off(self):
+        conf.ITN_LOG_MODE = 'off'
+        self.client.post(notify_url(), {'m_payment_id': self.payment_form.order.m_payment_id})
+        self.assertEqual(PayFastITNLog.objects.count(), 0)
+
+
+@override_settings(PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class ReplayTest(TestCase):
+
+    def setUp(self):
+        conf.USE_POSTBACK = False
+        conf.MERCHANT_ID = '10000100'
+        conf.REQUIRE_AMOUNT_MATCH = True
+
+        checkout_data = _test_data()
+        payment_form = PayFastForm(initial={
+            'amount': checkout_data['amount'],
+            'item_name': checkout_data['item_name']
+        })
+        self.notify_data = _itn_data_from_checkout(checkout_data, payment_form)
+
+    def test_replay_from_log(self):
+        """
+        ITNs rejected during an outage are accepted when replayed afterwards.
+        """
+        with override_settings(PAYFAST_IP_ADDRESSES=[]):
+            response = self.client.post(notify_url(), self.notify_data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(_order().trusted, False)
+
+        stdout = six.StringIO()
+        call_command('payfast_replay_itn', verdict=['rejected'], stdout=stdout)
+        self.assertIn('Replayed 1 ITNs', stdout.getvalue())
+        self.assertIn('accepted: 1', stdout.getvalue())
+        self.assertEqual(_order().trusted, True)
+
+        replayed = PayFastITNLog.objects.latest('pk')
+        self.assertEqual(replayed.verdict, PayFastITNLog.VERDICT_ACCEPTED)
+        self.assertEqual(json.loads(replayed.headers)['HTTP_X_PAYFAST_REPLAY'], '1')
+
+    def test_replay_jsonl_dry_run(self):
+        payloads = replay.payloads_from_jsonl([
+            json.dumps({'data': self.notify_data, 'source_ip': '127.0.0.1'}),
+            '',
+            json.dumps({'body': 'm_payment_id=missing', 'source_ip': '127.0.0.1'}),
+        ])
+        conf.USE_POSTBACK = True
+        data_is_valid = api.data_is_valid
+        api.data_is_valid = lambda post_data, postback_server: self.fail('postback made')
+        try:
+            report = replay.replay(payloads, dry_run=True)
+        finally:
+            api.data_is_valid = data_is_valid
+            conf.USE_POSTBACK = False
+        self.assertEqual(report.outcomes, {'accepted': 1, 'not_found': 1})
+        self.assertEqual(report.total, 2)
+
+        # Nothing was saved or recorded.
+        self.assertIsNone(_order().trusted)
+        self.assertEqual(PayFastITNLog.objects.count(), 0)
+
+    def test_jsonl_values(self):
+        [payload] = replay.payloads_from_jsonl([
+            json.dumps({'data': {'m_payment_id': 1, 'amount_gross': 12.5, 'item_name': 'x'}}),
+        ])
+        self.assertEqual(payload.body, b'amount_gross=12.5&item_name=x&m_payment_id=1')
+
+
+class DispatchTest(SimpleTestCase):
+
+    def setUp(self):
+        self.order = PayFastOrder(m_payment_id='1')
+        self.received = []  # type: list
+        payfast.signals.notify.connect(self.failing_receiver)
+        payfast.signals.notify.connect(self.receiver)
+        # Silence the logged receiver failures.
+        dispatch.logger.disabled = True
+
+    def tearDown(self):
+        payfast.signals.notify.disconnect(self.failing_receiver)
+        payfast.signals.notify.disconnect(self.receiver)
+        dispatch.logger.disabled = False
+        conf.NOTIFY_DISPATCH = 'sync'
+        dispatch._executor = None
+
+    def failing_receiver(self, sender, order, **kwargs):
+        raise ValueError('failed')
+
+    def receiver(self, sender, order, **kwargs):
+        self.received.append((threading.current_thread(), order))
+        return 'ok'
+
+    def test_sync(self):
+        """
+        Synchronous dispatch propagates receiver exceptions, like Signal.send().
+        """
+        with self.assertRaises(ValueError):
+            dispatch.send_notify(None, self.order)
+
+    def test_on_commit(self):
+        conf.NOTIFY_DISPATCH = 'on_commit'
+        report = dispatch.send_notify(None, self.order).result(timeout=0)
+        self.assertEqual([(r.response, type(r.error)) for r in report.results],
+                         [(None, ValueError), ('ok', type(None))])
+        self.assertEqual(len(report.failed), 1)
+        self.assertEqual(self.received, [(threading.current_thread(), self.order)])
+
+    def test_executor(self):
+        conf.NOTIFY_DISPATCH = 'executor'
+        report = dispatch.send_notify(None, self.order).result(timeout=5)
+        self.assertEqual(len(report.results), 2)
+        [(thread, order)] = self.received
+        self.assertNotEqual(thread, threading.current_thread())
+        self.assertEqual(order, self.order)
+        self.assertEqual(dispatch.get_executor().stats()['submitted'], 1)
+
+    def test_executor_backpressure(self):
+        """
+        With the queue full, submissions run in the calling thread.
+        """
+        executor = dispatch.BoundedExecutor(workers=1, queue_size=1, queue_timeout=0.01)
+        (started, release) = (threading.Event(), threading.Event())
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        ran_inline = []
+        executor.submit(block)
+        started.wait(5)
+        executor.submit(lambda: None)  # Queued
+        executor.submit(lambda: ran_inline.append(threading.current_thread()))
+        self.assertEqual(ran_inline, [threading.current_thread()])
+        self.assertEqual(executor.stats()['queue_depth'], 1)
+        self.assertEqual(executor.stats()['ran_inline'], 1)
+        release.set()
+
+
+class AdmissionTest(SimpleTestCase):
+
+    def tearDown(self):
+        admission._controller = None
+        metrics.reset()
+
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = admission.TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+        self.assertEqual([bucket.try_acquire() for _ in range(4)], [True, True, True, False])
+        now[0] = 0.5  # One token refilled.
+        self.assertEqual([bucket.try_acquire() for _ in range(2)], [True, False])
+
+    def test_burst(self):
+        conf.ADMISSION_RATE = 0.5
+        admission._controller = None
+        try:
+            # A fractional rate still admits one request at a time.
+            self.assertEqual(admission.get_controller().bucket.burst, 1)
+            admission._controller = None
+            conf.ADMISSION_BURST = 0.5
+            with self.assertRaises(ImproperlyConfigured):
+                admission.get_controller()
+        finally:
+            (conf.ADMISSION_RATE, conf.ADMISSION_BURST) = (None, None)
+
+    def test_concurrency_limit(self):
+        controller = admission.AdmissionController(limiter=admission.ConcurrencyLimiter(1))
+        self.assertIsNone(controller.try_admit())
+        self.assertEqual(controller.try_admit(), admission.SHED_CONCURRENCY)
+        controller.release()
+        self.assertIsNone(controller.try_admit())
+        self.assertEqual(controller.stats(), {
+            'admitted': 2, 'shed_rate': 0, 'shed_concurrency': 1, 'in_flight': 1,
+        })
+
+    def test_notify_shed(self):
+        """
+        Shed notify requests get a quick retryable response.
+        """
+        admission._controller = admission.AdmissionController(
+            bucket=admission.TokenBucket(rate=0, burst=0))
+        response = self.client.post(notify_url(), {})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(admission.get_controller().stats()['shed_rate'], 1)
+        self.assertEqual(metrics.ITN_SHED.labels(reason=admission.SHED_RATE).value(), 1)
+
+
+@override_settings(PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class ConcurrentPostbackTest(TestCase):
+
+    def setUp(self):
+        conf.USE_POSTBACK = True
+        conf.POSTBACK_MODE = 'concurrent'
+        conf.MERCHANT_ID = '10000100'
+        conf.REQUIRE_AMOUNT_MATCH = True
+
+        self.postbacks = []  # type: list
+        self._data_is_valid = api.data_is_valid
+        api.data_is_valid = self.fake_data_is_valid
+
+        checkout_data = _test_data()
+        payment_form = PayFastForm(initial={
+            'amount': checkout_data['amount'],
+            'item_name': checkout_data['item_name']
+        })
+        self.notify_data = _itn_data_from_checkout(checkout_data, payment_form)
+
+    def tearDown(self):
+        api.data_is_valid = self._data_is_valid
+        conf.USE_POSTBACK = False
+        conf.POSTBACK_MODE = 'serial'
+
+    def fake_data_is_valid(self, post_data, postback_server):
+        self.postbacks.append(threading.current_thread())
+        return post_data['item_name'] != 'invalid'
+
+    def test_notify(self):
+        with testing.assert_budget(_untimed(ITN_BUDGETS[PayFastITNLog.VERDICT_ACCEPTED])) as usage:
+            response = self.client.post(notify_url(), self.notify_data)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(usage.http_calls, [conf.SERVER])
+        [postback_thread] = self.postbacks
+        self.assertNotEqual(postback_thread, threading.current_thread())
+        self.assertEqual(_order().trusted, True)
+
+    def test_postback_invalid(self):
+        self.notify_data['item_name'] = 'invalid'
+        self.notify_data['signature'] = api.itn_signature(self.notify_data)
+        response = self.client.post(notify_url(), self.notify_data)
+        self.assertEqual(json.loads(response.content), {
+            '__all__': [{'code': '', 'message': 'Postback validation fails'}],
+        })
+
+    def test_untrusted_ip(self):
+        """
+        Requests failing the cheap checks do not trigger a postback.
+        """
+        response = self.client.post(notify_url(), self.notify_data, REMOTE_ADDR='127.0.0.2')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.postbacks, [])
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Uses SQLite query plans')
+class IndexTest(TestCase):
+    """
+    The admin and reporting queries use the composite indexes.
+
+    See benchmarks/bench_indexes.py for timings on a multi-million-row table.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='example_user')
+        PayFastOrder.objects.bulk_create(
+            PayFastOrder(
+                m_payment_id=str(n),
+                item_name='Example item',
+                payment_status=['COMPLETE', 'PENDING', 'FAILED'][n % 3],
+                payment_status_code=[1, 2, 3][n % 3],
+                trusted=[True, False, None][n % 3],
+                user=(user if n % 10 == 0 else None),
+            )
+            for n in range(300)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def _index_name(self, columns):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA index_list('payfast_payfastorder')")
+            for row in cursor.fetchall():
+                name = row[1]
+                cursor.execute("PRAGMA index_info('{}')".format(name))
+                if [info[2] for info in cursor.fetchall()] == columns:
+                    return name
+        self.fail('No index on {!r}'.format(columns))
+
+    def _query_plan(self, queryset):
+        (sql, params) = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, columns):
+        plan = self._query_plan(queryset)
+        self.assertIn(self._index_name(columns), plan)
+        self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan)
+
+    def test_status_by_date(self):
+        since = _order().created_at
+        self.assertUsesIndex(
+            PayFastOrder.objects.filter(payment_status_q('PENDING'), created_at__gte=since)
+            .order_by('created_at'),
+            ['payment_status_code', 'created_at'])
+
+    def test_trusted_by_date(self):
+        self.assertUsesIndex(
+            PayFastOrder.objects.filter(trusted=True).order_by('-created_at'),
+            ['trusted', 'created_at'])
+
+    def test_user_by_date(self):
+        self.assertUsesIndex(
+            PayFastOrder.objects.filter(user__username='example_user').order_by('-created_at'),
+            ['user_id', 'created_at'])
+
+    def test_queryset_helpers(self):
+        self.assertUsesIndex(PayFastOrder.objects.stale(datetime.timedelta(days=1)),
+                             ['trusted', 'created_at'])
+        self.assertUsesIndex(PayFastOrder.objects.untrusted().order_by('-created_at'),
+                             ['trusted', 'created_at'])
+
+
+class PayFastOrderQuerySetTest(TestCase):
+
+    def setUp(self):
+        for (n, (status, trusted)) in enumerate([
+                ('COMPLETE', True), ('PENDING', True), ('PENDING', False), (None, None),
+                (None, None),
+        ]):
+            PayFastOrder.objects.create(m_payment_id=str(n), payment_status=status,
+                                        trusted=trusted)
+        PayFastOrder.objects.filter(m_payment_id='4').update(
+            created_at=datetime.datetime(2017, 1, 1, tzinfo=utc))
+
+    def _ids(self, queryset):
+        return sorted(queryset.values_list('m_payment_id', flat=True))
+
+    def test_helpers(self):
+        orders = PayFastOrder.objects.all()
+        self.assertEqual(self._ids(orders.complete()), ['0'])
+        self.assertEqual(self._ids(orders.pending()), ['1'])
+        self.assertEqual(self._ids(orders.untrusted()), ['2'])
+        self.assertEqual(self._ids(orders.stale(datetime.timedelta(days=1))), ['4'])
+        self.assertEqual(self._ids(orders.stale(datetime.datetime(2016, 1, 1, tzinfo=utc))), [])
+
+    def test_transition(self):
+        # One SELECT and one UPDATE per batch, and a final empty SELECT.
+        with self.assertNumQueries(5):
+            changed = PayFastOrder.objects.transition(
+                'CANCELLED', from_statuses=['PENDING', None], batch_size=2)
+        self.assertEqual(changed, 4)
+        self.assertEqual(self._ids(PayFastOrder.objects.filter(payment_status='CANCELLED')),
+                         ['1', '2', '3', '4'])
+
+        self.assertEqual(PayFastOrder.objects.transition('CANCELLED'), 1)
+        self.assertEqual(PayFastOrder.objects.transition('CANCELLED'), 0)
+
+    def test_mark_untrusted(self):
+        changed = PayFastOrder.objects.filter(payment_status='PENDING').mark_untrusted('chargeback')
+        self.assertEqual(changed, 1)
+        order = PayFastOrder.objects.get(m_payment_id='1')
+        self.assertEqual((order.trusted, order.debug_info), (False, 'chargeback'))
+
+
+class PayFastOrderAdminTest(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.changelist_url = reverse('admin:payfast_payfastorder_changelist')
+        cache.clear()
+
+    def tearDown(self):
+        conf.ADMIN_SEARCH_MODE = 'contains'
+
+    def _create_orders(self, count):
+        for n in range(PayFastOrder.objects.count(), count):
+            user = User.objects.create(username='user{}'.format(n))
+            PayFastOrder.objects.create(m_payment_id='order{}'.format(n), item_name='Item',
+                                        payment_status='COMPLETE', user=user)
+
+    def _changelist_queries(self, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.changelist_url, data)
+        self.assertEqual(response.status_code, 200)
+        return (response, len(queries))
+
+    def test_changelist_queries(self):
+        """
+        The number of changelist queries does not grow with the number of orders.
+        """
+        self._create_orders(2)
+        (_, few) = self._changelist_queries({'payment_status': 'COMPLETE'})
+        self._create_orders(10)
+        cache.clear()
+        (_, many) = self._changelist_queries({'payment_status': 'COMPLETE'})
+        self.assertEqual(few, many)
+
+    def test_date_hierarchy_cached(self):
+        self._create_orders(2)
+        (_, uncached) = self._changelist_queries()
+        (_, cached) = self._changelist_queries()
+        self.assertLess(cached, uncached)
+
+    def test_search_modes(self):
+        self._create_orders(12)
+
+        def search(q):
+            (response, _) = self._changelist_queries({'q': q})
+            return sorted(order.m_payment_id for order in response.context['cl'].result_list)
+
+        self.assertEqual(search('der1'), ['order1', 'order10', 'order11'])
+        conf.ADMIN_SEARCH_MODE = 'prefix'
+        self.assertEqual(search('der1'), [])
+        self.assertEqual(search('order1'), ['order1', 'order10', 'order11'])
+        self.assertEqual(search('USER1'), ['order1', 'order10', 'order11'])
+        conf.ADMIN_SEARCH_MODE = 'exact'
+        self.assertEqual(search('order1'), ['order1'])
+        self.assertEqual(search('user1'), [])
+
+    def test_export_action(self):
+        self._create_orders(3)
+        response = self.client.post(self.changelist_url, {
+            'action': 'export_csv',
+            'payment_status': 'COMPLETE',
+            'select_across': '1',
+            '_selected_action': ['1'],
+        })
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[0], ','.join(export.DEFAULT_COLUMNS))
+        self.assertEqual(sorted(line.split(',')[0] for line in lines[1:]),
+                         ['order0', 'order1', 'order2'])
+
+    def test_estimated_count(self):
+        self._create_orders(3)
+        orders = PayFastOrder.objects.order_by('pk')
+        estimated_count = payfast_admin.estimated_count
+        try:
+            payfast_admin.estimated_count = lambda queryset: 10 ** 7
+            paginator = payfast_admin.EstimatedCountPaginator(orders, 100)
+            self.assertEqual(paginator.count, 10 ** 7)
+
+            # Below the threshold, count exactly.
+            payfast_admin.estimated_count = lambda queryset: 10
+            paginator = payfast_admin.EstimatedCountPaginator(orders, 100)
+            self.assertEqual(paginator.count, 3)
+        finally:
+            payfast_admin.estimated_count = estimated_count
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        for n in range(3):
+            PayFastOrder.objects.create(m_payment_id=str(n), item_name='Item, "{}"'.format(n),
+                                        amount_gross='1{}.50'.format(n))
+
+    def test_command_csv(self):
+        stdout = six.StringIO()
+        call_command('payfast_export_orders', columns='m_payment_id,item_name,amount_gross',
+                     chunk_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            'm_payment_id,item_name,amount_gross',
+            '0,"Item, ""0""",10.50',
+            '1,"Item, ""1""",11.50',
+            '2,"Item, ""2""",12.50',
+        ])
+
+    def test_command_output(self):
+        PayFastOrder.objects.filter(m_payment_id='0').update(item_name='Caf\xe9')
+        output = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        output.close()
+        self.addCleanup(os.remove, output.name)
+        for format in ['csv', 'jsonl']:
+            call_command('payfast_export_orders', format=format, columns='m_payment_id,item_name',
+                         output=output.name)
+            with io.open(output.name, encoding='utf-8', newline='') as f:
+                lines = f.read().splitlines()
+            if format == 'csv':
+                self.assertEqual(lines[:2], ['m_payment_id,item_name', '0,Caf\xe9'])
+            else:
+                self.assertEqual(json.loads(lines[0]),
+                                 {'m_payment_id': '0', 'item_name': 'Caf\xe9'})
+
+    def test_command_jsonl_date_range(self):
+        PayFastOrder.objects.filter(m_payment_id='0').update(
+            created_at=datetime.datetime(2017, 12, 31, tzinfo=utc))
+        stdout = six.StringIO()
+        call_command('payfast_export_orders', format='jsonl', columns='m_payment_id,created_at',
+                     since=datetime.datetime(2017, 1, 1, tzinfo=utc),
+                     until=datetime.datetime(2018, 1, 1, tzinfo=utc), stdout=stdout)
+        self.assertEqual([json.loads(line) for line in stdout.getvalue().splitlines()], [
+            {'m_payment_id': '0', 'created_at': '2017-12-31T00:00:00+00:00'},
+        ])
+
+    def test_unknown_column(self):
+        with self.assertRaises(ValueError):
+            export.export_lines(PayFastOrder.objects.all(), columns=['m_payment_id', 'password'])
+
+
+class ReconcileTest(TestCase):
+
+    header = 'PF Payment ID,M Payment ID,Gross,Fee,Net,Status\n'
+    rows = [
+        '100,1,"1,000.00",-23.00,977.00,COMPLETE\n',  # matched
+        '101,2,10.00,-1.00,9.00,COMPLETE\n',  # mismatched gross
+        '102,3,10.00,-1.00,9.00,COMPLETE\n',  # untrusted
+        ',4,10.00,-1.00,9.00,COMPLETE\n',  # matched by m_payment_id
+        '999,999,10.00,-1.00,9.00,COMPLETE\n',  # missing
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'history.csv')
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            f.write(self.header + ''.join(self.rows))
+
+        for (m_payment_id, pf_payment_id, gross, trusted) in [
+                ('1', '100', '1000.00', True),
+                ('2', '101', '11.00', True),
+                ('3', '102', '10.00', False),
+                ('4', None, '10.00', True),
+        ]:
+            PayFastOrder.objects.create(
+                m_payment_id=m_payment_id, pf_payment_id=pf_payment_id, amount_gross=gross,
+                amount_fee=(-23 if gross == '1000.00' else -1),
+                amount_net=(977 if gross == '1000.00' else 9),
+                payment_status='COMPLETE', trusted=trusted)
+
+    def _report(self, path):
+        with io.open(path, encoding='utf-8') as f:
+            return [line.split(',')[:2] for line in f.read().splitlines()]
+
+    def test_reconcile(self):
+        # Live and archive lookups by pf_payment_id, then by m_payment_id for the missing row.
+        with self.assertNumQueries(4):
+            [(rows, matched, discrepancies)] = reconcile.reconcile(
+                [dict(zip(self.header.strip().split(','), row)) for row in [
+                    ['100', '1', '1,000.00', '-23.00', '977.00', 'complete'],
+                    ['101', '2', '10.00', '-1.00', '9.00', 'COMPLETE'],
+                    ['999', '999', '10.00', '-1.00', '9.00', 'COMPLETE'],
+                ]], chunk_size=10)
+        self.assertEqual((rows, matched), (3, 1))
+        self.assertEqual(discrepancies, [
+            reconcile.Discrepancy('mismatch', 2, '101', '2', 'amount_gross: 10.00 != 11.00'),
+            reconcile.Discrepancy('missing', 3, '999', '999', 'No matching PayFastOrder'),
+        ])
+
+    def test_command(self):
+        report = os.path.join(self.dir, 'report.csv')
+        stderr = six.StringIO()
+        call_command('payfast_reconcile', self.path, report=report, chunk_size=2, stderr=stderr)
+        self.assertEqual(self._report(report), [
+            ['kind', 'row_number'], ['mismatch', '2'], ['untrusted', '3'], ['missing', '5'],
+        ])
+        self.assertIn('Reconciled 5 rows: 2 matched, 1 mismatch, 1 missing, 1 untrusted',
+                      stderr.getvalue())
+
+    def test_command_non_ascii(self):
+        with io.open(self.path, 'a', encoding='utf-8') as f:
+            f.write('998,caf\xe9,10.00,-1.00,9.00,COMPLETE\n')
+        report = os.path.join(self.dir, 'report.csv')
+        call_command('payfast_reconcile', self.path, report=report, stderr=six.StringIO())
+        self.assertEqual(self._report(report)[-1], ['missing', '6'])
+        with io.open(report, encoding='utf-8') as f:
+            self.assertIn('998,caf\xe9,', f.read())
+
+        stdout = six.StringIO()
+        call_command('payfast_reconcile', self.path, stdout=stdout, stderr=six.StringIO())
+        self.assertIn('998,caf\xe9,', stdout.getvalue())
+
+    def test_command_resume(self):
+        report = os.path.join(self.dir, 'report.csv')
+        checkpoint_path = os.path.join(self.dir, 'checkpoint.json')
+        checkpoint = reconcile.Checkpoint(checkpoint_path, os.path.abspath(self.path),
+                                          rows=2, counts={'matched': 1, 'mismatch': 1})
+        checkpoint.save()
+        with io.open(report, 'w', encoding='utf-8') as f:
+            f.write('kind,row_number\nmismatch,2\n')
+
+        call_command('payfast_reconcile', self.path, report=report, chunk_size=2,
+                     checkpoint=checkpoint_path, stderr=six.StringIO())
+        self.assertEqual(self._report(report), [
+            ['kind', 'row_number'], ['mismatch', '2'], ['untrusted', '3'], ['missing', '5'],
+        ])
+        checkpoint = reconcile.Checkpoint.load(checkpoint_path, os.path.abspath(self.path))
+        self.assertEqual((checkpoint.rows, checkpoint.counts), (5, {
+            'matched': 2, 'mismatch': 1, 'missing': 1, 'untrusted': 1,
+        }))
+
+
+class SummaryTest(TestCase):
+
+    def _order(self, m_payment_id, status='COMPLETE', gross='10.00', trusted=True):
+        return PayFastOrder.objects.create(
+            m_payment_id=m_payment_id, merchant_id='10000100', payment_status=status,
+            amount_gross=gross, amount_fee='-1.00', amount_net='9.00', trusted=trusted)
+
+    def _summaries(self):
+        return [(s.payment_status, s.count, s.amount_gross, s.amount_net)
+                for s in PayFastDailySummary.objects.order_by('payment_status')]
+
+    def test_update(self):
+        pending = self._order('1', status='PENDING')
+        summaries.update(None, summaries.contribution(pending))
+        summaries.update(None, summaries.contribution(self._order('2', status='PENDING')))
+        self.assertEqual(self._summaries(), [('PENDING', 2, Decimal('20.00'), Decimal('18.00'))])
+
+        # PENDING -> COMPLETE moves the order between rows.
+        before = summaries.contribution(pending)
+        pending.payment_status = 'COMPLETE'
+        summaries.update(before, summaries.contribution(pending))
+        self.assertEqual(self._summaries(), [
+            ('COMPLETE', 1, Decimal('10.00'), Decimal('9.00')),
+            ('PENDING', 1, Decimal('10.00'), Decimal('9.00')),
+        ])
+
+        # Untrusted orders don't count.
+        before = summaries.contribution(pending)
+        pending.trusted = False
+        summaries.update(before, summaries.contribution(pending))
+        self.assertEqual(self._summaries(), [
+            ('COMPLETE', 0, Decimal('0.00'), Decimal('0.00')),
+            ('PENDING', 1, Decimal('10.00'), Decimal('9.00')),
+        ])
+
+    def test_stored_contribution(self):
+        # A concurrent ITN moved the order after this one was looked up:
+        # the contribution to move is that of the stored row.
+        order = self._order('1', status='PENDING')
+        PayFastOrder.objects.filter(pk=order.pk).update(payment_status='COMPLETE')
+        with transaction.atomic():
+            previous = views._stored_contribution(order)
+        self.assertEqual(previous.key.payment_status, 'COMPLETE')
+
+    def test_rebuild_command(self):
+        self._order('1')
+        self._order('2', gross='15.50')
+        self._order('3', status='FAILED')
+        self._order('4', trusted=False)
+        PayFastDailySummary.objects.create(day=datetime.date(2000, 1, 1), merchant_id='stale')
+
+        stdout = six.StringIO()
+        call_command('payfast_rebuild_summaries', chunk_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Rebuilt 2 summary rows\n')
+        self.assertEqual(self._summaries(), [
+            ('COMPLETE', 2, Decimal('25.50'), Decimal('18.00')),
+            ('FAILED', 1, Decimal('10.00'), Decimal('9.00')),
+        ])
+
+
+class SweepTest(TestCase):
+
+    def setUp(self):
+        old = datetime.datetime(2017, 1, 1, tzinfo=utc)
+        for n in range(5):
+            PayFastOrder.objects.create(m_payment_id='old{}'.format(n))
+        PayFastOrder.objects.create(m_payment_id='paid', pf_payment_id='1', trusted=True)
+        PayFastOrder.objects.create(m_payment_id='rejected', trusted=False)
+        PayFastOrder.objects.update(created_at=old)
+        PayFastOrder.objects.create(m_payment_id='new')
+
+    def _ids(self):
+        return sorted(PayFastOrder.objects.values_list('m_payment_id', flat=True))
+
+    def test_sweep(self):
+        reports = []
+        report = sweep.sweep(batch_size=2, sleep=0, progress=reports.append)
+        self.assertEqual((report.batches, report.rows), (3, 5))
+        self.assertEqual([r.rows for r in reports], [2, 4, 5])
+        self.assertEqual(self._ids(), ['new', 'paid', 'rejected'])
+
+    def test_sweep_archive(self):
+        report = sweep.sweep(sleep=0, archive=True)
+        self.assertEqual(report.rows, 5)
+        self.assertEqual(self._ids(), ['new', 'paid', 'rejected'])
+        self.assertEqual(PayFastOrderArchive.objects.count(), 5)
+
+    def test_command_dry_run(self):
+        stdout = six.StringIO()
+        call_command('payfast_sweep_orders', dry_run=True, batch_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Would sweep 5 orders in 3 batches\n')
+        self.assertEqual(len(self._ids()), 8)
+
+        call_command('payfast_sweep_orders', sleep=0, stdout=stdout)
+        self.assertEqual(self._ids(), ['new', 'paid', 'rejected'])
+
+
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='example_user')
+        for (n, status) in enumerate(['COMPLETE', 'FAILED', 'PENDING', 'COMPLETE']):
+            PayFastOrder.objects.create(m_payment_id=str(n), pf_payment_id='pf{}'.format(n),
+                                        payment_status=status, trusted=True, user=self.user,
+                                        amount_gross='10.00')
+        self.old = datetime.datetime(2017, 1, 1, tzinfo=utc)
+        PayFastOrder.objects.exclude(m_payment_id='3').update(
+            created_at=self.old, updated_at=self.old)
+        self.log = PayFastITNLog.objects.create(order=PayFastOrder.objects.get(m_payment_id='0'),
+                                                m_payment_id='0', body=b'')
+
+    def test_archive_orders(self):
+        report = archive.archive_orders(batch_size=1, sleep=0)
+        self.assertEqual((report.batches, report.rows), (2, 2))
+        self.assertEqual(sorted(PayFastOrder.objects.values_list('m_payment_id', flat=True)),
+                         ['2', '3'])
+
+        archived = PayFastOrderArchive.objects.get(m_payment_id='0')
+        self.assertEqual((archived.pf_payment_id, archived.user, archived.created_at,
+                          archived.amount_gross),
+                         ('pf0', self.user, self.old, Decimal('10.00')))
+        self.log.refresh_from_db()
+        self.assertIsNone(self.log.order)
+
+    def test_archive_conflict(self):
+        # An archived order with the same m_payment_id as live order '1'.
+        PayFastOrderArchive.objects.create(id=100, m_payment_id='1', created_at=self.old,
+                                           updated_at=self.old)
+        with patch_logger('payfast.archive', 'warning') as warnings:
+            report = archive.archive_orders(sleep=0)
+        self.assertEqual(report.rows, 1)
+        self.assertEqual(sorted(PayFastOrder.objects.values_list('m_payment_id', flat=True)),
+                         ['1', '2', '3'])
+        [warning] = warnings
+        self.assertIn(str(PayFastOrder.objects.get(m_payment_id='1').pk), warning)
+
+    def test_history(self):
+        call_command('payfast_archive_orders', sleep=0, stdout=six.StringIO())
+
+        self.assertIsInstance(archive.history.get(m_payment_id='0'), PayFastOrderArchive)
+        self.assertIsInstance(archive.history.get(m_payment_id='3'), PayFastOrder)
+        with self.assertRaises(PayFastOrder.DoesNotExist):
+            archive.history.get(m_payment_id='missing')
+
+        self.assertEqual(archive.history.count(payment_status='COMPLETE'), 2)
+        self.assertEqual(sorted(o.m_payment_id for o in archive.history.filter(user=self.user)),
+                         ['0', '1', '2', '3'])
+        with self.assertNumQueries(2):
+            found = archive.history.in_bulk(['pf0', 'pf3', 'pf9'], 'pf_payment_id')
+        self.assertEqual(sorted(found), ['pf0', 'pf3'])
+
+    def test_dry_run(self):
+        stdout = six.StringIO()
+        call_command('payfast_archive_orders', dry_run=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Would archive 2 orders in 1 batches\n')
+        self.assertEqual(PayFastOrderArchive.objects.count(), 0)
+
+
+class MoneyTest(unittest.TestCase):
+
+    def test_to_cents(self):
+        for (value, cents) in [
+                ('123.45', 12345), ('-2.80', -280), ('7', 700), ('7.5', 750), (' 0.01 ', 1),
+                ('1.005', 100), ('1.015', 102), ('1e2', 10000),
+                (100, 10000), (Decimal('99.99'), 9999), (Decimal('-0.5'), -50), (0.1, 10),
+                (None, None), ('', None),
+        ]:
+            self.assertEqual(money.to_cents(value), cents, value)
+
+    def test_to_cents_invalid(self):
+        for value in ['abc', '1.2.3', 'NaN', True, object()]:
+            with self.assertRaises(ValueError, msg=value):
+                money.to_cents(value)
+
+    def test_format(self):
+        self.assertEqual(money.format_cents(12345), '123.45')
+        self.assertEqual(money.format_cents(-5), '-0.05')
+        self.assertEqual(money.format_amount(100), '100.00')
+        self.assertEqual(money.from_cents(-280), Decimal('-2.80'))
+        self.assertIsNone(money.from_cents(None))
+
+
+class AmountCentsTest(TestCase):
+
+    def test_save(self):
+        order = PayFastOrder.objects.create(amount_gross='10.50', amount_fee=Decimal('-0.25'))
+        order = PayFastOrder.objects.get(pk=order.pk)
+        self.assertEqual((order.amount_gross_cents, order.amount_fee_cents, order.amount_net_cents),
+                         (1050, -25, None))
+
+        order.amount_gross = 12
+        order.save(update_fields=['amount_gross'])
+        self.assertEqual(PayFastOrder.objects.get(pk=order.pk).amount_gross_cents, 1200)
+
+    def test_amount_totals(self):
+        for gross in ['10.01', '20.02', '0.07']:
+            PayFastOrder.objects.create(amount_gross=gross)
+        self.assertEqual(PayFastOrder.objects.amount_totals(), {
+            'amount_gross': Decimal('30.10'), 'amount_fee': None, 'amount_net': None,
+        })
+
+    def test_backfill_migration(self):
+        for gross in ['10.01', None]:
+            PayFastOrder.objects.create(amount_gross=gross, amount_net='9.00')
+
+        migration = importlib.import_module('payfast.migrations.0009_backfill_amount_cents')
+        # Span more than one batch.
+        PayFastOrder.objects.bulk_create(
+            PayFastOrder(amount_gross='1.00') for _ in range(migration.BATCH_SIZE))
+        PayFastOrder.objects.update(amount_gross_cents=None, amount_net_cents=None)
+
+        schema_editor = type(str('SchemaEditor'), (), {'connection': connection})
+        migration.backfill_amount_cents(django_apps, schema_editor)
+        self.assertEqual(
+            list(PayFastOrder.objects.order_by('pk').values_list('amount_gross_cents',
+                                                                 'amount_net_cents')),
+            [(1001, 900), (None, 900)] + [(100, None)] * migration.BATCH_SIZE)
+
+
+class PaymentStatusCodeTest(TestCase):
+
+    def test_save(self):
+        for (status, code) in [('COMPLETE', 1), ('CANCELLED', 4), ('REFUNDED', 0), (None, None)]:
+            order = PayFastOrder.objects.create(m_payment_id=str(status), payment_status=status)
+            order = PayFastOrder.objects.get(pk=order.pk)
+            self.assertEqual((order.payment_status, order.payment_status_code), (status, code))
+
+    def test_filters(self):
+        for status in ['COMPLETE', 'REFUNDED', 'CHARGEBACK']:
+            PayFastOrder.objects.create(m_payment_id=status, payment_status=status, trusted=True)
+        for status in ['COMPLETE', 'REFUNDED']:
+            [order] = PayFastOrder.objects.with_status(status)
+            self.assertEqual(order.m_payment_id, status)
+
+        self.assertEqual(PayFastOrder.objects.transition('CANCELLED', from_statuses=['REFUNDED']),
+                         1)
+        order = PayFastOrder.objects.get(m_payment_id='REFUNDED')
+        self.assertEqual((order.payment_status, order.payment_status_code), ('CANCELLED', 4))
+
+    def test_payment_status_code(self):
+        self.assertEqual(payment_status_code(' complete '), 1)
+        self.assertEqual(payment_status_code('SOMETHING_NEW'), 0)
+        self.assertEqual(payment_status_code(''), None)
+
+    def test_backfill_migration(self):
+        for status in ['COMPLETE', 'pending', ' Failed ', 'SOMETHING_NEW', None]:
+            PayFastOrder.objects.create(m_payment_id=str(status), payment_status=status)
+        PayFastOrder.objects.update(payment_status_code=None)
+
+        migration = importlib.import_module('payfast.migrations.0010_payment_status_code')
+        schema_editor = type(str('SchemaEditor'), (), {'connection': connection})
+        migration.backfill_payment_status_code(django_apps, schema_editor)
+        self.assertEqual(
+            list(PayFastOrder.objects.order_by('pk').values_list('payment_status_code', flat=True)),
+            [1, 2, 3, 0, None])
+
+
+@override_settings(DATABASE_ROUTERS=['payfast.routers.PayFastRouter'],
+                   PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class RouterTest(TransactionTestCase):
+    """
+    The "replica" database is a separate (empty) database here, so reads
+    that reach it don't find the orders written to the primary.
+    """
+    multi_db = True
+
+    def setUp(self):
+        conf.DATABASE_REPLICAS = ['replica']
+        conf.USE_POSTBACK = False
+        conf.MERCHANT_ID = '10000100'
+        routers.unstick('1')
+        self.router = routers.PayFastRouter()
+        PayFastOrder.objects.create(m_payment_id='1')
+
+    def tearDown(self):
+        conf.DATABASE_REPLICAS = []
+        routers.unstick('1')
+
+    def _on_replica(self):
+        return PayFastOrder.objects.filter(m_payment_id='1').exists() is False
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(PayFastOrder.objects.all().db, 'replica')
+        self.assertTrue(self._on_replica())
+        self.assertEqual(self.router.db_for_write(PayFastOrder), 'default')
+        self.assertIsNone(self.router.db_for_read(User))
+        self.assertIsNone(self.router.db_for_write(User))
+
+    def test_use_primary(self):
+        with routers.use_primary():
+            self.assertFalse(self._on_replica())
+            with routers.use_primary():
+                self.assertFalse(self._on_replica())
+            self.assertFalse(self._on_replica())
+        self.assertTrue(self._on_replica())
+
+    def test_atomic(self):
+        with transaction.atomic():
+            self.assertFalse(self._on_replica())
+
+    def test_sticky(self):
+        routers.stick('1', 60)
+        # Only reads of the sticky order stay on the primary.
+        self.assertTrue(self._on_replica())
+        with routers.use_primary_for('1'):
+            self.assertFalse(self._on_replica())
+        with routers.use_primary_for('2'):
+            self.assertTrue(self._on_replica())
+        order = PayFastOrder.objects.using('default').get(m_payment_id='1')
+        self.assertEqual(self.router.db_for_read(PayFastOrder, instance=order), 'default')
+
+        routers.unstick('1')
+        with routers.use_primary_for('1'):
+            self.assertTrue(self._on_replica())
+        self.assertEqual(self.router.db_for_read(PayFastOrder, instance=order), 'replica')
+
+    def test_checkout_and_itn(self):
+        checkout_data = _test_data()
+        payment_form = PayFastForm(initial={
+            'amount': checkout_data['amount'],
+            'item_name': checkout_data['item_name'],
+            'm_payment_id': '1',
+        })
+        self.assertEqual(payment_form.order.m_payment_id, '1')
+        self.assertEqual(PayFastOrder.objects.using('default').count(), 1)
+
+        # The order is only on the primary: the ITN must look it up there.
+        response = self.client.post(notify_url(), _itn_data_from_checkout(checkout_data,
+                                                                          payment_form))
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertTrue(routers.is_sticky('1'))
+        self.assertFalse(routers.is_sticky('2'))
+        with routers.use_primary_for('1'):
+            self.assertEqual(PayFastOrder.objects.get(m_payment_id='1').trusted, True)
+
+    def test_allow_migrate(self):
+        self.assertIs(self.router.allow_migrate('replica', 'payfast'), False)
+        self.assertIsNone(self.router.allow_migrate('default', 'payfast'))
+        self.assertIsNone(self.router.allow_migrate('replica', 'auth'))
+        # Django 1.7 passes the model instead.
+        self.assertIs(self.router.allow_migrate('replica', PayFastOrder), False)
+        self.assertIsNone(self.router.allow_migrate('replica', User))
+
+
+@override_settings(PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class MerchantTest(TestCase):
+
+    def setUp(self):
+        conf.USE_POSTBACK = False
+        conf.MERCHANT_ID = '10000100'
+        conf.REQUIRE_AMOUNT_MATCH = True
+        conf.MERCHANTS = {
+            '20000200': {'merchant_key': 'key2', 'passphrase': 'secret', 'test_mode': True},
+        }
+        merchants.reset()
+
+    def tearDown(self):
+        conf.MERCHANTS = {}
+        merchants.reset()
+
+    def test_registry(self):
+        registry = merchants.get_registry()
+        self.assertIs(merchants.get_registry(), registry)
+        self.assertEqual([m.merchant_id for m in registry], ['10000100', '20000200'])
+        self.assertEqual(registry.default.merchant_key, '46f0cd694581a')
+        self.assertIsNone(registry.get('30000300'))
+
+        merchant = registry.get('20000200')
+        self.assertEqual(merchant.server, conf.SANDBOX_SERVER)
+        self.assertIs(merchant.signer, merchant.signer)
+        self.assertIs(merchant.postback, merchant.postback)
+        self.assertEqual(merchant.postback.server, conf.SANDBOX_SERVER)
+
+    def test_invalid_settings(self):
+        conf.MERCHANTS = {'20000200': {'key': 'key2'}}
+        merchants.reset()
+        with self.assertRaises(ImproperlyConfigured):
+            merchants.get_registry()
+
+    def _checkout(self, merchant_id):
+        checkout_data = _test_data()
+        checkout_data['merchant_id'] = merchant_id
+        del checkout_data['merchant_key']
+        form = PayFastForm(initial={
+            'amount': checkout_data['amount'],
+            'item_name': checkout_data['item_name'],
+            'merchant_id': merchant_id,
+        })
+        checkout_data['merchant_key'] = form.initial['merchant_key']
+        notify_data = _itn_data_from_checkout(checkout_data, form)
+        return (form, notify_data)
+
+    def test_notify(self):
+        (form, notify_data) = self._checkout('20000200')
+        self.assertEqual(form.initial['merchant_key'], 'key2')
+        self.assertEqual(form.target, conf.SANDBOX_SERVER + '/eng/process')
+        self.assertEqual(form.fields['signature'].initial,
+                         api.checkout_signature(form.initial, 'secret'))
+
+        # Without the passphrase, the signature is invalid.
+        response = self.client.post(notify_url(), notify_data)
+        self.assertEqual(response.status_code, 400)
+
+        notify_data['signature'] = api.itn_signature(notify_data, 'secret')
+        response = self.client.post(notify_url(), notify_data)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(_order().merchant_id, '20000200')
+
+    def test_unknown_merchant(self):
+        (form, notify_data) = self._checkout('30000300')
+        response = self.client.post(notify_url(), notify_data)
+        self.assertEqual(json.loads(response.content), {
+            'merchant_id': [{'code': '', 'message': 'Invalid merchant id (30000300).'}],
+        })
+
+
+@override_settings(PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class ProfilingTest(TestCase):
+
+    def setUp(self):
+        conf.USE_POSTBACK = False
+        conf.MERCHANT_ID = '10000100'
+        conf.PROFILE_RATE = 1.0
+        conf.PROFILE_MODE = 'cprofile'
+        conf.PROFILE_DIR = tempfile.mkdtemp()
+        conf.PROFILE_DUMP_INTERVAL = 0
+        conf.PROFILE_STACK_INTERVAL = 0.001
+        profiling.reset()
+
+    def tearDown(self):
+        shutil.rmtree(conf.PROFILE_DIR)
+        conf.PROFILE_RATE = 0.0
+        conf.PROFILE_DIR = None
+        conf.PROFILE_DUMP_INTERVAL = 60
+        profiling.reset()
+
+    def _middleware_settings(self):
+        name = 'MIDDLEWARE' if django.VERSION >= (1, 10) else 'MIDDLEWARE_CLASSES'
+        return override_settings(**{
+            name: list(getattr(settings, name)) + ['payfast.profiling.ProfilingMiddleware'],
+        })
+
+    def test_middleware(self):
+        checkout_data = _test_data()
+        payment_form = PayFastForm(initial={
+            'amount': checkout_data['amount'],
+            'item_name': checkout_data['item_name'],
+        })
+        with self._middleware_settings():
+            response = self.client.post(
+                notify_url(), _itn_data_from_checkout(checkout_data, payment_form))
+            self.assertEqual(response.status_code, 200, response.content)
+            # Other views are not profiled.
+            self.client.get('/admin/login/')
+
+        [path] = os.listdir(conf.PROFILE_DIR)
+        self.assertEqual(path, 'payfast-payfast_notify-{}.pstats'.format(os.getpid()))
+        stats = pstats.Stats(os.path.join(conf.PROFILE_DIR, path))
+        self.assertIn('process_itn', {name for (_, _, name) in stats.stats})
+
+    def test_not_sampled(self):
+        conf.PROFILE_RATE = 0.0
+        self.assertIsNone(profiling.start('example'))
+        with self._middleware_settings():
+            self.client.post(notify_url(), {})
+        self.assertEqual(os.listdir(conf.PROFILE_DIR), [])
+
+    def test_stack_mode(self):
+        conf.PROFILE_MODE = 'stack'
+
+        @profiling.profiled()
+        def slow_view():
+            threading.Event().wait(0.05)
+
+        slow_view()
+        [path] = profiling.get_store().dump()
+        self.assertTrue(path.endswith('.collapsed'))
+        with io.open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any('payfast.tests.slow_view' in line for line in lines), lines)
+
+
+@override_settings(PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        conf.USE_POSTBACK = False
+        conf.MERCHANT_ID = '10000100'
+        conf.REQUIRE_AMOUNT_MATCH = True
+        conf.METRICS_VIEW = True
+        metrics.reset()
+
+    def tearDown(self):
+        conf.METRICS_VIEW = False
+        conf.METRICS_DIR = None
+        metrics.reset()
+
+    def _notify_data(self):
+        checkout_data = _test_data()
+        payment_form = PayFastForm(initial={
+            'amount': checkout_data['amount'],
+            'item_name': checkout_data['item_name'],
+        })
+        return _itn_data_from_checkout(checkout_data, payment_form)
+
+    def _exposition(self):
+        response = self.client.get('/payfast/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        return response.content.decode('utf-8').splitlines()
+
+    def test_notify(self):
+        self.client.post(notify_url(), self._notify_data())
+        self.client.post(notify_url(), self._notify_data(), REMOTE_ADDR='127.0.0.2')
+        self.client.post(notify_url(), {})
+
+        lines = self._exposition()
+        for line in [
+            'payfast_itn_received_total 3',
+            'payfast_itn_accepted_total 1',
+            'payfast_itn_rejected_total{reason="untrusted_ip"} 1',
+            'payfast_itn_not_found_total 1',
+            'payfast_itn_db_seconds_bucket{le="+Inf"} 3',
+            'payfast_itn_db_seconds_count 3',
+        ]:
+            self.assertIn(line, lines)
+
+    def test_postback_seconds(self):
+        conf.USE_POSTBACK = True
+        data_is_valid = api.data_is_valid
+        api.data_is_valid = lambda post_data, postback_server: False
+        try:
+            self.client.post(notify_url(), self._notify_data())
+        finally:
+            api.data_is_valid = data_is_valid
+            conf.USE_POSTBACK = False
+
+        self.assertEqual(metrics.ITN_REJECTED.labels(reason='postback_invalid').value(), 1)
+        value = metrics.POSTBACK_SECONDS.labels().value()
+        self.assertEqual(sum(value['buckets']), 1)
+
+    def test_rejection_reason(self):
+        notify_data = self._notify_data()
+        cases = [
+            ({'signature': 'x'}, 'bad_signature'),
+            ({'merchant_id': '1'}, 'merchant_mismatch'),
+            ({'amount_gross': '1.00'}, 'amount_mismatch'),
+            ({'item_name': ''}, 'invalid_data'),
+        ]
+        for (changes, reason) in cases:
+            data = dict(notify_data, **changes)
+            if 'signature' not in changes:
+                data['signature'] = api.itn_signature(data)
+            request = RequestFactory().post(notify_url(), data)
+            form = NotifyForm(request, request.POST, instance=_order())
+            self.assertFalse(form.is_valid())
+            self.assertEqual(form.rejection_reason(), reason, form.errors)
+
+    def test_disabled(self):
+        conf.METRICS_VIEW = False
+        self.assertEqual(self.client.get('/payfast/metrics/').status_code, 404)
+
+    def test_multiprocess(self):
+        conf.METRICS_DIR = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, conf.METRICS_DIR)
+        # Another worker's totals.
+        metrics.ITN_RECEIVED.inc(2)
+        metrics.ITN_REJECTED.labels(reason='bad_signature').inc()
+        metrics.POSTBACK_SECONDS.observe(0.2)
+        other = json.dumps(metrics.REGISTRY.snapshot())
+        with io.open(os.path.join(conf.METRICS_DIR, 'payfast-metrics-1.json'), 'w') as f:
+            f.write(other)
+        metrics.reset()
+
+        self.client.post(notify_url(), self._notify_data())
+        metrics.POSTBACK_SECONDS.observe(3)
+
+        lines = self._exposition()
+        for line in [
+            'payfast_itn_received_total 3',
+            'payfast_itn_accepted_total 1',
+            'payfast_itn_rejected_total{reason="bad_signature"} 1',
+            'payfast_postback_seconds_bucket{le="0.25"} 1',
+            'payfast_postback_seconds_bucket{le="5"} 2',
+            'payfast_postback_seconds_sum 3.2',
+            'payfast_postback_seconds_count 2',
+        ]:
+            self.assertIn(line, lines)
+        self.assertEqual(sorted(os.listdir(conf.METRICS_DIR)), [
+            'payfast-metrics-1.json', 'payfast-metrics-{}.json'.format(os.getpid())])
+
+    def test_concurrent_flushes(self):
+        conf.METRICS_DIR = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, conf.METRICS_DIR)
+        errors = []
+
+        def work():
+            try:
+                for _ in range(20):
+                    metrics.flush()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(conf.METRICS_DIR),
+                         ['payfast-metrics-{}.json'.format(os.getpid())])
+
+    def test_flush_error(self):
+        # The directory can't be created: a file is in the way.
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        conf.METRICS_DIR = os.path.join(path, 'metrics')
+        with patch_logger('payfast.metrics', 'exception') as logged:
+            response = self.client.post(notify_url(), self._notify_data())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(len(logged), 1)
+
+    @unittest.skipIf(os.name != 'posix', 'Folding needs fcntl')
+    def test_exited_workers(self):
+        conf.METRICS_DIR = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, conf.METRICS_DIR)
+        # The totals of two exited workers, one of which had this process's pid.
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        metrics.ITN_RECEIVED.inc(2)
+        for pid in [exited.pid, os.getpid()]:
+            with io.open(os.path.join(conf.METRICS_DIR, 'payfast-metrics-{}.json'.format(pid)),
+                         'w') as f:
+                f.write(json.dumps(metrics.REGISTRY.snapshot()))
+        metrics.reset()
+
+        metrics.ITN_RECEIVED.inc()
+        self.assertIn('payfast_itn_received_total 5', self._exposition())
+        self.assertEqual(sorted(os.listdir(conf.METRICS_DIR)), [
+            'payfast-metrics-{}.json'.format(os.getpid()), 'payfast-metrics-exited.json',
+            'payfast-metrics.lock'])
+        # Collecting again doesn't count them twice.
+        self.assertIn('payfast_itn_received_total 5', self._exposition())
+
+    def test_threads(self):
+        def work():
+            for _ in range(1000):
+                metrics.ITN_RECEIVED.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.ITN_RECEIVED.labels().value(), 4000)
+
+
+@override_settings(PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class TracingTest(TestCase):
+
+    def setUp(self):
+        conf.USE_POSTBACK = False
+        conf.MERCHANT_ID = '10000100'
+        conf.TRACE_RATE = 1.0
+        self.exporter = tracing.MemoryExporter()
+        conf.TRACE_EXPORTERS = [self.exporter]
+        tracing.reset()
+
+    def tearDown(self):
+        conf.TRACE_RATE = 0.0
+        conf.TRACE_EXPORTERS = ['payfast.tracing.LoggingExporter']
+        tracing.reset()
+
+    def _notify_data(self):
+        checkout_data = _test_data()
+        payment_form = PayFastForm(initial={
+            'amount': checkout_data['amount'],
+            'item_name': checkout_data['item_name'],
+        })
+        return _itn_data_from_checkout(checkout_data, payment_form)
+
+    def test_checkout_and_notify(self):
+        notify_data = self._notify_data()
+        response = self.client.post(notify_url(), notify_data)
+        self.assertEqual(response.status_code, 200, response.content)
+
+        spans = self.exporter.spans
+        self.assertEqual([span.name for span in spans], [
+            'payfast.checkout.order',
+            'payfast.checkout.sign',
+            'payfast.checkout',
+            'payfast.notify.lookup',
+            'payfast.notify.validate',
+            'payfast.notify.save',
+            'payfast.notify.signal',
+            'payfast.notify',
+        ])
+        (checkout, notify) = (spans[2], spans[-1])
+        m_payment_id = notify_data['m_payment_id']
+        self.assertEqual(checkout.attributes['m_payment_id'], m_payment_id)
+        self.assertEqual(notify.attributes['m_payment_id'], m_payment_id)
+        self.assertEqual(notify.attributes['verdict'], PayFastITNLog.VERDICT_ACCEPTED)
+        # The checkout and the ITN of an order share a trace.
+        self.assertEqual({span.trace_id for span in spans}, {tracing.trace_id_for(m_payment_id)})
+        self.assertEqual([span.parent_id for span in spans[:2]], [checkout.span_id] * 2)
+        self.assertEqual([span.parent_id for span in spans[3:-1]], [notify.span_id] * 4)
+        self.assertIsNone(notify.parent_id)
+
+    def test_postback(self):
+        conf.USE_POSTBACK = True
+        data_is_valid = api.data_is_valid
+        api.data_is_valid = lambda post_data, postback_server: True
+        try:
+            self.client.post(notify_url(), self._notify_data())
+        finally:
+            api.data_is_valid = data_is_valid
+            conf.USE_POSTBACK = False
+
+        [postback] = [span for span in self.exporter.spans
+                      if span.name == 'payfast.notify.postback']
+        [validate] = [span for span in self.exporter.spans
+                      if span.name == 'payfast.notify.validate']
+        self.assertEqual(postback.parent_id, validate.span_id)
+
+    def test_sampling(self):
+        conf.TRACE_RATE = 0.0
+        self._notify_data()
+        self.assertEqual(self.exporter.spans, [])
+
+        # The decision follows the m_payment_id.
+        conf.TRACE_RATE = 0.5
+        decisions = {m_payment_id: tracing._sampled(m_payment_id)
+                     for m_payment_id in map(str, range(100))}
+        self.assertTrue(20 < sum(decisions.values()) < 80, decisions)
+        for (m_payment_id, sampled) in decisions.items():
+            self.assertEqual(tracing._sampled(m_payment_id), sampled)
+        # Integer ids (such as from PayFastForm's initial data) are hashed as text.
+        self.assertEqual(tracing._sampled(42), decisions['42'])
+
+    def test_integer_m_payment_id(self):
+        self.assertEqual(tracing.trace_id_for(42), tracing.trace_id_for('42'))
+        with tracing.trace('example', 42):
+            pass
+        [span] = self.exporter.spans
+        self.assertEqual(span.trace_id, tracing.trace_id_for('42'))
+
+    def test_error(self):
+        class BrokenExporter(object):
+            def export(self, spans):
+                raise ValueError('broken')
+
+        conf.TRACE_EXPORTERS = [BrokenExporter(), self.exporter]
+        tracing.reset()
+        with self.assertRaises(KeyError), patch_logger('payfast.tracing', 'exception') as logged:
+            with tracing.trace('example', 'order-1'):
+                with tracing.span('child'):
+                    raise KeyError('example')
+        self.assertEqual(len(logged), 1)
+        self.assertEqual([(span.name, span.error) for span in self.exporter.spans],
+                         [('child', 'KeyError'), ('example', 'KeyError')])
+        # Untraced code gets no-op spans.
+        self.assertIs(tracing.current_span(), tracing.NOOP_SPAN)
+
+
+class _PostbackHandler(BaseHTTPRequestHandler):
+    """
+    Answer postbacks with VALID, over keep-alive connections.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.postbacks += 1
+        self.send_response(200)
+        self.send_header('Content-Length', '5')
+        self.end_headers()
+        self.wfile.write(b'VALID')
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    pass
+
+
+class PostbackPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _PostbackHandler)
+        self.server.daemon_threads = True
+        (self.server.connections, self.server.postbacks) = (0, 0)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        conf.POSTBACK_POOL_SIZE = 2
+        (self.conf_server, self.conf_use_postback) = (conf.SERVER, conf.USE_POSTBACK)
+        conf.USE_POSTBACK = True
+        conf.HEALTH_VIEW = True
+        merchants.reset()
+        warmup.reset()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        conf.POSTBACK_POOL_SIZE = 0
+        conf.HEALTH_VIEW = False
+        (conf.SERVER, conf.USE_POSTBACK) = (self.conf_server, self.conf_use_postback)
+        api.reset_pools()
+        merchants.reset()
+        warmup.reset()
+
+    def test_reuse(self):
+        client = merchants.PostbackClient(self.url)
+        self.assertIs(client.pool, api.get_pool(self.url + '/', 2))
+        for _ in range(3):
+            self.assertTrue(client.validate({'item_name': 'example'}))
+        self.assertEqual((self.server.connections, self.server.postbacks), (1, 3))
+        self.assertEqual(client.pool.stats(), {'size': 2, 'idle': 1, 'in_use': 0})
+
+    def test_reconnect(self):
+        pool = api.get_pool(self.url, 2)
+        self.assertEqual(pool.warm(5), 2)
+        # The server drops the idle connections.
+        for idle in pool._idle:
+            idle.sock.close()
+        self.assertTrue(api.data_is_valid({}, self.url))
+        self.assertEqual(self.server.postbacks, 1)
+
+    def test_warmup(self):
+        conf.SERVER = self.url
+        with self.settings(PAYFAST_IP_ADDRESSES=['127.0.0.1']):
+            response = self.client.get('/payfast/ready/')
+            self.assertEqual(response.status_code, 200)
+            warmup.start()
+            self.assertTrue(warmup._state.done.wait(5))
+
+            response = self.client.get('/payfast/ready/')
+            self.assertEqual(response.status_code, 200)
+            report = json.loads(response.content.decode('utf-8'))
+            self.assertTrue(report['ready'])
+            self.assertEqual(list(report['warmup']), [name for (name, _) in warmup.STEPS])
+            for seconds in report['warmup'].values():
+                self.assertIsInstance(seconds, float)
+
+            # The first postback reuses a warm connection.
+            pool = merchants.get_registry().default.postback.pool
+            warm = list(pool._idle)
+            self.assertEqual(len(warm), 2)
+            merchants.get_registry().default.postback.validate({})
+            self.assertEqual(set(pool._idle), set(warm))
+            self.assertEqual(self.server.postbacks, 1)
+
+    def test_start_on_request(self):
+        conf.SERVER = self.url
+        conf.WARMUP = True
+        try:
+            django_apps.get_app_config('payfast').ready()
+        finally:
+            conf.WARMUP = False
+        self.addCleanup(request_started.disconnect,
+                        dispatch_uid='payfast.warmup.start_on_request')
+        # Management commands don't warm up.
+        call_command('check', stdout=six.StringIO())
+        self.assertFalse(warmup._state.started)
+
+        with self.settings(PAYFAST_IP_ADDRESSES=['127.0.0.1']):
+            self.client.get('/payfast/ready/')
+            self.assertTrue(warmup._state.started)
+            self.assertTrue(warmup._state.done.wait(5))
+            self.assertEqual(self.client.get('/payfast/ready/').status_code, 200)
+
+    def test_fork(self):
+        pool = api.get_pool(self.url, 2)
+        self.assertEqual(pool.warm(2), 2)
+        warmup._state.started = True
+        self.assertFalse(warmup.is_ready())
+
+        # A forked process has no warm-up thread, nor its parent's connections.
+        (pool._pid, warmup._state.pid) = (-1, -1)
+        self.assertTrue(warmup.is_ready())
+        self.assertFalse(warmup._state.started)
+        self.assertEqual(pool.stats(), {'size': 2, 'idle': 0, 'in_use': 0})
+
+    def test_not_ready(self):
+        warmup._state.started = True
+        response = self.client.get('/payfast/ready/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.content.decode('utf-8')),
+                         {'ready': False, 'warmup': {}})
+
+    def test_failed_step(self):
+        conf.SERVER = 'http://127.0.0.1:1'
+        with patch_logger('payfast.warmup', 'exception') as logged:
+            report = warmup.run()
+        self.assertEqual(len(logged), 1)
+        # The error type, without its message.
+        self.assertIsInstance(report['postback_connections'], six.string_types)
+        self.assertNotIn(' ', report['postback_connections'])
+        self.assertIsInstance(report['urls'], float)
+        self.assertTrue(warmup.is_ready())
+
+    def test_app_config(self):
+        self.assertIsInstance(django_apps.get_app_config('payfast'), PayFastConfig)
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    def test_breaker(self):
+        now = [0.0]
+        breaker = merchants.CircuitBreaker(2, 10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        # After the timeout, one trial call.
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        now[0] = 20
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.stats(), {'state': 'closed', 'failures': 0,
+                                           'seconds_in_state': 0})
+
+
+@override_settings(PAYFAST_IP_ADDRESSES=['127.0.0.1'])
+class HealthTest(TestCase):
+
+    def setUp(self):
+        conf.USE_POSTBACK = False
+        conf.MERCHANT_ID = '10000100'
+        conf.HEALTH_DB_INTERVAL = 0
+        conf.HEALTH_VIEW = True
+        health.reset()
+        merchants.reset()
+        warmup.reset()
+
+    def tearDown(self):
+        conf.HEALTH_DB_INTERVAL = 10
+        conf.HEALTH_VIEW = False
+        conf.POSTBACK_BREAKER_THRESHOLD = 0
+        health.reset()
+        merchants.reset()
+
+    def _health(self, status_code=200):
+        with self.assertNumQueries(0):
+            response = self.client.get('/payfast/health/')
+        self.assertEqual(response.status_code, status_code, response.content)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_health(self):
+        report = self._health()
+        self.assertEqual(report['status'], 'ok')
+        self.assertEqual(report['database']['reachable'], None)
+        self.assertEqual(report['notify'], {'window_seconds': 60, 'received': 0,
+                                            'error_rate': 0.0})
+        [postback] = report['postback']
+        self.assertIsNone(postback['breaker'])
+        self.assertNotIn('10000100', json.dumps(report))
+
+        checkout_data = _test_data()
+        payment_form = PayFastForm(initial={
+            'amount': checkout_data['amount'],
+            'item_name': checkout_data['item_name'],
+        })
+        self.client.post(notify_url(), _itn_data_from_checkout(checkout_data, payment_form))
+        self.client.post(notify_url(), {})
+
+        report = self._health()
+        self.assertEqual(report['status'], 'ok')
+        self.assertEqual(report['database']['reachable'], True)
+        self.assertEqual(report['notify'], {'window_seconds': 60, 'received': 2,
+                                            'accepted': 1, 'not_found': 1, 'error_rate': 0.0})
+
+    def test_database_error(self):
+        health.record_itn_error(DatabaseError('gone'))
+        report = self._health(503)
+        self.assertEqual(report['status'], 'unavailable')
+        self.assertEqual(report['database']['error'], 'DatabaseError')
+        self.assertEqual(report['notify']['error_rate'], 1.0)
+
+        self.assertTrue(health.check_database())
+        self.assertEqual(self._health()['status'], 'degraded')
+
+    def test_breaker_open(self):
+        conf.POSTBACK_BREAKER_THRESHOLD = 2
+        calls = []
+
+        def failing_data_is_valid(post_data, postback_server):
+            calls.append(post_data)
+            raise IOError('unreachable')
+
+        client = merchants.get_registry().default.postback
+        data_is_valid = api.data_is_valid
+        api.data_is_valid = failing_data_is_valid
+        try:
+            for _ in range(2):
+                with self.assertRaises(IOError):
+                    client.validate({})
+            # The circuit is open: fail fast.
+            with self.assertRaises(merchants.PostbackUnavailable):
+                client.validate({})
+
+            # ITNs are answered with a retryable 503, leaving the order untouched.
+            conf.USE_POSTBACK = True
+            checkout_data = _test_data()
+            payment_form = PayFastForm(initial={
+                'amount': checkout_data['amount'],
+                'item_name': checkout_data['item_name'],
+            })
+            response = self.client.post(
+                notify_url(), _itn_data_from_checkout(checkout_data, payment_form))
+        finally:
+            api.data_is_valid = data_is_valid
+            conf.USE_POSTBACK = False
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(conf.POSTBACK_BREAKER_RESET))
+        order = _order()
+        self.assertEqual((order.trusted, order.debug_info), (None, None))
+        self.assertFalse(PayFastDailySummary.objects.exists())
+
+        report = self._health()
+        self.assertEqual(report['status'], 'degraded')
+        self.assertEqual(report['postback'][0]['breaker']['state'], 'open')
+
+    def test_starting(self):
+        warmup._state.started = True
+        self.assertEqual(self._health(503)['status'], 'starting')
+
+    def test_disabled(self):
+        conf.HEALTH_VIEW = False
+        self.assertEqual(self.client.get('/payfast/health/').status_code, 404)
+        self.assertEqual(self.client.get('/payfast/ready/').status_code, 404)
+
+    def test_recent_counts(self):
+        now = [100.0]
+        counts = health.RecentCounts(60, clock=lambda: now[0])
+        counts.add('accepted')
+        now[0] = 130
+        counts.add('rejected')
+        self.assertEqual(counts.totals(), {'accepted': 1, 'rejected': 1})
+        now[0] = 160
+        self.assertEqual(counts.totals(), {'rejected': 1})
+        now[0] = 190
+        self.assertEqual(counts.totals(), {})
+
+
 class IPTest(SimpleTestCase):
 
     @override_settings(PAYFAST_IP_ADDRESSES=[])
@@ -0,0 +1,239 @@
+"""
+Lightweight tracing of the checkout and ITN flows.
+
+The checkout (`PayFastForm`: order creation and signing) and the notify view
+(order lookup, validation, postback and signal dispatch) each record a trace:
+a root span and its child spans, with their durations. Both carry the order's
+`m_payment_id` as an attribute, and derive their trace id from it, so a buyer's
+checkout and the later ITNs for the same order share a trace id.
+
+Settings:
+
+* `PAYFAST_TRACE_RATE`: The fraction of orders to trace (default: 0, off).
+  The decision is a hash of the `m_payment_id`, so the checkout and the ITNs
+  of an order are traced together. (Checkouts without a caller-supplied
+  `m_payment_id` are sampled at random.) An untraced flow costs a hash, and
+  a thread-local lookup per span.
+* `PAYFAST_TRACE_EXPORTERS`: The exporters that receive each finished trace,
+  as objects or dotted paths (default: ``['payfast.tracing.LoggingExporter']``).
+
+An exporter is any object with an ``export(spans)`` method, which is passed the
+finished spans of a trace, root last. Exporters run in the traced request:
+hand the spans off to a queue if exporting is slow. For example, to forward
+spans to an OpenTelemetry or Zipkin client, write a small exporter that maps
+each `Span` to that client's span type.
+
+Spans are thread-local: work handed off to other threads (such as concurrent
+postbacks, or deferred `notify` receivers) is covered by the span that waits
+for, or schedules it.
+"""
+from __future__ import unicode_literals
+
+import binascii
+import hashlib
+import logging
+import os
+import random
+import threading
+import zlib
+from contextlib import contextmanager
+from timeit import default_timer
+from typing import Any, Dict, Iterator, List, Optional  # noqa: F401
+
+from django.utils.module_loading import import_string
+from six import string_types, text_type
+
+from payfast import conf
+
+
+logger = logging.getLogger(__name__)
+
+
+def _random_id(size):  # type: (int) -> str
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+def trace_id_for(m_payment_id):  # type: (object) -> str
+    """
+    Return the trace id of the flows of the order `m_payment_id` (as text: an
+    integer id and its string form share a trace id).
+    """
+    return hashlib.sha1(('payfast:' + text_type(m_payment_id)).encode('utf-8')).hexdigest()[:32]
+
+
+class Span(object):
+    """
+    A timed operation within a trace.
+
+    `trace_id` is set when the trace finishes. `duration` is in seconds, and
+    `error` is the name of the exception that ended the span, if any.
+    """
+
+    def __init__(self, name, parent_id, attributes):
+        # type: (str, Optional[str], Dict[str, Any]) -> None
+        self.name = name
+        self.trace_id = None  # type: Optional[str]
+        self.span_id = _random_id(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = default_timer()
+        self.duration = None  # type: Optional[float]
+        self.error = None  # type: Optional[str]
+
+    def set_attribute(self, key, value):  # type: (str, Any) -> None
+        self.attributes[key] = value
+
+    def __repr__(self):
+        return '<Span {} {}: {}>'.format(self.name, self.span_id, self.attributes)
+
+
+class _NoopSpan(object):
+    """
+    The span of untraced flows.
+    """
+
+    def set_attribute(self, key, value):  # type: (str, Any) -> None
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Trace(object):
+
+    def __init__(self):  # type: () -> None
+        self.stack = []  # type: List[Span]
+        self.finished = []  # type: List[Span]
+
+
+_local = threading.local()
+
+
+def _sampled(m_payment_id):  # type: (Optional[object]) -> bool
+    rate = conf.TRACE_RATE
+    if not rate:
+        return False
+    if rate >= 1:
+        return True
+    if m_payment_id is None:
+        return random.random() < rate
+    return (zlib.crc32(text_type(m_payment_id).encode('utf-8')) & 0xffffffff) < rate * 2 ** 32
+
+
+@contextmanager
+def trace(name, m_payment_id=None, **attributes):
+    # type: (str, Optional[str], **Any) -> Iterator[Any]
+    """
+    Start a trace for the order `m_payment_id` (if it is sampled), with a root span `name`.
+
+    Set the `m_payment_id` attribute on the root span if it is only known later.
+    Inside another trace, this is a child span of that trace.
+    """
+    if getattr(_local, 'trace', None) is not None:
+        with span(name, m_payment_id=m_payment_id, **attributes) as child:
+            yield child
+        return
+    if not _sampled(m_payment_id):
+        yield NOOP_SPAN
+        return
+    attributes['m_payment_id'] = m_payment_id
+    _local.trace = current = _Trace()
+    try:
+        with span(name, **attributes) as root:
+            yield root
+    finally:
+        _local.trace = None
+        _export(current)
+
+
+@contextmanager
+def span(name, **attributes):  # type: (str, **Any) -> Iterator[Any]
+    """
+    Record a child span `name` of the current trace, if any.
+    """
+    current = getattr(_local, 'trace', None)
+    if current is None:
+        yield NOOP_SPAN
+        return
+    parent_id = current.stack[-1].span_id if current.stack else None
+    new = Span(name, parent_id, attributes)
+    current.stack.append(new)
+    try:
+        yield new
+    except BaseException as e:
+        new.error = type(e).__name__
+        raise
+    finally:
+        new.duration = default_timer() - new.start
+        current.stack.pop()
+        current.finished.append(new)
+
+
+def current_span():  # type: () -> Any
+    """
+    Return the innermost span of the current trace, or a no-op span.
+    """
+    current = getattr(_local, 'trace', None)
+    return current.stack[-1] if current is not None and current.stack else NOOP_SPAN
+
+
+def _export(current):  # type: (_Trace) -> None
+    root = current.finished[-1]
+    m_payment_id = root.attributes.get('m_payment_id')
+    trace_id = _random_id(16) if m_payment_id is None else trace_id_for(m_payment_id)
+    for finished in current.finished:
+        finished.trace_id = trace_id
+    for exporter in get_exporters():
+        try:
+            exporter.export(current.finished)
+        except Exception:
+            logger.exception('PayFast trace exporter %r failed', exporter)
+
+
+class LoggingExporter(object):
+    """
+    Log each span to the ``payfast.tracing`` logger, at DEBUG level.
+    """
+
+    def export(self, spans):  # type: (List[Span]) -> None
+        for finished in spans:
+            logger.debug('trace=%s span=%s parent=%s %s %.3fms error=%s %r',
+                         finished.trace_id, finished.span_id, finished.parent_id,
+                         finished.name, finished.duration * 1000, finished.error,
+                         finished.attributes)
+
+
+class MemoryExporter(object):
+    """
+    Keep the spans in memory (mainly for tests).
+    """
+
+    def __init__(self):  # type: () -> None
+        self.spans = []  # type: List[Span]
+
+    def export(self, spans):  # type: (List[Span]) -> None
+        self.spans.extend(spans)
+
+
+_exporters = None  # type: Optional[List[Any]]
+_lock = threading.Lock()
+
+
+def get_exporters():  # type: () -> List[Any]
+    global _exporters
+    if _exporters is None:
+        with _lock:
+            if _exporters is None:
+                _exporters = [
+                    import_string(exporter)() if isinstance(exporter, string_types) else exporter
+                    for exporter in conf.TRACE_EXPORTERS]
+    return _exporters
+
+
+def reset():  # type: () -> None
+    """
+    Discard the exporters, and the settings read from them (mainly for tests).
+    """
+    global _exporters
+    with _lock:
+        _exporters = None
@@ -1,8 +1,14 @@
 from django.conf.urls import url
 
+from payfast.health import health_view
+from payfast.metrics import metrics_view
 from payfast.views import notify_handler
+from payfast.warmup import readiness_view
 
 
 urlpatterns = [
     url('^notify/$', notify_handler, name='payfast_notify'),
+    url('^metrics/$', metrics_view, name='payfast_metrics'),
+    url('^ready/$', readiness_view, name='payfast_ready'),
+    url('^health/$', health_view, name='payfast_health'),
 ]
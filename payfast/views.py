@@ -1,37 +1,188 @@
-from django.http import HttpResponse, HttpResponseBadRequest
-from django.shortcuts import get_object_or_404
+from collections import namedtuple
+from typing import Optional  # noqa: F401
+
+from django.db import transaction
+from django.http import Http404, HttpRequest, HttpResponse, HttpResponseBadRequest  # noqa: F401
 from django.views.decorators.csrf import csrf_exempt
 
-from payfast.forms import NotifyForm
-from payfast.models import PayFastOrder
-from payfast import signals
+from payfast.forms import NotifyForm, start_postback
+from payfast.budgets import Budget
+from payfast.models import PayFastOrder, PayFastITNLog
+from payfast import admission
+from payfast import conf
+from payfast import dispatch
+from payfast import health
+from payfast import itn_log
+from payfast import merchants
+from payfast import metrics
+from payfast import routers
+from payfast import summaries
+from payfast import tracing
+
+
+#: Resource budgets of `notify_handler` (and `process_itn`), by path. See `payfast.budgets`.
+#:
+#: With the default settings, an accepted or rejected ITN takes the order lookup,
+#: its locked re-read and update, up to two `PayFastDailySummary` queries, and the
+#: ITN log entry. A duplicate ITN (repeating the order's current state) leaves the
+#: summary alone.
+#: An unknown order may still cost a postback in concurrent postback mode.
+ITN_BUDGETS = {
+    PayFastITNLog.VERDICT_ACCEPTED: Budget(queries=6, http_calls=1, seconds=1.0),
+    'duplicate': Budget(queries=4, http_calls=1, seconds=1.0),
+    PayFastITNLog.VERDICT_REJECTED: Budget(queries=6, http_calls=1, seconds=1.0),
+    PayFastITNLog.VERDICT_NOT_FOUND: Budget(queries=2, http_calls=1, seconds=1.0),
+}
+
+
+#: The outcome of `process_itn`.
+#:
+#: `verdict` is one of the `PayFastITNLog.VERDICT_*` values.
+#: `order` and `form` are None if the order was not found.
+ITNResult = namedtuple('ITNResult', ['verdict', 'order', 'form'])
+
+
+@routers.use_primary()
+def process_itn(request, commit=True, postback=True):
+    """
+    Validate an ITN request, and save and signal the result (see `payfast.dispatch`).
+
+    This is the processing pipeline behind `notify_handler`, for callers that
+    need to handle ITNs outside the view (such as the `payfast_replay_itn` command).
+
+    If `commit` is false, only look up and validate the order: nothing is saved,
+    recorded or signalled. If `postback` is false, no postback validation is
+    made, whatever the merchant's `use_postback`.
+
+    Reads are pinned to the primary database, and stay there briefly after
+    the order is saved: see `payfast.routers`.
+
+    Sampled ITNs are traced, under their `m_payment_id`: see `payfast.tracing`.
+    Outcomes are recorded for the health view: see `payfast.health`.
+
+    :rtype: ITNResult
+    """
+    m_payment_id = request.POST.get('m_payment_id', None)
+    try:
+        with tracing.trace('payfast.notify', m_payment_id, commit=commit) as span:
+            result = _process_itn(request, m_payment_id, commit, postback)
+            span.set_attribute('verdict', result.verdict)
+    except Exception as e:
+        if commit:
+            health.record_itn_error(e)
+        raise
+    if commit:
+        health.record_itn(result.verdict)
+    return result
+
+
+def _process_itn(request, m_payment_id, commit, use_postback):
+    # type: (HttpRequest, Optional[str], bool, bool) -> ITNResult
+    timer = itn_log.StageTimer()
+
+    # In concurrent mode, the postback is in flight during the lookup and validation.
+    postback = (start_postback(request)
+                if use_postback and conf.POSTBACK_MODE == 'concurrent' else None)
+
+    try:
+        with timer.stage('lookup'), tracing.span('payfast.notify.lookup'):
+            order = PayFastOrder.objects.get(m_payment_id=m_payment_id)
+    except PayFastOrder.DoesNotExist:
+        if postback is not None:
+            postback.cancel()
+        if commit:
+            itn_log.record(request, PayFastITNLog.VERDICT_NOT_FOUND, timings=timer.timings)
+            metrics.record_itn(PayFastITNLog.VERDICT_NOT_FOUND, timings=timer.timings)
+        return ITNResult(PayFastITNLog.VERDICT_NOT_FOUND, None, None)
+
+    form = NotifyForm(request, request.POST, instance=order, postback=postback,
+                      use_postback=None if use_postback else False)
+    with timer.stage('validate'), tracing.span('payfast.notify.validate'):
+        is_valid = form.is_valid()
+    if not is_valid:
+        if commit:
+            errors = form.plain_errors()
+            with timer.stage('save'), tracing.span('payfast.notify.save'), transaction.atomic():
+                order.request_ip = form.ip
+                order.debug_info = errors[:255]
+                order.trusted = False
+                previous = _stored_contribution(order)
+                order.save()
+                _update_summaries(previous, order)
+            routers.stick(order.m_payment_id)
+            itn_log.record(request, PayFastITNLog.VERDICT_REJECTED, order=order,
+                           errors=errors, timings=timer.timings)
+            metrics.record_itn(PayFastITNLog.VERDICT_REJECTED, form.rejection_reason(),
+                               timings=timer.timings)
+        return ITNResult(PayFastITNLog.VERDICT_REJECTED, order, form)
+
+    if commit:
+        with timer.stage('save'), tracing.span('payfast.notify.save'), transaction.atomic():
+            previous = _stored_contribution(order)
+            order = form.save()
+            _update_summaries(previous, order)
+        routers.stick(order.m_payment_id)
+        signal_span = tracing.span('payfast.notify.signal', dispatch=conf.NOTIFY_DISPATCH)
+        try:
+            with timer.stage('signal'), signal_span:
+                dispatch.send_notify(notify_handler, order)
+        finally:
+            # The order is saved: log the ITN even if a receiver failed.
+            itn_log.record(request, PayFastITNLog.VERDICT_ACCEPTED, order=order,
+                           timings=timer.timings)
+            metrics.record_itn(PayFastITNLog.VERDICT_ACCEPTED, timings=timer.timings)
+    return ITNResult(PayFastITNLog.VERDICT_ACCEPTED, order, form)
+
+
+def _stored_contribution(order):
+    # type: (PayFastOrder) -> Optional[summaries.Contribution]
+    """
+    Lock `order`'s row, and return the summary contribution of its stored state.
+
+    The form updates the order in place, so this reads the stored row again.
+    The lock holds until the transaction ends, so concurrent ITNs for the same
+    order move its contribution one after the other.
+    """
+    if not conf.DAILY_SUMMARIES:
+        return None
+    return summaries.contribution(PayFastOrder.objects.select_for_update().get(pk=order.pk))
+
+
+def _update_summaries(previous, order):
+    if conf.DAILY_SUMMARIES:
+        summaries.update(previous, summaries.contribution(order))
 
 
 @csrf_exempt
+@admission.admission_controlled
 def notify_handler(request):
     """
     Notify URL handler.
 
     On successful access 'payfast.signals.notify' signal is sent.
     Orders should be processed in signal handler.
+
+    Every request is recorded in the ITN log: see `payfast.itn_log`.
+    Requests may be shed under load: see `payfast.admission`.
+    While the postback circuit breaker is open, requests are answered with a
+    retryable 503, leaving the order untouched: see `payfast.merchants`.
     """
-    m_payment_id = request.POST.get('m_payment_id', None)
-    order = get_object_or_404(PayFastOrder, m_payment_id=m_payment_id)
+    try:
+        result = process_itn(request)
+    except merchants.PostbackUnavailable:
+        response = HttpResponse('Postback unavailable, please retry.',
+                                status=503, content_type='text/plain')
+        response['Retry-After'] = str(conf.POSTBACK_BREAKER_RESET)
+        return response
 
-    form = NotifyForm(request, request.POST, instance=order)
-    if not form.is_valid():
-        errors = form.plain_errors()[:255]
-        order.request_ip = form.ip
-        order.debug_info = errors
-        order.trusted = False
-        order.save()
+    if result.verdict == PayFastITNLog.VERDICT_NOT_FOUND:
+        raise Http404('No PayFastOrder matches the given query.')
 
+    if result.verdict == PayFastITNLog.VERDICT_REJECTED:
         # XXX: Any possible data leakage here?
         return HttpResponseBadRequest(
             content_type='application/json',
-            content=form.errors.as_json(),
+            content=result.form.errors.as_json(),
         )
 
-    order = form.save()
-    signals.notify.send(sender=notify_handler, order=order)
     return HttpResponse()
@@ -0,0 +1,180 @@
+"""
+Warm-up of the ITN path, so that the first ITNs after a deploy are not slow.
+
+Without it, the first ITN of each process builds the URL resolver, parses the
+PayFast IP networks, builds the merchants' signers, and opens a new TLS
+connection to the postback server.
+
+Settings:
+
+* `PAYFAST_WARMUP`: Warm up on a background thread when each process gets its
+  first request (default: False). See `payfast.apps.PayFastConfig`.
+* `PAYFAST_WARMUP_CONNECTIONS`: Postback connections to open ahead of use,
+  per postback server (default 2). This requires `PAYFAST_POSTBACK_POOL_SIZE`.
+
+The warm-up starts lazily, rather than when the app is loaded, so that management
+commands (such as ``migrate``) skip it, and so that each worker of a pre-fork server
+(which loads the app before forking) runs its own.
+
+The readiness view, mounted with ``payfast.urls`` at ``ready/`` and enabled with
+`PAYFAST_HEALTH_VIEW`, answers 503 until the warm-up is done, and 200 after
+(or if there is no warm-up). Point the load balancer's readiness check at it.
+
+A failed step is logged, and reported by exception type, but does not stop the
+warm-up.
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+from typing import Callable, Dict, List, Optional, Tuple  # noqa: F401
+
+from django.http import Http404, HttpResponse
+
+from payfast import conf
+from payfast import merchants
+from payfast.forms import notify_url, payfast_ip_networks
+
+
+logger = logging.getLogger(__name__)
+
+
+def _resolve_urls():  # type: () -> None
+    # Builds the URL resolver, importing the URLconf and views.
+    notify_url()
+
+
+def _build_merchants():  # type: () -> None
+    for merchant in merchants.get_registry():
+        merchant.signer.itn_signature({'merchant_id': merchant.merchant_id})
+        merchant.signer.checkout_signature({'merchant_id': merchant.merchant_id})
+        # Builds the postback client, and its connection pool.
+        merchant.postback
+
+
+def _parse_ip_networks():  # type: () -> None
+    payfast_ip_networks()
+
+
+def _open_postback_connections():  # type: () -> None
+    pools = {merchant.postback.pool.server: merchant.postback.pool
+             for merchant in merchants.get_registry()
+             if merchant.use_postback and merchant.postback.pool is not None}
+    for pool in pools.values():
+        pool.warm(conf.WARMUP_CONNECTIONS)
+
+
+#: The warm-up steps, in order: (name, function).
+STEPS = [
+    ('urls', _resolve_urls),
+    ('merchants', _build_merchants),
+    ('ip_networks', _parse_ip_networks),
+    ('postback_connections', _open_postback_connections),
+]  # type: List[Tuple[str, Callable[[], None]]]
+
+
+class WarmupState(object):
+
+    def __init__(self):  # type: () -> None
+        #: The process this state belongs to.
+        self.pid = os.getpid()
+        self.started = False
+        self.done = threading.Event()
+        #: Step name: seconds taken, or the type of the error that failed it.
+        self.steps = OrderedDict()  # type: Dict[str, object]
+
+
+_state = WarmupState()
+_lock = threading.Lock()
+
+
+def _get_state():  # type: () -> WarmupState
+    """
+    Return the warm-up state of this process: a forked process starts afresh,
+    since the warm-up thread of its parent does not exist in it.
+    """
+    global _state
+    if _state.pid != os.getpid():
+        with _lock:
+            if _state.pid != os.getpid():
+                _state = WarmupState()
+    return _state
+
+
+def run():  # type: () -> Dict[str, object]
+    """
+    Run the warm-up steps now, and return their report.
+    """
+    state = _get_state()
+    state.started = True
+    for (name, step) in STEPS:
+        started = default_timer()
+        try:
+            step()
+        except Exception as e:
+            logger.exception('PayFast warm-up step %s failed', name)
+            state.steps[name] = type(e).__name__
+        else:
+            state.steps[name] = round(default_timer() - started, 6)
+    state.done.set()
+    return state.steps
+
+
+def start():  # type: () -> None
+    """
+    Run the warm-up on a background thread, once per process.
+    """
+    state = _get_state()
+    if state.started:
+        return
+    with _lock:
+        if state.started:
+            return
+        state.started = True
+    thread = threading.Thread(target=run, name='payfast-warmup')
+    thread.daemon = True
+    thread.start()
+
+
+def is_ready():  # type: () -> bool
+    """
+    Return whether the warm-up is done (or was never started).
+    """
+    state = _get_state()
+    return not state.started or state.done.is_set()
+
+
+def start_on_request(sender, **kwargs):
+    """
+    Start the warm-up on the first request of each process
+    (connected to `request_started` with `PAYFAST_WARMUP`).
+    """
+    start()
+
+
+def reset():  # type: () -> None
+    """
+    Forget the warm-up state (mainly for tests).
+    """
+    global _state
+    with _lock:
+        _state = WarmupState()
+
+
+def readiness_view(request):
+    """
+    Report whether the warm-up is done: 200 if so, 503 if not.
+    """
+    if not conf.HEALTH_VIEW:
+        raise Http404('Health checks are disabled.')
+    ready = is_ready()
+    steps = OrderedDict(list(_get_state().steps.items()))
+    return HttpResponse(
+        json.dumps({'ready': ready, 'warmup': steps}),
+        status=200 if ready else 503,
+        content_type='application/json',
+    )
@@ -41,7 +41,13 @@ DATABASES = {
         # Add 'postgresql_psycopg2', 'postgresql', 'mysql', 'sqlite3' or 'oracle'.
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': join('db.sqlite'),  # Or path to database file if using sqlite3.
-    }
+    },
+    # A stand-in read replica, for the payfast.routers tests.
+    # (The tests only enable the router where they need it.)
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': join('db-replica.sqlite'),
+    },
 }
 
 USE_TZ = True
@@ -8,7 +8,7 @@ def README():
         return f.read()
 
 
-_PYTHON_2_BACKPORTS = ['ipaddress'] if sys.version_info < (3,) else []
+_PYTHON_2_BACKPORTS = ['ipaddress', 'futures'] if sys.version_info < (3,) else []
 
 
 setup(
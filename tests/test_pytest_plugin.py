@@ -0,0 +1,71 @@
+"""
+Tests for the payfast pytest plugin (`payfast.pytest_plugin`).
+"""
+from __future__ import unicode_literals
+
+from textwrap import dedent
+
+
+pytest_plugins = ['pytester']
+
+# The plugin's tests don't touch the database.
+TESTS = dedent('''
+    import os
+
+    import pytest
+
+    from payfast import api
+    from payfast.budgets import Budget
+
+
+    @pytest.fixture(autouse=True)
+    def fake_postback(monkeypatch):
+        monkeypatch.setattr(api, 'data_is_valid', lambda post_data, postback_server: True)
+
+
+    def test_usage(payfast_usage):
+        with payfast_usage(databases=[]) as usage:
+            api.data_is_valid({}, 'https://example.com/')
+        assert usage.http_calls == ['https://example.com/']
+        assert usage.queries == []
+
+
+    def test_budget(payfast_budget):
+        with payfast_budget(Budget(queries=0, http_calls=1, seconds=None), databases=[]):
+            api.data_is_valid({}, 'https://example.com/')
+
+
+    def test_over_budget(payfast_budget):
+        with pytest.raises(AssertionError) as excinfo:
+            with payfast_budget(Budget(queries=0, http_calls=0, seconds=None), databases=[]):
+                api.data_is_valid({}, 'https://example.com/')
+        assert '1 HTTP calls, budget 0' in str(excinfo.value)
+
+
+    @pytest.mark.payfast_budget(Budget(queries=0, http_calls=1, seconds=None), databases=[])
+    def test_marker():
+        api.data_is_valid({}, 'https://example.com/')
+
+
+    @pytest.mark.payfast_budget(Budget(queries=0, http_calls=0, seconds=None), databases=[])
+    def test_marker_over_budget():
+        api.data_is_valid({}, 'https://example.com/')
+
+
+    def test_time_factor():
+        assert os.environ.get('PAYFAST_BUDGET_TIME_FACTOR') == '2.5'
+''')
+
+
+def test_plugin(testdir):
+    testdir.makepyfile(TESTS)
+    # In a subprocess, so that the time factor doesn't leak into this process's environment.
+    result = testdir.runpytest_subprocess(
+        '-p', 'payfast.pytest_plugin', '--payfast-budget-time-factor', '2.5')
+    result.assert_outcomes(passed=5, failed=1)
+    result.stdout.fnmatch_lines(['*test_marker_over_budget*', '*1 HTTP calls, budget 0*'])
+
+
+def test_marker_registered(testdir):
+    result = testdir.runpytest_subprocess('-p', 'payfast.pytest_plugin', '--markers')
+    result.stdout.fnmatch_lines(['@pytest.mark.payfast_budget(budget, databases=None):*'])